@@ -1,4 +1,4 @@
 
-from .db import get_conn, init_db, new_client
+from .db import get_conn, init_db, new_client, new_issuer, get_or_create_client_by_nif, get_or_create_clients_by_nif
 from .clients import add_client, choose_client_id, validate_client
 from .invoices import create_invoice_interactive
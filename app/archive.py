@@ -0,0 +1,206 @@
+import os
+import re
+from datetime import datetime
+from typing import List, Optional
+from urllib.request import pathname2url
+
+ARCHIVE_DB_TEMPLATE = "invoice_archive_{year}.db"
+MAX_ATTACHED = 4  # SQLite allows 10 attached databases per connection
+_NUMBER_YEAR_RE = re.compile(r"^[A-Z]*(\d{4})-")
+
+
+def db_file(conn) -> str:
+    """Path of the main database file behind `conn` ('' for in-memory DBs)."""
+    for _, name, path in conn.execute("PRAGMA database_list").fetchall():
+        if name == "main":
+            return path or ""
+    return ""
+
+
+def archive_path(conn, year: int) -> str:
+    main = db_file(conn)
+    folder = os.path.dirname(main) if main else os.getcwd()
+    return os.path.join(folder, ARCHIVE_DB_TEMPLATE.format(year=int(year)))
+
+
+def _alias(year: int) -> str:
+    return f"archive_{int(year)}"
+
+
+def _attached(conn) -> List[str]:
+    return [name for _, name, _ in conn.execute("PRAGMA database_list").fetchall()]
+
+
+def _detach(conn, alias: str) -> None:
+    if alias in _attached(conn):
+        conn.execute("DETACH DATABASE " + alias)
+
+
+def archived_years(conn) -> List[int]:
+    cur = conn.cursor()
+    cur.execute("SELECT year FROM archived_years ORDER BY year")
+    return [r[0] for r in cur.fetchall()]
+
+
+def attach_archive(conn, year: int) -> Optional[str]:
+    """
+    Attach the archive of `year` read-only and return its schema alias, or
+    None if that year was never archived. At most MAX_ATTACHED archives stay
+    attached per connection; the oldest attachment is detached first.
+    """
+    alias = _alias(year)
+    attached = _attached(conn)
+    if alias in attached:
+        return alias
+    cur = conn.cursor()
+    cur.execute("SELECT path FROM archived_years WHERE year = ?", (int(year),))
+    row = cur.fetchone()
+    if not row or not os.path.exists(row[0]):
+        return None
+    archives = [name for name in attached if name.startswith("archive_")]  # in attach order
+    for old in archives[:max(0, len(archives) - MAX_ATTACHED + 1)]:
+        conn.execute("DETACH DATABASE " + old)
+    uri = "file:" + pathname2url(os.path.abspath(row[0])) + "?mode=ro"
+    cur.execute("ATTACH DATABASE ? AS " + alias, (uri,))
+    return alias
+
+
+def _year_stats(conn, schema: str, year: int):
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT COUNT(*), ROUND(COALESCE(SUM(total), 0), 2)
+        FROM {schema}.invoices WHERE substr(date, 1, 4) = ?
+    """, (f"{int(year):04d}",))
+    n_inv, sum_total = cur.fetchone()
+    cur.execute(f"""
+        SELECT COUNT(*), ROUND(COALESCE(SUM(it.line_total), 0), 2)
+        FROM {schema}.invoice_items it
+        JOIN {schema}.invoices i ON i.id = it.invoice_id
+        WHERE substr(i.date, 1, 4) = ?
+    """, (f"{int(year):04d}",))
+    n_items, sum_lines = cur.fetchone()
+    return n_inv, n_items, sum_total, sum_lines
+
+
+def archive_year(conn, year: int) -> dict:
+    """
+    Move every invoice dated in `year` (and its items) out of the main DB into
+    invoice_archive_<year>.db. The copy and the delete happen in one
+    transaction spanning both files; counts and sums are checked before
+    committing and the archive is re-read read-only afterwards.
+    """
+    year = int(year)
+    if year >= datetime.today().year:
+        raise ValueError(f"Year {year} is not closed yet.")
+    if year in archived_years(conn):
+        raise ValueError(f"Year {year} is already archived.")
+    path = archive_path(conn, year)
+    if os.path.exists(path):
+        raise ValueError(f"Archive file already exists: {path}")
+
+    expected = _year_stats(conn, "main", year)
+    if expected[0] == 0:
+        raise ValueError(f"No invoices dated {year} in the main database.")
+
+    conn.commit()  # ATTACH is not allowed inside a transaction
+    cur = conn.cursor()
+    cur.execute("ATTACH DATABASE ? AS archive_new", (path,))
+    done = False
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            # Same columns as the live tables, whatever migrations they have had.
+            cur.execute("CREATE TABLE archive_new.invoices AS SELECT * FROM main.invoices WHERE 0")
+            cur.execute("CREATE TABLE archive_new.invoice_items AS SELECT * FROM main.invoice_items WHERE 0")
+            cur.execute("CREATE UNIQUE INDEX archive_new.ux_invoices_number ON invoices(number)")
+            cur.execute("CREATE UNIQUE INDEX archive_new.ux_invoices_id ON invoices(id)")
+            cur.execute("CREATE INDEX archive_new.ix_items_invoice ON invoice_items(invoice_id)")
+
+            cur.execute("""
+                INSERT INTO archive_new.invoices
+                SELECT * FROM main.invoices WHERE substr(date, 1, 4) = ? ORDER BY id
+            """, (f"{year:04d}",))
+            cur.execute("""
+                INSERT INTO archive_new.invoice_items
+                SELECT * FROM main.invoice_items
+                WHERE invoice_id IN (SELECT id FROM archive_new.invoices) ORDER BY id
+            """)
+
+            copied = _year_stats(conn, "archive_new", year)
+            if copied != expected:
+                raise RuntimeError(f"Archive copy mismatch: expected {expected}, got {copied}")
+
+            # Keep each issuer's sequence for the year past everything that
+            # leaves the main DB.
+            cur.execute("""
+                INSERT INTO main.invoice_seq(issuer_id, year, next_seq)
+                SELECT a.issuer_id, ?, MAX(CAST(substr(a.number, length(s.series) + 6) AS INTEGER)) + 1
+                FROM archive_new.invoices a JOIN main.issuers s ON s.id = a.issuer_id
+                WHERE a.number GLOB s.series || ?
+                GROUP BY a.issuer_id
+                ON CONFLICT(issuer_id, year) DO UPDATE SET next_seq = MAX(next_seq, excluded.next_seq)
+            """, (year, f"{year:04d}-[0-9]*"))
+
+            cur.execute("""
+                DELETE FROM main.invoice_items
+                WHERE invoice_id IN (SELECT id FROM archive_new.invoices)
+            """)
+            cur.execute("DELETE FROM main.invoices WHERE id IN (SELECT id FROM archive_new.invoices)")
+            cur.execute("""
+                INSERT INTO main.archived_years(year, path, invoices, items, archived_at, min_id, max_id)
+                SELECT ?, ?, ?, ?, ?, MIN(id), MAX(id) FROM archive_new.invoices
+            """, (year, path, expected[0], expected[1], datetime.now().isoformat(timespec="seconds")))
+            conn.commit()
+            done = True
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        cur.execute("DETACH DATABASE archive_new")
+        if not done and os.path.exists(path):
+            # ATTACH created the file; leave nothing behind so a retry can run.
+            os.remove(path)
+
+    if _year_stats(conn, "main", year)[0] != 0:
+        raise RuntimeError(f"Invoices dated {year} still present in the main database.")
+    alias = attach_archive(conn, year)
+    try:
+        check = conn.execute(f"PRAGMA {alias}.integrity_check").fetchone()[0]
+        stored = _year_stats(conn, alias, year)
+    finally:
+        _detach(conn, alias)
+    if check != "ok" or stored != expected:
+        raise RuntimeError(f"Archive verification failed for {year}: {check}, {stored} != {expected}")
+
+    return {"year": year, "path": path, "invoices": expected[0], "items": expected[1], "total": expected[2]}
+
+
+def find_archived_invoice(conn, invoice_id: Optional[int] = None, number: Optional[str] = None) -> Optional[str]:
+    """
+    Return the alias of the attached archive holding the invoice, or None.
+    An id goes to the archives whose id range covers it and a number
+    '[series]YYYY-...' to that year's archive; anything else (and archives
+    written before id ranges were recorded) is looked up newest first.
+    """
+    if number is not None:
+        m = _NUMBER_YEAR_RE.match(number)
+        first = [int(m.group(1))] if m else []
+        rest = list(reversed(archived_years(conn)))  # an override number may be dated in another year
+    else:
+        first = [r[0] for r in conn.execute("""
+            SELECT year FROM archived_years WHERE ? BETWEEN min_id AND max_id ORDER BY year DESC
+        """, (invoice_id,)).fetchall()]
+        rest = [r[0] for r in conn.execute("""
+            SELECT year FROM archived_years WHERE min_id IS NULL ORDER BY year DESC
+        """).fetchall()]
+    for year in first + [y for y in rest if y not in first]:
+        alias = attach_archive(conn, year)
+        if not alias:
+            continue
+        if number is not None:
+            found = conn.execute(f"SELECT 1 FROM {alias}.invoices WHERE number = ?", (number,)).fetchall()
+        else:
+            found = conn.execute(f"SELECT 1 FROM {alias}.invoices WHERE id = ?", (invoice_id,)).fetchall()
+        if found:
+            return alias
+    return None
@@ -0,0 +1,177 @@
+from typing import Dict, List, Optional
+
+# Whole-database consistency checks, each one a single set-based query
+# (grouped aggregates / window functions) over the main DB. Archived years
+# live in their own files and are verified when they are archived.
+# Numbering is checked per issuer: '[series]YYYY-NNNN' with the issuer's series.
+# Every check takes :since and :issuer (None = all issuers).
+
+_SEQS = """
+    SELECT i.id, i.number, i.date, i.issuer_id,
+           CAST(substr(i.number, length(s.series) + 1, 4) AS INTEGER) AS year,
+           CAST(substr(i.number, length(s.series) + 6) AS INTEGER) AS seq
+    FROM invoices i JOIN issuers s ON s.id = i.issuer_id
+    WHERE i.number GLOB s.series || '[0-9][0-9][0-9][0-9]-[0-9]*'
+      AND substr(i.number, length(s.series) + 6) NOT GLOB '*[^0-9]*'
+      AND (:issuer IS NULL OR i.issuer_id = :issuer)
+"""
+
+
+def _params(since: Optional[str], issuer_id: Optional[int]) -> dict:
+    return {"since": since or "", "since_year": int(since[:4]) if since else 0, "issuer": issuer_id}
+
+
+def total_mismatches(conn, since: Optional[str] = None, issuer_id: Optional[int] = None) -> List[tuple]:
+    """
+    Invoices whose stored base/IVA/total do not match their lines (all in cents):
+    (id, number, base, lines_base, iva, lines_iva, irpf, total)
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        WITH per_rate AS (
+            SELECT it.invoice_id, it.iva_rate_bp, SUM(it.line_total_cents) AS base
+            FROM invoice_items it
+            WHERE it.invoice_id IN (SELECT id FROM invoices WHERE date >= :since
+                                    AND (:issuer IS NULL OR issuer_id = :issuer))
+            GROUP BY it.invoice_id, it.iva_rate_bp
+        ), lines AS (
+            SELECT invoice_id,
+                   SUM(base) AS base,
+                   SUM(CAST(ROUND(base * iva_rate_bp / 10000.0) AS INTEGER)) AS iva
+            FROM per_rate GROUP BY invoice_id
+        )
+        SELECT i.id, i.number, i.base_cents, COALESCE(l.base, 0), i.iva_cents, COALESCE(l.iva, 0),
+               i.irpf_cents, i.total_cents
+        FROM invoices i LEFT JOIN lines l ON l.invoice_id = i.id
+        WHERE i.date >= :since AND (:issuer IS NULL OR i.issuer_id = :issuer)
+          AND (i.base_cents <> COALESCE(l.base, 0)
+               OR i.iva_cents <> COALESCE(l.iva, 0)
+               OR i.total_cents <> i.base_cents + i.iva_cents - i.irpf_cents
+               OR ABS(i.total - i.total_cents / 100.0) >= 0.005)
+        ORDER BY i.date, i.id
+    """, _params(since, issuer_id))
+    return cur.fetchall()
+
+
+def orphan_items(conn) -> List[tuple]:
+    """(item id, invoice_id) of lines whose invoice does not exist."""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT it.id, it.invoice_id FROM invoice_items it
+        LEFT JOIN invoices i ON i.id = it.invoice_id
+        WHERE i.id IS NULL ORDER BY it.id
+    """)
+    return cur.fetchall()
+
+
+def missing_clients(conn, since: Optional[str] = None, issuer_id: Optional[int] = None) -> List[tuple]:
+    """(id, number, client_id) of invoices pointing to a client that does not exist."""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT i.id, i.number, i.client_id FROM invoices i
+        LEFT JOIN clients c ON c.id = i.client_id
+        WHERE c.id IS NULL AND i.date >= :since AND (:issuer IS NULL OR i.issuer_id = :issuer)
+        ORDER BY i.id
+    """, _params(since, issuer_id))
+    return cur.fetchall()
+
+
+def numbering_gaps(conn, since: Optional[str] = None, issuer_id: Optional[int] = None) -> List[tuple]:
+    """
+    (issuer_id, year, first_missing, last_missing) for each hole in an issuer's
+    yearly sequence that is not covered by a range skipped with
+    forward_invoice_number.
+    """
+    cur = conn.cursor()
+    cur.execute(f"""
+        WITH seqs AS ({_SEQS}), w AS (
+            SELECT issuer_id, year, seq,
+                   LAG(seq, 1, 0) OVER (PARTITION BY issuer_id, year ORDER BY seq, id) AS prev
+            FROM seqs WHERE year >= :since_year
+        )
+        SELECT issuer_id, year, prev + 1, seq - 1 FROM w
+        WHERE seq > prev + 1
+          AND NOT EXISTS (
+              SELECT 1 FROM invoice_seq_skips k
+              WHERE k.issuer_id = w.issuer_id AND k.year = w.year
+                AND k.from_seq <= w.prev + 1 AND k.to_seq >= w.seq - 1)
+        ORDER BY issuer_id, year, seq
+    """, _params(since, issuer_id))
+    return cur.fetchall()
+
+
+def numbering_duplicates(conn, since: Optional[str] = None, issuer_id: Optional[int] = None) -> List[tuple]:
+    """(issuer_id, year, seq, numbers) for sequence values used more than once (e.g. 2025-0007 and 2025-007)."""
+    cur = conn.cursor()
+    cur.execute(f"""
+        WITH seqs AS ({_SEQS})
+        SELECT issuer_id, year, seq, GROUP_CONCAT(number, ', ') FROM seqs
+        WHERE year >= :since_year
+        GROUP BY issuer_id, year, seq HAVING COUNT(*) > 1
+        ORDER BY issuer_id, year, seq
+    """, _params(since, issuer_id))
+    return cur.fetchall()
+
+
+def nonstandard_numbers(conn, since: Optional[str] = None, issuer_id: Optional[int] = None) -> List[tuple]:
+    """(id, number, date) of invoices not numbered [series]YYYY-NNNN (override_number)."""
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT id, number, date FROM invoices
+        WHERE id NOT IN (SELECT id FROM ({_SEQS})) AND date >= :since
+          AND (:issuer IS NULL OR issuer_id = :issuer)
+        ORDER BY date, id
+    """, _params(since, issuer_id))
+    return cur.fetchall()
+
+
+def seq_drift(conn, since: Optional[str] = None, issuer_id: Optional[int] = None) -> List[tuple]:
+    """
+    (issuer_id, year, next_seq, max_used) where invoice_seq would hand out a
+    number already used (next_seq <= max_used), or is missing (next_seq NULL).
+    """
+    cur = conn.cursor()
+    cur.execute(f"""
+        WITH used AS (
+            SELECT issuer_id, year, MAX(seq) AS max_seq FROM ({_SEQS})
+            WHERE year >= :since_year GROUP BY issuer_id, year
+        )
+        SELECT u.issuer_id, u.year, s.next_seq, u.max_seq FROM used u
+        LEFT JOIN invoice_seq s ON s.issuer_id = u.issuer_id AND s.year = u.year
+        WHERE s.next_seq IS NULL OR s.next_seq <= u.max_seq
+        ORDER BY u.issuer_id, u.year
+    """, _params(since, issuer_id))
+    return cur.fetchall()
+
+
+def run_audit(conn, since: Optional[str] = None, issuer_id: Optional[int] = None) -> Dict[str, List[tuple]]:
+    """
+    All checks. `since` ('YYYY-MM-DD') limits invoice checks to invoices
+    dated on/after it and numbering checks to its year onwards; `issuer_id`
+    limits them to one issuer.
+    """
+    return {
+        "total_mismatches": total_mismatches(conn, since, issuer_id),
+        "orphan_items": orphan_items(conn),
+        "missing_clients": missing_clients(conn, since, issuer_id),
+        "numbering_gaps": numbering_gaps(conn, since, issuer_id),
+        "numbering_duplicates": numbering_duplicates(conn, since, issuer_id),
+        "nonstandard_numbers": nonstandard_numbers(conn, since, issuer_id),
+        "seq_drift": seq_drift(conn, since, issuer_id),
+    }
+
+
+def format_report(report: Dict[str, List[tuple]], limit: int = 20) -> str:
+    lines = []
+    for name, rows in report.items():
+        lines.append(f"{name}: {len(rows)}")
+        for row in rows[:limit]:
+            lines.append("    " + " | ".join(str(v) for v in row))
+        if len(rows) > limit:
+            lines.append(f"    ... {len(rows) - limit} more")
+    return "\n".join(lines)
+
+
+def has_problems(report: Dict[str, List[tuple]]) -> bool:
+    # override numbers are allowed; they are listed for information only
+    return any(rows for name, rows in report.items() if name != "nonstandard_numbers")
@@ -0,0 +1,140 @@
+import glob
+import gzip
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from .settings import BACKUP_DIR, BACKUP_KEEP
+
+# Online backups through the SQLite backup API: the source is copied a few
+# pages at a time with a pause between steps, so the GUI can keep writing.
+# The API's own `sleep` only applies when a step hits BUSY/LOCKED, so the
+# pause is taken in the progress callback.
+BACKUP_PAGES = 64      # pages copied per step
+BACKUP_SLEEP = 0.005   # seconds between steps
+
+
+def _stem(db_path: str) -> str:
+    return os.path.splitext(os.path.basename(db_path))[0]
+
+
+def _integrity(path: str) -> str:
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+
+
+_SNAPSHOT_RE = re.compile(r"-(\d{8}-\d{6})(?:-(\d+))?\.db\.gz$")
+
+
+def _snapshot_key(path: str):
+    m = _SNAPSHOT_RE.search(path)
+    return (m.group(1), int(m.group(2) or 0)) if m else ("", 0)
+
+
+def list_snapshots(db_path: str, dest_dir: str = BACKUP_DIR) -> List[str]:
+    """Snapshots of `db_path`, oldest first."""
+    paths = glob.glob(os.path.join(dest_dir, f"{_stem(db_path)}-*.db.gz"))
+    return sorted((p for p in paths if _SNAPSHOT_RE.search(p)), key=_snapshot_key)
+
+
+def rotate(db_path: str, dest_dir: str = BACKUP_DIR, keep: Optional[int] = BACKUP_KEEP) -> List[str]:
+    """Delete all but the `keep` newest snapshots (None keeps all); returns the deleted paths."""
+    old = list_snapshots(db_path, dest_dir)[:-keep] if keep else []
+    for path in old:
+        os.remove(path)
+    return old
+
+
+def backup_db(db_path: str, dest_dir: str = BACKUP_DIR, keep: Optional[int] = BACKUP_KEEP,
+              pages: int = BACKUP_PAGES, sleep: float = BACKUP_SLEEP, progress=None) -> str:
+    """
+    Snapshot `db_path` into dest_dir/<name>-YYYYmmdd-HHMMSS.db.gz and return
+    its path. The copy is integrity-checked before it is compressed; old
+    snapshots beyond `keep` are rotated out.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    final = os.path.join(dest_dir, f"{_stem(db_path)}-{stamp}.db.gz")
+    # same second: number past the newest snapshot of that second (never reuse
+    # a name rotation freed, or the new snapshot would sort as the oldest)
+    same = [_snapshot_key(p)[1] for p in list_snapshots(db_path, dest_dir) if _snapshot_key(p)[0] == stamp]
+    if same:
+        final = os.path.join(dest_dir, f"{_stem(db_path)}-{stamp}-{max(same) + 1}.db.gz")
+    fd, raw = tempfile.mkstemp(suffix=".db.partial", dir=dest_dir)
+    os.close(fd)
+    try:
+        src = sqlite3.connect(db_path)
+        dst = sqlite3.connect(raw)
+        def step(status, remaining, total):
+            if progress is not None:
+                progress(status, remaining, total)
+            if remaining and sleep:
+                time.sleep(sleep)
+
+        try:
+            src.backup(dst, pages=pages, progress=step, sleep=sleep)
+        finally:
+            dst.close()
+            src.close()
+
+        check = _integrity(raw)
+        if check != "ok":
+            raise RuntimeError(f"Backup failed integrity_check: {check}")
+
+        with open(raw, "rb") as fin, gzip.open(final + ".partial", "wb") as fout:
+            shutil.copyfileobj(fin, fout, 1024 * 1024)
+        os.replace(final + ".partial", final)
+    finally:
+        for path in (raw, final + ".partial"):
+            if os.path.exists(path):
+                os.remove(path)
+    rotate(db_path, dest_dir, keep)
+    return final
+
+
+def _unpack(snapshot: str, dest_dir: str) -> str:
+    fd, raw = tempfile.mkstemp(suffix=".db", dir=dest_dir)
+    with os.fdopen(fd, "wb") as fout, gzip.open(snapshot, "rb") as fin:
+        shutil.copyfileobj(fin, fout, 1024 * 1024)
+    return raw
+
+
+def verify_snapshot(snapshot: str) -> str:
+    """Decompress a snapshot to a temp file and return its integrity_check result."""
+    raw = _unpack(snapshot, os.path.dirname(os.path.abspath(snapshot)))
+    try:
+        return _integrity(raw)
+    finally:
+        os.remove(raw)
+
+
+def restore_snapshot(snapshot: str, db_path: str, dest_dir: str = BACKUP_DIR) -> Optional[str]:
+    """
+    Replace the contents of `db_path` with `snapshot`. The current database
+    is snapshotted first (path returned) and the restore itself goes through
+    the backup API, so other connections see either the old or the new DB.
+    """
+    raw = _unpack(snapshot, os.path.dirname(os.path.abspath(snapshot)))
+    try:
+        check = _integrity(raw)
+        if check != "ok":
+            raise RuntimeError(f"Snapshot failed integrity_check: {check}")
+        safety = backup_db(db_path, dest_dir, keep=None) if os.path.exists(db_path) else None
+        src = sqlite3.connect(raw)
+        dst = sqlite3.connect(db_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        return safety
+    finally:
+        os.remove(raw)
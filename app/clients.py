@@ -1,4 +1,5 @@
 
+from .repository import client_repo
 from .utils import validate_nif
 
 def add_client():
@@ -16,7 +17,7 @@ def validate_client(client: dict) -> bool:
         print("Name is required.")
         return False
     if client.get("nif") and not validate_nif(client["nif"]):
-        print("Warning: NIF format looks invalid.")
+        print("Warning: NIF/NIE/CIF control character is invalid.")
     return True
 
 def choose_client_id(conn):
@@ -28,9 +29,7 @@ def choose_client_id(conn):
     except ValueError:
         print("Not a number.")
         return None
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM clients WHERE id = ?", (cid,))
-    if cur.fetchone():
+    if client_repo(conn).exists(cid):
         return cid
     print("Client id not found.")
     return None
@@ -1,18 +1,42 @@
 
+import re
 import sqlite3
 from datetime import datetime
 from typing import Optional, List, Tuple, Dict
 
+from .archive import find_archived_invoice
+from .register import append_record
+from .repository import Connection, client_repo
+from .settings import COMPANY_NAME, COMPANY_NIF, COMPANY_ADDRESS, COMPANY_IBAN, IVA_RATE
+from .totals import to_cents, rate_bp, line_total_cents, BP_SCALE
+from .utils import normalize_nif, validate_nif
+
 DB_NAME = "invoice_app.db"
+NUMBER_RE = re.compile(r"^([A-Z]*)(\d{4})-(\d+)$")  # [series]YYYY-NNNN
+SERIES_RE = re.compile(r"^[A-Z]{0,5}$")
+DEFAULT_ISSUER_ID = 1
 
 SCHEMA = [
+    # Legal entities we bill for; id 1 is seeded from settings.py.
+    # series prefixes their invoice numbers ('' for the default issuer).
+    """CREATE TABLE IF NOT EXISTS issuers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        nif TEXT NOT NULL,
+        address TEXT,
+        iban TEXT,
+        series TEXT NOT NULL UNIQUE,
+        created_at TEXT NOT NULL
+    );""",
+
     """CREATE TABLE IF NOT EXISTS clients (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT NOT NULL,
         nif TEXT,
         address TEXT,
         email TEXT,
-        phone TEXT
+        phone TEXT,
+        nif_norm TEXT
     );""",
 
     """CREATE TABLE IF NOT EXISTS invoices (
@@ -25,6 +49,11 @@ SCHEMA = [
         irpf REAL NOT NULL,
         total REAL NOT NULL,
         notes TEXT,
+        base_cents INTEGER NOT NULL DEFAULT 0,
+        iva_cents INTEGER NOT NULL DEFAULT 0,
+        irpf_cents INTEGER NOT NULL DEFAULT 0,
+        total_cents INTEGER NOT NULL DEFAULT 0,
+        issuer_id INTEGER NOT NULL DEFAULT 1,
         FOREIGN KEY(client_id) REFERENCES clients(id)
     );""",
 
@@ -35,44 +64,353 @@ SCHEMA = [
         qty REAL NOT NULL,
         unit_price REAL NOT NULL,
         line_total REAL NOT NULL,
+        unit_price_cents INTEGER NOT NULL DEFAULT 0,
+        line_total_cents INTEGER NOT NULL DEFAULT 0,
+        iva_rate_bp INTEGER NOT NULL DEFAULT 2100,
         FOREIGN KEY(invoice_id) REFERENCES invoices(id)
     );""",
 
     """CREATE TABLE IF NOT EXISTS invoice_seq (
+        issuer_id INTEGER NOT NULL,
+        year INTEGER NOT NULL,
+        next_seq INTEGER NOT NULL,
+        PRIMARY KEY (issuer_id, year)
+    );""",
+
+    # Closed years moved to invoice_archive_<year>.db (see app/archive.py)
+    """CREATE TABLE IF NOT EXISTS archived_years (
         year INTEGER PRIMARY KEY,
-        next_seq INTEGER NOT NULL
+        path TEXT NOT NULL,
+        invoices INTEGER NOT NULL,
+        items INTEGER NOT NULL,
+        archived_at TEXT NOT NULL,
+        min_id INTEGER,             -- invoice id range, routes lookups by id
+        max_id INTEGER
+    );""",
+
+    # Ranges skipped on purpose by forward_invoice_number (not gaps for the audit)
+    """CREATE TABLE IF NOT EXISTS invoice_seq_skips (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        issuer_id INTEGER NOT NULL DEFAULT 1,
+        year INTEGER NOT NULL,
+        from_seq INTEGER NOT NULL,
+        to_seq INTEGER NOT NULL,
+        created_at TEXT NOT NULL
+    );""",
+
+    # Invoice emails waiting for / done by the delivery worker (app/mailer.py)
+    """CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        invoice_id INTEGER NOT NULL,
+        recipient TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        body TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TEXT NOT NULL,
+        claimed_at TEXT,
+        last_error TEXT,
+        created_at TEXT NOT NULL,
+        sent_at TEXT,
+        FOREIGN KEY(invoice_id) REFERENCES invoices(id)
+    );""",
+
+    # PDF renders queued on save and run by app/render_worker.py
+    """CREATE TABLE IF NOT EXISTS render_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        invoice_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TEXT NOT NULL,
+        claimed_by TEXT,
+        claimed_at TEXT,
+        duration_ms INTEGER,
+        output TEXT,
+        last_error TEXT,
+        created_at TEXT NOT NULL,
+        finished_at TEXT,
+        FOREIGN KEY(invoice_id) REFERENCES invoices(id)
+    );""",
+
+    # VeriFactu-style hash chain, one per issuer NIF; see app/register.py.
+    # No FK: records outlive invoices moved to an archive.
+    """CREATE TABLE IF NOT EXISTS invoice_register (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        issuer_nif TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        invoice_id INTEGER NOT NULL,
+        number TEXT NOT NULL,
+        date TEXT NOT NULL,
+        record_type TEXT NOT NULL DEFAULT 'F1',
+        iva_cents INTEGER NOT NULL,
+        total_cents INTEGER NOT NULL,
+        generated_at TEXT NOT NULL,
+        prev_hash TEXT NOT NULL,
+        hash TEXT NOT NULL
+    );""",
+    """CREATE TRIGGER IF NOT EXISTS invoice_register_no_update
+        BEFORE UPDATE ON invoice_register
+        BEGIN SELECT RAISE(ABORT, 'invoice_register is append-only'); END;""",
+    """CREATE TRIGGER IF NOT EXISTS invoice_register_no_delete
+        BEFORE DELETE ON invoice_register
+        BEGIN SELECT RAISE(ABORT, 'invoice_register is append-only'); END;""",
+    """CREATE TABLE IF NOT EXISTS register_head (
+        issuer_nif TEXT PRIMARY KEY,
+        last_seq INTEGER NOT NULL,
+        hash TEXT NOT NULL
+    );""",
+    # invoices billed every period; see app/recurring.py. items is a JSON list
+    # of {description, qty, unit_price, iva_rate}; runs counts billed periods.
+    """CREATE TABLE IF NOT EXISTS recurring_templates (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        client_id INTEGER NOT NULL,
+        issuer_id INTEGER NOT NULL DEFAULT 1,
+        items TEXT NOT NULL,
+        cadence TEXT NOT NULL,
+        start_date TEXT NOT NULL,
+        next_run TEXT NOT NULL,
+        runs INTEGER NOT NULL DEFAULT 0,
+        notes TEXT,
+        active INTEGER NOT NULL DEFAULT 1,
+        created_at TEXT NOT NULL,
+        last_run_at TEXT,
+        FOREIGN KEY(client_id) REFERENCES clients(id)
+    );""",
+    """CREATE TABLE IF NOT EXISTS register_checkpoints (
+        issuer_nif TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (issuer_nif, seq)
     );"""
 ]
 
 
-def get_conn(db_path: Optional[str] = None) -> sqlite3.Connection:
-    return sqlite3.connect(db_path or DB_NAME)
+# Created after migrations, so they may refer to columns added by ALTER TABLE
+INDEXES = [
+    # one client per normalized NIF; clients without NIF are not constrained
+    """CREATE UNIQUE INDEX IF NOT EXISTS ux_clients_nif_norm
+        ON clients(nif_norm) WHERE nif_norm IS NOT NULL;""",
+    "CREATE INDEX IF NOT EXISTS ix_items_invoice ON invoice_items(invoice_id);",
+    "CREATE INDEX IF NOT EXISTS ix_invoices_date_id ON invoices(date, id);",
+    "CREATE INDEX IF NOT EXISTS ix_invoices_client_date_id ON invoices(client_id, date, id);",
+    "CREATE INDEX IF NOT EXISTS ix_invoices_issuer_date_id ON invoices(issuer_id, date, id);",
+    "CREATE INDEX IF NOT EXISTS ix_outbox_due ON outbox(status, next_attempt_at);",
+    "CREATE INDEX IF NOT EXISTS ix_outbox_invoice ON outbox(invoice_id);",
+    "CREATE INDEX IF NOT EXISTS ix_render_jobs_due ON render_jobs(status, next_attempt_at);",
+    "CREATE INDEX IF NOT EXISTS ix_render_jobs_invoice ON render_jobs(invoice_id);",
+    "CREATE INDEX IF NOT EXISTS ix_recurring_due ON recurring_templates(next_run) WHERE active = 1;",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_register_issuer_seq ON invoice_register(issuer_nif, seq);",
+    "CREATE INDEX IF NOT EXISTS ix_register_invoice ON invoice_register(invoice_id);",
+]
+
+
+def get_conn(db_path: Optional[str] = None, timeout: float = 5.0) -> sqlite3.Connection:
+    """Open the main DB; every connection of the app should come from here (see repository.Connection)."""
+    return sqlite3.connect(db_path or DB_NAME, timeout=timeout, factory=Connection)
+
+def _columns(conn, table: str, schema: str = "main") -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")}
+
+def _migrate(conn) -> None:
+    cur = conn.cursor()
+    if "nif_norm" not in _columns(conn, "clients"):
+        cur.execute("ALTER TABLE clients ADD COLUMN nif_norm TEXT")
+        # Backfill; later duplicates keep nif_norm NULL so the unique index can be built
+        seen = set()
+        cur.execute("SELECT id, nif FROM clients ORDER BY id")
+        for cid, nif in cur.fetchall():
+            norm = normalize_nif(nif)
+            if norm and norm not in seen:
+                seen.add(norm)
+                conn.execute("UPDATE clients SET nif_norm = ? WHERE id = ?", (norm, cid))
+            elif norm:
+                print(f"Warning: client {cid} duplicates NIF {norm}; not indexed.")
+
+    # Integer cents next to the legacy REAL columns (which stay = cents / 100).
+    # Lines written before per-line rates existed were all at the global 21%.
+    if "total_cents" not in _columns(conn, "invoices"):
+        for col in ("base_cents", "iva_cents", "irpf_cents", "total_cents"):
+            cur.execute(f"ALTER TABLE invoices ADD COLUMN {col} INTEGER NOT NULL DEFAULT 0")
+        cur.execute("""
+            UPDATE invoices SET
+                base_cents = CAST(ROUND(base * 100) AS INTEGER),
+                iva_cents = CAST(ROUND(iva * 100) AS INTEGER),
+                irpf_cents = CAST(ROUND(irpf * 100) AS INTEGER),
+                total_cents = CAST(ROUND(total * 100) AS INTEGER)
+        """)
+    if "line_total_cents" not in _columns(conn, "invoice_items"):
+        cur.execute("ALTER TABLE invoice_items ADD COLUMN unit_price_cents INTEGER NOT NULL DEFAULT 0")
+        cur.execute("ALTER TABLE invoice_items ADD COLUMN line_total_cents INTEGER NOT NULL DEFAULT 0")
+        cur.execute(f"ALTER TABLE invoice_items ADD COLUMN iva_rate_bp INTEGER NOT NULL DEFAULT {rate_bp(IVA_RATE)}")
+        cur.execute("""
+            UPDATE invoice_items SET
+                unit_price_cents = CAST(ROUND(unit_price * 100) AS INTEGER),
+                line_total_cents = CAST(ROUND(line_total * 100) AS INTEGER)
+        """)
+
+    # Archives made before id ranges were recorded keep NULL (looked up by scanning)
+    if "min_id" not in _columns(conn, "archived_years"):
+        cur.execute("ALTER TABLE archived_years ADD COLUMN min_id INTEGER")
+        cur.execute("ALTER TABLE archived_years ADD COLUMN max_id INTEGER")
+
+    # Multi-issuer: everything that existed belongs to the issuer of settings.py
+    if cur.execute("SELECT 1 FROM issuers WHERE id = ?", (DEFAULT_ISSUER_ID,)).fetchone() is None:
+        cur.execute("""
+            INSERT INTO issuers (id, name, nif, address, iban, series, created_at) VALUES (?, ?, ?, ?, ?, '', ?)
+        """, (DEFAULT_ISSUER_ID, COMPANY_NAME, COMPANY_NIF, COMPANY_ADDRESS, COMPANY_IBAN,
+              datetime.now().isoformat(timespec="seconds")))
+    for table in ("invoices", "invoice_seq_skips", "recurring_templates"):
+        if "issuer_id" not in _columns(conn, table):
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN issuer_id INTEGER NOT NULL DEFAULT {DEFAULT_ISSUER_ID}")
+    if "issuer_id" not in _columns(conn, "invoice_seq"):
+        # the primary key changes from (year) to (issuer_id, year): rebuild
+        cur.execute("ALTER TABLE invoice_seq RENAME TO invoice_seq_old")
+        cur.execute(next(stmt for stmt in SCHEMA if "TABLE IF NOT EXISTS invoice_seq (" in stmt))
+        cur.execute(f"INSERT INTO invoice_seq (issuer_id, year, next_seq) SELECT {DEFAULT_ISSUER_ID}, year, next_seq FROM invoice_seq_old")
+        cur.execute("DROP TABLE invoice_seq_old")
 
 def init_db(conn: sqlite3.Connection) -> None:
     cur = conn.cursor()
     for stmt in SCHEMA:
         cur.execute(stmt)
+    _migrate(conn)
+    for stmt in INDEXES:
+        cur.execute(stmt)
     conn.commit()
 
 # --- Clients ---
+CLIENT_FIELDS = ("name", "nif", "address", "email", "phone")
+
+def _client_params(client: Dict[str, str]) -> Dict[str, str]:
+    params = {k: (client.get(k) or "").strip() for k in CLIENT_FIELDS}
+    params["nif_norm"] = normalize_nif(params["nif"]) or None
+    return params
+
 def new_client(conn, client: Dict[str, str]) -> int:
+    """Raises sqlite3.IntegrityError if another client has the same (normalized) NIF."""
     cur = conn.cursor()
     cur.execute(
-        """INSERT INTO clients (name, nif, address, email, phone)
-               VALUES (:name, :nif, :address, :email, :phone)""", client
+        """INSERT INTO clients (name, nif, address, email, phone, nif_norm)
+               VALUES (:name, :nif, :address, :email, :phone, :nif_norm)""", _client_params(client)
     )
     conn.commit()
+    client_repo(conn).invalidate()
     return cur.lastrowid
 
-def get_client(conn, client_id: int):
+def get_or_create_client_by_nif(conn, client: Dict[str, str]) -> int:
+    """
+    Returns the id of the client with this NIF, inserting `client` if there is none.
+    The NIF is required and must have a valid control character.
+    """
+    return get_or_create_clients_by_nif(conn, [client])[0]
+
+def get_or_create_clients_by_nif(conn, clients: List[Dict[str, str]], chunk: int = 500) -> List[int]:
+    """
+    Batched get_or_create_client_by_nif: one indexed IN (...) lookup per chunk,
+    inserts for the missing NIFs and a single commit. Returns ids in input order.
+    """
+    rows = [_client_params(c) for c in clients]
+    for params in rows:
+        if not params["nif_norm"] or not validate_nif(params["nif_norm"]):
+            raise ValueError(f"Invalid NIF/NIE/CIF: {params['nif']!r}")
+
+    wanted = list(dict.fromkeys(p["nif_norm"] for p in rows))
+    ids: Dict[str, int] = {}
     cur = conn.cursor()
-    cur.execute("SELECT id, name, nif, address, email, phone FROM clients WHERE id = ?", (client_id,))
-    return cur.fetchone()
+    for i in range(0, len(wanted), chunk):
+        part = wanted[i:i + chunk]
+        cur.execute(
+            f"SELECT nif_norm, id FROM clients WHERE nif_norm IN ({','.join('?' * len(part))})", part
+        )
+        ids.update(cur.fetchall())
+
+    try:
+        for params in rows:
+            if params["nif_norm"] not in ids:
+                cur.execute(
+                    """INSERT INTO clients (name, nif, address, email, phone, nif_norm)
+                           VALUES (:name, :nif, :address, :email, :phone, :nif_norm)""", params
+                )
+                ids[params["nif_norm"]] = cur.lastrowid
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        client_repo(conn).invalidate()
+    return [ids[p["nif_norm"]] for p in rows]
+
+def get_client(conn, client_id: int):
+    return client_repo(conn).get(client_id)
 
 def list_clients(conn) -> List[Tuple]:
+    return client_repo(conn).list_all()
+
+# --- Issuers ---
+ISSUER_FIELDS = ("name", "nif", "address", "iban", "series")
+
+def new_issuer(conn, issuer: Dict[str, str]) -> int:
+    """
+    Raises ValueError for an invalid NIF or series (up to 5 capital letters),
+    sqlite3.IntegrityError if the series is taken.
+    """
+    params = {k: (issuer.get(k) or "").strip() for k in ISSUER_FIELDS}
+    params["series"] = params["series"].upper()
+    if not validate_nif(params["nif"]):
+        raise ValueError(f"Invalid NIF: {params['nif']}")
+    if not SERIES_RE.match(params["series"]):
+        raise ValueError(f"Invalid series {params['series']!r}: up to 5 letters A-Z")
+    params["nif"] = normalize_nif(params["nif"])
+    params["created_at"] = datetime.now().isoformat(timespec="seconds")
     cur = conn.cursor()
-    cur.execute("SELECT id, name, nif, address, email, phone FROM clients ORDER BY id DESC")
-    return cur.fetchall()
+    cur.execute("""
+        INSERT INTO issuers (name, nif, address, iban, series, created_at)
+        VALUES (:name, :nif, :address, :iban, :series, :created_at)
+    """, params)
+    conn.commit()
+    return cur.lastrowid
+
+def update_issuer(conn, issuer_id: int, changes: Dict[str, str]) -> Tuple:
+    """
+    Change the given fields of an issuer and return the updated row. The NIF
+    and series of an issuer that already has invoices are fixed (they are in
+    its numbers and register chain). ValueError / LookupError as above,
+    sqlite3.IntegrityError if the new series is taken.
+    """
+    current = dict(zip(("id",) + ISSUER_FIELDS, get_issuer(conn, issuer_id)))
+    params = {k: (v or "").strip() for k, v in changes.items() if k in ISSUER_FIELDS and v is not None}
+    if "series" in params:
+        params["series"] = params["series"].upper()
+        if not SERIES_RE.match(params["series"]):
+            raise ValueError(f"Invalid series {params['series']!r}: up to 5 letters A-Z")
+    if "nif" in params:
+        if not validate_nif(params["nif"]):
+            raise ValueError(f"Invalid NIF: {params['nif']}")
+        params["nif"] = normalize_nif(params["nif"])
+    fixed = [k for k in ("nif", "series") if k in params and params[k] != current[k]]
+    if fixed and conn.execute("SELECT 1 FROM invoices WHERE issuer_id = ? LIMIT 1", (issuer_id,)).fetchone():
+        raise ValueError(f"Issuer {issuer_id} already has invoices; its {' and '.join(fixed)} cannot change.")
+    if params:
+        conn.execute(f"UPDATE issuers SET {', '.join(f'{k} = :{k}' for k in params)} WHERE id = :id",
+                     dict(params, id=issuer_id))
+        conn.commit()
+    return get_issuer(conn, issuer_id)
+
+def get_issuer(conn, issuer_id: int) -> Tuple:
+    """(id, name, nif, address, iban, series); LookupError if there is none."""
+    row = conn.execute("SELECT id, name, nif, address, iban, series FROM issuers WHERE id = ?", (issuer_id,)).fetchone()
+    if row is None:
+        raise LookupError(f"Issuer id {issuer_id} not found")
+    return row
+
+def list_issuers(conn) -> List[Tuple]:
+    return conn.execute("SELECT id, name, nif, address, iban, series FROM issuers ORDER BY id").fetchall()
+
+def invoice_issuer(inv) -> Tuple:
+    """Issuer row carried by a fetched invoice; settings.py for bare tuples."""
+    if len(inv) > 9:
+        return inv[9]
+    return (DEFAULT_ISSUER_ID, COMPANY_NAME, COMPANY_NIF, COMPANY_ADDRESS, COMPANY_IBAN, "")
 
 # --- Invoice numbering ---
 def _last_suffix_for_year(conn, year: str) -> int:
@@ -86,9 +424,9 @@ def _last_suffix_for_year(conn, year: str) -> int:
     except Exception:
         return 0
 
-def next_invoice_number(conn, date_str: str | None = None) -> str:
+def next_invoice_number(conn, date_str: str | None = None, issuer_id: int = DEFAULT_ISSUER_ID) -> str:
     """
-    Returns the next invoice number 'YYYY-NNNN'.
+    Returns the issuer's next invoice number '[series]YYYY-NNNN'.
     - If date_str is given (e.g. '2025-09-24'), use that year; else use today's year.
     - Sequence is max(DB max for year + 1, invoice_seq.next_seq).
     """
@@ -100,100 +438,240 @@ def next_invoice_number(conn, date_str: str | None = None) -> str:
     else:
         year = int(datetime.today().strftime("%Y"))
 
+    series = get_issuer(conn, issuer_id)[5]
     cur = conn.cursor()
 
-    # Highest existing seq in invoices for that year
+    # Highest existing seq in the issuer's invoices for that year
     cur.execute("""
         SELECT number FROM invoices
-        WHERE number LIKE ?
+        WHERE issuer_id = ? AND number LIKE ?
         ORDER BY number DESC
         LIMIT 1
-    """, (f"{year}-%",))
+    """, (issuer_id, f"{series}{year}-%"))
     row = cur.fetchone()
     db_next = 1
     if row:
         try:
-            # parse 'YYYY-NNNN'
-            db_next = int(row[0].split("-", 1)[1]) + 1
+            db_next = _seq_from_number(row[0]) + 1
         except Exception:
             db_next = 1
 
     # Stored next_seq in invoice_seq (if any)
-    cur.execute("SELECT next_seq FROM invoice_seq WHERE year = ?", (year,))
+    cur.execute("SELECT next_seq FROM invoice_seq WHERE issuer_id = ? AND year = ?", (issuer_id, year))
     row = cur.fetchone()
     stored_next = row[0] if row else 1
 
     seq = max(db_next, stored_next)
-    return f"{year}-{seq:04d}"
+    return _compose_number(year, seq, series)
 
 
 # --- Invoices ---
-def insert_invoice(conn, number: str, date: str, client_id: int, base: float, iva: float, irpf: float, total: float, notes: str) -> int:
-    cur = conn.cursor()
+# The _write_* helpers only execute; callers decide when to commit
+# (see app/service.py for the single-transaction save).
+def _write_invoice(cur, number: str, date: str, client_id: int, cents, notes: str,
+                   issuer_id: int = DEFAULT_ISSUER_ID) -> int:
+    """cents: (base, iva, irpf, total) in integer cents. Also appends the register record."""
+    cur.execute("SELECT nif FROM issuers WHERE id = ?", (issuer_id,))
+    row = cur.fetchone()
+    if row is None:
+        raise ValueError(f"Issuer id {issuer_id} not found.")
     cur.execute(
-        """INSERT INTO invoices (number, date, client_id, base, iva, irpf, total, notes)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-        (number, date, client_id, base, iva, irpf, total, notes)
+        """INSERT INTO invoices (number, date, client_id, base, iva, irpf, total, notes,
+                                 base_cents, iva_cents, irpf_cents, total_cents, issuer_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (number, date, client_id, *(c / 100 for c in cents), notes, *cents, issuer_id)
     )
-    conn.commit()
-    return cur.lastrowid
+    invoice_id = cur.lastrowid
+    # after the INSERT, so the write lock is held while the chain head is read
+    append_record(cur, invoice_id, number, date, cents[1], cents[0] + cents[1], row[0])
+    return invoice_id
 
-def insert_item(conn, invoice_id: int, description: str, qty: float, unit_price: float) -> int:
-    line_total = round(qty * unit_price, 2)
-    cur = conn.cursor()
+def _item_row(invoice_id: int, description: str, qty: float, unit_price: float, iva_rate: float) -> tuple:
+    line_cents = line_total_cents(qty, unit_price)
+    price_cents = to_cents(unit_price)
+    return (invoice_id, description, qty, price_cents / 100, line_cents / 100,
+            price_cents, line_cents, rate_bp(iva_rate))
+
+_INSERT_ITEM = """INSERT INTO invoice_items (invoice_id, description, qty, unit_price, line_total,
+                                             unit_price_cents, line_total_cents, iva_rate_bp)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+def _write_items(cur, invoice_id: int, items) -> None:
+    """items: (description, qty, unit_price[, line_total[, iva_rate]]), one executemany."""
+    cur.executemany(_INSERT_ITEM, [
+        _item_row(invoice_id, it[0], it[1], it[2], it[4] if len(it) > 4 else IVA_RATE) for it in items
+    ])
+
+def _write_render_job(cur, invoice_id: int) -> int:
+    now = datetime.now().isoformat(timespec="seconds")
     cur.execute(
-        """INSERT INTO invoice_items (invoice_id, description, qty, unit_price, line_total)
-            VALUES (?, ?, ?, ?, ?)""", (invoice_id, description, qty, unit_price, line_total)
+        "INSERT INTO render_jobs (invoice_id, next_attempt_at, created_at) VALUES (?, ?, ?)",
+        (invoice_id, now, now)
     )
+    return cur.lastrowid
+
+def insert_invoice(conn, number: str, date: str, client_id: int, base: float, iva: float, irpf: float, total: float, notes: str,
+                   issuer_id: int = DEFAULT_ISSUER_ID) -> int:
+    cur = conn.cursor()
+    invoice_id = _write_invoice(cur, number, date, client_id, [to_cents(x) for x in (base, iva, irpf, total)], notes, issuer_id)
+    conn.commit()
+    return invoice_id
+
+def insert_item(conn, invoice_id: int, description: str, qty: float, unit_price: float, iva_rate: float = IVA_RATE) -> int:
+    cur = conn.cursor()
+    cur.execute(_INSERT_ITEM, _item_row(invoice_id, description, qty, unit_price, iva_rate))
     conn.commit()
     return cur.lastrowid
 
-def fetch_invoice_full(conn, invoice_id: int):
+def _fetch_invoice_from(conn, schema: str, invoice_id: int):
     cur = conn.cursor()
-    cur.execute("SELECT id, number, date, client_id, base, iva, irpf, total, notes FROM invoices WHERE id = ?", (invoice_id,))
+    # archives written before multi-issuer have no issuer_id
+    issuer = "issuer_id" if "issuer_id" in _columns(conn, "invoices", schema) else DEFAULT_ISSUER_ID
+    cur.execute(f"SELECT id, number, date, client_id, base, iva, irpf, total, notes, {issuer} FROM {schema}.invoices WHERE id = ?", (invoice_id,))
     inv = cur.fetchone()
-    cur.execute("SELECT description, qty, unit_price, line_total FROM invoice_items WHERE invoice_id = ?", (invoice_id,))
-    items = cur.fetchall()
-    cur.execute("SELECT id, name, nif, address, email, phone FROM clients WHERE id = ?", (inv[3],))
-    client = cur.fetchone()
-    return inv, items, client
+    if inv is None:
+        return None, []
+    inv = inv[:9] + (get_issuer(conn, inv[9]),)
+    # archives written before per-line rates existed have no iva_rate_bp
+    rate = "iva_rate_bp" if "iva_rate_bp" in _columns(conn, "invoice_items", schema) else rate_bp(IVA_RATE)
+    cur.execute(f"SELECT description, qty, unit_price, line_total, {rate} * 1.0 / {BP_SCALE} FROM {schema}.invoice_items WHERE invoice_id = ? ORDER BY id", (invoice_id,))
+    return inv, cur.fetchall()
+
+def fetch_invoice_full(conn, invoice_id: int):
+    """
+    Returns (inv, items, client); inv is (id, number, date, client_id, base,
+    iva, irpf, total, notes, issuer) with the issuer row of get_issuer, items
+    are (description, qty, unit_price, line_total, iva_rate). Invoices of
+    archived years are read from their (read-only attached) archive
+    database transparently.
+    """
+    inv, items = _fetch_invoice_from(conn, "main", invoice_id)
+    if inv is None:
+        alias = find_archived_invoice(conn, invoice_id=invoice_id)
+        if alias is None:
+            raise LookupError(f"Invoice id {invoice_id} not found")
+        inv, items = _fetch_invoice_from(conn, alias, invoice_id)
+    return inv, items, get_client(conn, inv[3])
+
+def fetch_invoice_by_number(conn, number: str):
+    """Same as fetch_invoice_full, looked up by invoice number."""
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM invoices WHERE number = ?", (number,))
+    row = cur.fetchone()
+    if row is None:
+        alias = find_archived_invoice(conn, number=number)
+        if alias is None:
+            raise LookupError(f"Invoice {number} not found")
+        cur.execute(f"SELECT id FROM {alias}.invoices WHERE number = ?", (number,))
+        inv, items = _fetch_invoice_from(conn, alias, cur.fetchone()[0])
+        return inv, items, get_client(conn, inv[3])
+    return fetch_invoice_full(conn, row[0])
+
+def iter_invoices_page(conn, after_key: Optional[Tuple[str, int]] = None, limit: int = 50,
+                       client_id: Optional[int] = None, date_from: Optional[str] = None,
+                       date_to: Optional[str] = None, issuer_id: Optional[int] = None):
+    """
+    One page of invoices, newest first: returns (rows, next_key) with rows
+    (id, number, date, client_id, client_name, total). Pass next_key back as
+    after_key for the next page; it is None after the last one. Keyset
+    pagination on (date, id), so every page is an index range scan.
+    """
+    where, params = [], []
+    if after_key:
+        where.append("(i.date, i.id) < (?, ?)")
+        params += [after_key[0], after_key[1]]
+    if client_id is not None:
+        where.append("i.client_id = ?")
+        params.append(client_id)
+    if issuer_id is not None:
+        where.append("i.issuer_id = ?")
+        params.append(issuer_id)
+    if date_from:
+        where.append("i.date >= ?")
+        params.append(date_from)
+    if date_to:
+        where.append("i.date <= ?")
+        params.append(date_to)
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT i.id, i.number, i.date, i.client_id, c.name, i.total
+        FROM invoices i LEFT JOIN clients c ON c.id = i.client_id
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY i.date DESC, i.id DESC
+        LIMIT ?
+    """, params + [limit + 1])
+    rows = cur.fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, (rows[-1][2], rows[-1][0])
+    return rows, None
 
 # ⬇️ Add these helpers (anywhere in db.py)
+def _split_number(inv_number: str) -> Tuple[str, int, int]:
+    # expects "[series]YYYY-NNNN"
+    m = NUMBER_RE.match(inv_number)
+    if not m:
+        raise ValueError(f"Not a [series]YYYY-NNNN number: {inv_number!r}")
+    return m.group(1), int(m.group(2)), int(m.group(3))
+
 def _year_from_number(inv_number: str) -> int:
-    # expects "YYYY-NNNN"
-    return int(inv_number.split("-", 1)[0])
+    return _split_number(inv_number)[1]
 
 def _seq_from_number(inv_number: str) -> int:
-    return int(inv_number.split("-", 1)[1])
+    return _split_number(inv_number)[2]
 
-def _compose_number(year: int, seq: int) -> str:
-    return f"{year}-{seq:04d}"
+def _compose_number(year: int, seq: int, series: str = "") -> str:
+    return f"{series}{year}-{seq:04d}"
 
-def forward_invoice_number(conn, target_number: str) -> None:
+def forward_invoice_number(conn, target_number: str, issuer_id: Optional[int] = None) -> None:
     """
     Force the NEXT invoice number >= target_number for its year.
     Example: forward_invoice_number(conn, "2025-0031")
+    The issuer defaults to the one whose series prefixes target_number.
     """
-    year = _year_from_number(target_number)
-    target_seq = _seq_from_number(target_number)
+    series, year, target_seq = _split_number(target_number)
+    if issuer_id is None:
+        row = conn.execute("SELECT id FROM issuers WHERE series = ?", (series,)).fetchone()
+        if row is None:
+            raise ValueError(f"No issuer uses the series {series!r}")
+        issuer_id = row[0]
+    current_seq = _seq_from_number(next_invoice_number(conn, f"{year}-01-01", issuer_id))
     cur = conn.cursor()
-    # Upsert the invoice_seq row for that year
+    if target_seq > current_seq:
+        # remember the skipped range so the audit does not report it as a gap
+        cur.execute(
+            "INSERT INTO invoice_seq_skips (issuer_id, year, from_seq, to_seq, created_at) VALUES (?, ?, ?, ?, ?)",
+            (issuer_id, year, current_seq, target_seq - 1, datetime.now().isoformat(timespec="seconds"))
+        )
+    # Upsert the invoice_seq row for that issuer and year
     cur.execute("""
-        INSERT INTO invoice_seq(year, next_seq) VALUES(?, ?)
-        ON CONFLICT(year) DO UPDATE SET next_seq = MAX(next_seq, excluded.next_seq)
-    """, (year, target_seq))
+        INSERT INTO invoice_seq(issuer_id, year, next_seq) VALUES(?, ?, ?)
+        ON CONFLICT(issuer_id, year) DO UPDATE SET next_seq = MAX(next_seq, excluded.next_seq)
+    """, (issuer_id, year, target_seq))
     conn.commit()
 
-def mark_invoice_used(conn, inv_number: str) -> None:
+def _write_seq_used(cur, inv_number: str, issuer_id: int = DEFAULT_ISSUER_ID) -> None:
     """
-    After inserting an invoice row, call this to bump invoice_seq to seq+1.
+    Bump the issuer's invoice_seq past `inv_number`; non '[series]YYYY-NNNN'
+    numbers and numbers of another issuer's series are left alone.
     """
-    year = _year_from_number(inv_number)
-    seq = _seq_from_number(inv_number) + 1
-    cur = conn.cursor()
+    if not NUMBER_RE.match(inv_number):
+        return
+    series, year, seq = _split_number(inv_number)
+    cur.execute("SELECT series FROM issuers WHERE id = ?", (issuer_id,))
+    row = cur.fetchone()
+    if row is None or row[0] != series:
+        return
+    seq += 1
     cur.execute("""
-        INSERT INTO invoice_seq(year, next_seq) VALUES(?, ?)
-        ON CONFLICT(year) DO UPDATE SET next_seq = MAX(next_seq, excluded.next_seq)
-    """, (year, seq))
+        INSERT INTO invoice_seq(issuer_id, year, next_seq) VALUES(?, ?, ?)
+        ON CONFLICT(issuer_id, year) DO UPDATE SET next_seq = MAX(next_seq, excluded.next_seq)
+    """, (issuer_id, year, seq))
+
+def mark_invoice_used(conn, inv_number: str, issuer_id: int = DEFAULT_ISSUER_ID) -> None:
+    """
+    After inserting an invoice row, call this to bump invoice_seq to seq+1.
+    """
+    _write_seq_used(conn.cursor(), inv_number, issuer_id)
     conn.commit()
 
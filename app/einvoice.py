@@ -0,0 +1,410 @@
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+from xml.sax.saxutils import XMLGenerator
+
+from .db import fetch_invoice_full, get_conn, invoice_issuer
+from .settings import CURRENCY, IVA_RATE, IRPF_RATE, OUTPUT_DIR
+from .totals import compute_totals, line_total_cents, rate_bp, tax_cents, to_cents
+from .utils import normalize_nif, split_address_lines
+
+# Electronic invoices written with a streaming XML writer: elements go to
+# the output as they are produced, nothing is kept as a DOM tree.
+# The files are unsigned; FACe also requires a XAdES signature on Facturae.
+
+FACTURAE_NS = "http://www.facturae.gob.es/formato/Versiones/Facturaev3_2_2.xml"
+DS_NS = "http://www.w3.org/2000/09/xmldsig#"
+UBL_NS = "urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
+CAC_NS = "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+CBC_NS = "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2"
+
+FORMATS = ("facturae", "ubl")
+
+
+class _Writer:
+    """Thin wrapper over XMLGenerator: start/end/leaf, with indentation."""
+
+    def __init__(self, out, encoding: str = "UTF-8"):
+        self.gen = XMLGenerator(out, encoding=encoding, short_empty_elements=True)
+        self.depth = 0
+
+    def start_document(self):
+        self.gen.startDocument()
+
+    def end_document(self):
+        self.gen.ignorableWhitespace("\n")
+        self.gen.endDocument()
+
+    def start(self, name: str, attrs: Optional[dict] = None):
+        if self.depth:
+            self.gen.ignorableWhitespace("\n" + "  " * self.depth)
+        self.gen.startElement(name, attrs or {})
+        self.depth += 1
+
+    def end(self, name: str):
+        self.depth -= 1
+        self.gen.ignorableWhitespace("\n" + "  " * self.depth)
+        self.gen.endElement(name)
+
+    def leaf(self, name: str, text, attrs: Optional[dict] = None):
+        self.gen.ignorableWhitespace("\n" + "  " * self.depth)
+        self.gen.startElement(name, attrs or {})
+        self.gen.characters(str(text))
+        self.gen.endElement(name)
+
+
+def _amount(cents: int) -> str:
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+
+def _quantity(qty) -> str:
+    """Fixed point with the (up to) three decimals totals.py keeps: 1000000, 2.5, 0.125."""
+    text = f"{float(qty):.3f}".rstrip("0").rstrip(".")
+    return "0" if text in ("", "-0") else text
+
+
+def _rate(bp: int) -> str:
+    return f"{bp / 100:.2f}"
+
+
+def _is_person(nif: str) -> bool:
+    """DNI/NIE holders are individuals (F); CIFs are legal entities (J)."""
+    return bool(nif) and (nif[0].isdigit() or nif[0] in "XYZKLM")
+
+
+def _address_parts(address: str) -> Tuple[str, str, str, str]:
+    """(street, postcode, town, province) from a free-form Spanish address."""
+    l1, l2, l3 = split_address_lines(address or "")
+    m = re.search(r"\b(\d{5})\b", l2)
+    postcode = m.group(1) if m else ""
+    town = re.sub(r"\b\d{5}\b", "", l2).strip(" ,") or l3
+    province = re.sub(r",?\s*(Espanya|España|Spain)\s*$", "", l3, flags=re.I).strip(" ,")
+    if not province and " " in town:
+        # '08328 Alella Park Barcelona' + 'Espanya': the province is the last word
+        town, province = town.rsplit(" ", 1)
+    return l1, postcode, town, province or town
+
+
+def _split_name(name: str) -> Tuple[str, str, str]:
+    parts = (name or "").split()
+    if len(parts) >= 3:
+        return " ".join(parts[:-2]), parts[-2], parts[-1]
+    if len(parts) == 2:
+        return parts[0], parts[1], ""
+    return name or "", "", ""
+
+
+def _tax_breakdown(items) -> Tuple[Tuple[int, int, int], ...]:
+    return compute_totals(items).iva_by_rate
+
+
+# --- Facturae 3.2.2 ---
+def _facturae_party(w: _Writer, tag: str, name: str, nif: str, address: str):
+    nif = normalize_nif(nif)
+    street, postcode, town, province = _address_parts(address)
+    w.start(tag)
+    w.start("TaxIdentification")
+    w.leaf("PersonTypeCode", "F" if _is_person(nif) else "J")
+    w.leaf("ResidenceTypeCode", "R")
+    w.leaf("TaxIdentificationNumber", nif)
+    w.end("TaxIdentification")
+    if _is_person(nif):
+        first, surname1, surname2 = _split_name(name)
+        w.start("Individual")
+        w.leaf("Name", first)
+        w.leaf("FirstSurname", surname1)
+        if surname2:
+            w.leaf("SecondSurname", surname2)
+    else:
+        w.start("LegalEntity")
+        w.leaf("CorporateName", name)
+    w.start("AddressInSpain")
+    w.leaf("Address", street)
+    w.leaf("PostCode", postcode)
+    w.leaf("Town", town)
+    w.leaf("Province", province)
+    w.leaf("CountryCode", "ESP")
+    w.end("AddressInSpain")
+    w.end("Individual" if _is_person(nif) else "LegalEntity")
+    w.end(tag)
+
+
+def _facturae_tax(w: _Writer, code: str, bp: int, base: int, amount: int):
+    w.start("Tax")
+    w.leaf("TaxTypeCode", code)
+    w.leaf("TaxRate", _rate(bp))
+    w.start("TaxableBase")
+    w.leaf("TotalAmount", _amount(base))
+    w.end("TaxableBase")
+    w.start("TaxAmount")
+    w.leaf("TotalAmount", _amount(amount))
+    w.end("TaxAmount")
+    w.end("Tax")
+
+
+def write_facturae(out, inv, items, client) -> None:
+    """
+    Stream a Facturae 3.2.2 document for one invoice to the binary stream
+    `out`. inv/items/client are the rows of db.fetch_invoice_full.
+    """
+    base, iva, irpf, total = (to_cents(x) for x in (inv[4], inv[5], inv[6], inv[7]))
+    _, issuer_name, issuer_nif, issuer_address, issuer_iban, _ = invoice_issuer(inv)
+    irpf_bp = rate_bp(IRPF_RATE)
+    w = _Writer(out)
+    w.start_document()
+    w.start("fe:Facturae", {"xmlns:fe": FACTURAE_NS, "xmlns:ds": DS_NS})
+
+    w.start("FileHeader")
+    w.leaf("SchemaVersion", "3.2.2")
+    w.leaf("Modality", "I")
+    w.leaf("InvoiceIssuerType", "EM")
+    w.start("Batch")
+    w.leaf("BatchIdentifier", f"{normalize_nif(issuer_nif)}{inv[1]}")
+    w.leaf("InvoicesCount", 1)
+    for tag in ("TotalInvoicesAmount", "TotalOutstandingAmount", "TotalExecutableAmount"):
+        w.start(tag)
+        w.leaf("TotalAmount", _amount(total))
+        w.end(tag)
+    w.leaf("InvoiceCurrencyCode", CURRENCY)
+    w.end("Batch")
+    w.end("FileHeader")
+
+    w.start("Parties")
+    _facturae_party(w, "SellerParty", issuer_name, issuer_nif, issuer_address)
+    _facturae_party(w, "BuyerParty", client[1], client[2], client[3])
+    w.end("Parties")
+
+    w.start("Invoices")
+    w.start("Invoice")
+    w.start("InvoiceHeader")
+    w.leaf("InvoiceNumber", inv[1])
+    w.leaf("InvoiceDocumentType", "FC")
+    w.leaf("InvoiceClass", "OO")
+    w.end("InvoiceHeader")
+    w.start("InvoiceIssueData")
+    w.leaf("IssueDate", inv[2])
+    w.leaf("InvoiceCurrencyCode", CURRENCY)
+    w.leaf("TaxCurrencyCode", CURRENCY)
+    w.leaf("LanguageName", "ca")
+    w.end("InvoiceIssueData")
+
+    w.start("TaxesOutputs")
+    for bp, rate_base, rate_iva in _tax_breakdown(items):
+        _facturae_tax(w, "01", bp, rate_base, rate_iva)
+    w.end("TaxesOutputs")
+    if irpf:
+        w.start("TaxesWithheld")
+        _facturae_tax(w, "04", irpf_bp, base, irpf)
+        w.end("TaxesWithheld")
+
+    w.start("InvoiceTotals")
+    w.leaf("TotalGrossAmount", _amount(base))
+    w.leaf("TotalGrossAmountBeforeTaxes", _amount(base))
+    w.leaf("TotalTaxOutputs", _amount(iva))
+    w.leaf("TotalTaxesWithheld", _amount(irpf))
+    w.leaf("InvoiceTotal", _amount(total))
+    w.leaf("TotalOutstandingAmount", _amount(total))
+    w.leaf("TotalExecutableAmount", _amount(total))
+    w.end("InvoiceTotals")
+
+    w.start("Items")
+    for desc, qty, unit_price, line_total, *rest in items:
+        bp = rate_bp(rest[0] if rest else IVA_RATE)
+        cents = line_total_cents(qty, unit_price)
+        w.start("InvoiceLine")
+        w.leaf("ItemDescription", desc)
+        w.leaf("Quantity", _quantity(qty))
+        w.leaf("UnitOfMeasure", "01")
+        w.leaf("UnitPriceWithoutTax", f"{unit_price:.6f}")
+        w.leaf("TotalCost", _amount(cents))
+        w.leaf("GrossAmount", _amount(cents))
+        w.start("TaxesOutputs")
+        _facturae_tax(w, "01", bp, cents, tax_cents(cents, bp))
+        w.end("TaxesOutputs")
+        w.end("InvoiceLine")
+    w.end("Items")
+
+    if issuer_iban:
+        w.start("PaymentDetails")
+        w.start("Installment")
+        w.leaf("InstallmentDueDate", inv[2])
+        w.leaf("InstallmentAmount", _amount(total))
+        w.leaf("PaymentMeans", "04")  # transfer
+        w.start("AccountToBeCredited")
+        w.leaf("IBAN", issuer_iban.replace(" ", ""))
+        w.end("AccountToBeCredited")
+        w.end("Installment")
+        w.end("PaymentDetails")
+
+    if inv[8]:
+        w.start("AdditionalData")
+        w.leaf("InvoiceAdditionalInformation", inv[8])
+        w.end("AdditionalData")
+
+    w.end("Invoice")
+    w.end("Invoices")
+    w.end("fe:Facturae")
+    w.end_document()
+
+
+# --- UBL 2.1 (EN 16931) ---
+def _ubl_party(w: _Writer, tag: str, name: str, nif: str, address: str):
+    street, postcode, town, _ = _address_parts(address)
+    w.start(tag)
+    w.start("cac:Party")
+    w.start("cac:PostalAddress")
+    w.leaf("cbc:StreetName", street)
+    w.leaf("cbc:CityName", town)
+    w.leaf("cbc:PostalZone", postcode)
+    w.start("cac:Country")
+    w.leaf("cbc:IdentificationCode", "ES")
+    w.end("cac:Country")
+    w.end("cac:PostalAddress")
+    w.start("cac:PartyTaxScheme")
+    w.leaf("cbc:CompanyID", "ES" + normalize_nif(nif))
+    w.start("cac:TaxScheme")
+    w.leaf("cbc:ID", "VAT")
+    w.end("cac:TaxScheme")
+    w.end("cac:PartyTaxScheme")
+    w.start("cac:PartyLegalEntity")
+    w.leaf("cbc:RegistrationName", name)
+    w.end("cac:PartyLegalEntity")
+    w.end("cac:Party")
+    w.end(tag)
+
+
+def _ubl_category(w: _Writer, tag: str, bp: int):
+    w.start(tag)
+    w.leaf("cbc:ID", "S" if bp else "E")
+    w.leaf("cbc:Percent", _rate(bp))
+    w.start("cac:TaxScheme")
+    w.leaf("cbc:ID", "VAT")
+    w.end("cac:TaxScheme")
+    w.end(tag)
+
+
+def write_ubl(out, inv, items, client) -> None:
+    """Stream a UBL 2.1 Invoice for one invoice to the binary stream `out`."""
+    base, iva, irpf, total = (to_cents(x) for x in (inv[4], inv[5], inv[6], inv[7]))
+    cur = {"currencyID": CURRENCY}
+    _, issuer_name, issuer_nif, issuer_address, issuer_iban, _ = invoice_issuer(inv)
+    w = _Writer(out)
+    w.start_document()
+    w.start("Invoice", {"xmlns": UBL_NS, "xmlns:cac": CAC_NS, "xmlns:cbc": CBC_NS})
+    w.leaf("cbc:CustomizationID", "urn:cen.eu:en16931:2017")
+    w.leaf("cbc:ID", inv[1])
+    w.leaf("cbc:IssueDate", inv[2])
+    w.leaf("cbc:InvoiceTypeCode", "380")
+    if inv[8]:
+        w.leaf("cbc:Note", inv[8])
+    w.leaf("cbc:DocumentCurrencyCode", CURRENCY)
+    _ubl_party(w, "cac:AccountingSupplierParty", issuer_name, issuer_nif, issuer_address)
+    _ubl_party(w, "cac:AccountingCustomerParty", client[1], client[2], client[3])
+
+    if issuer_iban:
+        w.start("cac:PaymentMeans")
+        w.leaf("cbc:PaymentMeansCode", "30")  # credit transfer
+        w.start("cac:PayeeFinancialAccount")
+        w.leaf("cbc:ID", issuer_iban.replace(" ", ""))
+        w.end("cac:PayeeFinancialAccount")
+        w.end("cac:PaymentMeans")
+
+    w.start("cac:TaxTotal")
+    w.leaf("cbc:TaxAmount", _amount(iva), cur)
+    for bp, rate_base, rate_iva in _tax_breakdown(items):
+        w.start("cac:TaxSubtotal")
+        w.leaf("cbc:TaxableAmount", _amount(rate_base), cur)
+        w.leaf("cbc:TaxAmount", _amount(rate_iva), cur)
+        _ubl_category(w, "cac:TaxCategory", bp)
+        w.end("cac:TaxSubtotal")
+    w.end("cac:TaxTotal")
+
+    # EN 16931 has no withholding; IRPF goes in PrepaidAmount so that
+    # PayableAmount is what the client actually transfers.
+    w.start("cac:LegalMonetaryTotal")
+    w.leaf("cbc:LineExtensionAmount", _amount(base), cur)
+    w.leaf("cbc:TaxExclusiveAmount", _amount(base), cur)
+    w.leaf("cbc:TaxInclusiveAmount", _amount(base + iva), cur)
+    w.leaf("cbc:PrepaidAmount", _amount(irpf), cur)
+    w.leaf("cbc:PayableAmount", _amount(total), cur)
+    w.end("cac:LegalMonetaryTotal")
+
+    for n, (desc, qty, unit_price, line_total, *rest) in enumerate(items, 1):
+        bp = rate_bp(rest[0] if rest else IVA_RATE)
+        w.start("cac:InvoiceLine")
+        w.leaf("cbc:ID", n)
+        w.leaf("cbc:InvoicedQuantity", _quantity(qty), {"unitCode": "C62"})
+        w.leaf("cbc:LineExtensionAmount", _amount(line_total_cents(qty, unit_price)), cur)
+        w.start("cac:Item")
+        w.leaf("cbc:Name", desc)
+        _ubl_category(w, "cac:ClassifiedTaxCategory", bp)
+        w.end("cac:Item")
+        w.start("cac:Price")
+        w.leaf("cbc:PriceAmount", f"{unit_price:.2f}", cur)
+        w.end("cac:Price")
+        w.end("cac:InvoiceLine")
+
+    w.end("Invoice")
+    w.end_document()
+
+
+# --- Files and batches ---
+def _xml_path(folder: str, number: str, fmt: str) -> str:
+    return os.path.join(folder, f"invoice_{number}.{fmt}.xml")
+
+
+def export_einvoice(conn, invoice_id: int, folder: str = OUTPUT_DIR, fmt: str = "facturae") -> str:
+    """Write invoice_<number>.<fmt>.xml atomically; returns the path."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown e-invoice format {fmt!r} (use {', '.join(FORMATS)})")
+    inv, items, client = fetch_invoice_full(conn, invoice_id)
+    os.makedirs(folder, exist_ok=True)
+    path = _xml_path(folder, inv[1], fmt)
+    # unique temp name: two exports of the same invoice must not share it
+    fd, tmp = tempfile.mkstemp(prefix=f".invoice_{inv[1]}.", suffix=".tmp", dir=folder)
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            (write_facturae if fmt == "facturae" else write_ubl)(fh, inv, items, client)
+        os.chmod(tmp, 0o644)  # mkstemp creates 0600
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return path
+
+
+_worker_conn = None
+
+
+def _worker_init(db_path: str):
+    global _worker_conn
+    _worker_conn = get_conn(db_path)
+
+
+def _worker_export(args):
+    invoice_id, folder, fmt = args
+    try:
+        return invoice_id, export_einvoice(_worker_conn, invoice_id, folder, fmt), None
+    except Exception as e:
+        return invoice_id, None, f"{type(e).__name__}: {e}"
+
+
+def export_batch(db_path: str, invoice_ids: Iterable[int], folder: str = OUTPUT_DIR,
+                 fmt: str = "facturae", workers: Optional[int] = None) -> List[tuple]:
+    """
+    Export many invoices in parallel worker processes (one connection each).
+    Returns [(invoice_id, path or None, error or None)].
+    """
+    ids = list(invoice_ids)
+    if not ids:
+        return []
+    jobs = [(i, folder, fmt) for i in ids]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_worker_init, initargs=(db_path,)) as pool:
+        chunk = max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 4))
+        return list(pool.map(_worker_export, jobs, chunksize=chunk))
@@ -1,14 +1,17 @@
 import re
 from datetime import datetime, date
 
-from .db import next_invoice_number, insert_invoice, insert_item, fetch_invoice_full, mark_invoice_used
-from .settings import IVA_RATE, IRPF_RATE
+from .db import list_issuers
+from .service import InvoiceDraft, InvoiceService
+from .settings import IVA_RATE
+from .totals import check_iva_rate, line_total_cents, to_euros
 from .utils import to_money
-from . import pdf
+from .render_worker import drain_in_background, wait_for_job
 
 def _input_items():
+    """Returns [(description, qty, unit_price, line_total, iva_rate)]."""
     items = []
-    total = 0.0
+    total_cents = 0
     print("Add line items. Type 'done' as description to finish.")
     while True:
         desc = input("  Description: ").strip()
@@ -20,10 +23,16 @@ def _input_items():
         except ValueError:
             print("  Invalid number, try again.")
             continue
-        line_total = qty * price
-        items.append((desc, qty, price, line_total))
-        total += line_total
-        print(f"  Subtotal: {to_money(total)}")
+        raw_rate = input(f"  IVA % [{IVA_RATE * 100:g}]: ").strip()
+        try:
+            iva_rate = check_iva_rate(raw_rate) if raw_rate else IVA_RATE
+        except (ValueError, ArithmeticError):
+            print(f"  Invalid IVA rate, using {IVA_RATE * 100:g}%.")
+            iva_rate = IVA_RATE
+        line_cents = line_total_cents(qty, price)
+        items.append((desc, qty, price, to_euros(line_cents), iva_rate))
+        total_cents += line_cents
+        print(f"  Subtotal: {to_money(to_euros(total_cents))}")
     return items
 
 # Accepts 'DD MM YY', 'DD/MM/YYYY', 'YYYY-MM-DD', etc.
@@ -53,6 +62,7 @@ def create_invoice_interactive(
     notes: str = "",
     invoice_date: str | None = None,     # NEW (optional)
     override_number: str | None = None,  # NEW (optional)
+    issuer_id: int | None = None,        # default: ask when there is more than one
 ) -> int:
     # 1) Pick/parse the invoice date
     if invoice_date is None:
@@ -62,41 +72,53 @@ def create_invoice_interactive(
     else:
         date_iso = _parse_invoice_date_str(invoice_date)
 
-    # 2) Pick/compute the invoice number
-    if override_number:
-        number = override_number
-        if not re.match(r"^\d{4}-\d{4}$", number):
-            print("⚠️ Número de factura esperat com 'YYYY-NNNN' (ex: 2025-0031). Continuo igualment…")
-    else:
-        # your existing signature expects (conn, date_iso)
-        number = next_invoice_number(conn, date_iso)
+    # 2) Override number (otherwise allocated on save for the date's year)
+    number = override_number or None
+    if number and not re.match(r"^[A-Z]*\d{4}-\d{4}$", number):
+        print("⚠️ Número de factura esperat com '[sèrie]YYYY-NNNN' (ex: 2025-0031). Continuo igualment…")
+
+    # 2b) Issuer
+    if issuer_id is None:
+        issuers = list_issuers(conn)
+        issuer_id = issuers[0][0]
+        if len(issuers) > 1:
+            for iid, name, nif, *_ in issuers:
+                print(f"  {iid} - {name} ({nif})")
+            raw = input(f"Issuer id [{issuer_id}]: ").strip()
+            if raw:
+                if not raw.isdigit() or int(raw) not in {i[0] for i in issuers}:
+                    print("Unknown issuer.")
+                    return -1
+                issuer_id = int(raw)
 
     # 3) Client guard
     if client_id is None:
         print("No client selected. Use 'New Client' first or enter an existing id.")
         return -1
 
-    # 4) Items and totals (same as your code)
+    # 4) Items
     items = _input_items()
-    base = round(sum(l[3] for l in items), 2)
-    iva = round(base * IVA_RATE, 2)
-    irpf = round(base * IRPF_RATE, 2)
-    total = round(base + iva - irpf, 2)
 
-    # 5) Insert invoice + items (same as your code)
-    invoice_id = insert_invoice(conn, number, date_iso, client_id, base, iva, irpf, total, notes)
-    mark_invoice_used(conn, number)  # keep invoice_seq in sync
-    for desc, qty, price, line_total in items:
-        insert_item(conn, invoice_id, desc, qty, price)
+    # 5) Number + header + lines + invoice_seq in one transaction
+    try:
+        saved = InvoiceService(conn).save(InvoiceDraft(client_id, date_iso, items, notes, number, issuer_id))
+    except Exception as e:
+        print("Could not save invoice:", e)
+        return -1
+    invoice_id, number = saved.id, saved.number
+    base, iva, irpf, total = saved.totals.as_euros()
 
     print(f"Created invoice {number}: Base {to_money(base)} + IVA {to_money(iva)} - IRPF {to_money(irpf)} = Total {to_money(total)}")
 
-    # 6) Export PDF (same as your code)
-    try:
-        inv, it, cli = fetch_invoice_full(conn, invoice_id)
-        pdf.export_invoice(inv, it, cli)
-        print("PDF exported in 'out/' directory.")
-    except Exception as e:
-        print("PDF export failed:", e)
+    # 6) The PDF was queued with the invoice; render it and report the outcome
+    drain_in_background(conn)
+    status = wait_for_job(conn, invoice_id)
+    if status and status[0] == "done":
+        print("PDF exported:", status[1])
+    elif status and status[2]:
+        print("PDF export failed:", status[2])
+        print("Run 'python main.py render-worker' to retry it.")
+    else:
+        print("PDF still rendering; run 'python main.py render-worker' if it does not appear.")
 
     return invoice_id
@@ -0,0 +1,248 @@
+import queue
+import smtplib
+import threading
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from typing import Callable, List, Optional
+
+from .db import fetch_invoice_full, invoice_issuer
+from .settings import (
+    MAIL_FROM, SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, SMTP_STARTTLS,
+    MAIL_CONCURRENCY, MAIL_MAX_ATTEMPTS,
+)
+from .utils import to_money
+
+BACKOFF_BASE = 60           # seconds; doubles with every failed attempt
+BACKOFF_MAX = 24 * 3600
+STALE_CLAIM = 15 * 60       # 'sending' rows older than this are retried
+CLAIM_PER_SENDER = 10       # messages claimed per sender thread at a time
+
+SUBJECT = "Factura {number}"
+BODY = """Bon dia,
+
+Us adjuntem la factura {number} de data {date} per un import de {total} EUR.
+
+Salutacions,
+{company}
+"""
+
+
+def _now() -> datetime:
+    return datetime.now().replace(microsecond=0)
+
+
+def _iso(dt: datetime) -> str:
+    return dt.isoformat(timespec="seconds")
+
+
+# --- Queueing ---
+def enqueue_invoice_email(conn, invoice_id: int, recipient: Optional[str] = None) -> int:
+    """
+    Queue the PDF of an invoice for delivery (to the client's email by
+    default). Returns the outbox id; an already pending message is reused.
+    """
+    inv, _, client = fetch_invoice_full(conn, invoice_id)
+    recipient = (recipient or (client[4] if client else "") or "").strip()
+    if not recipient:
+        raise ValueError(f"Invoice {inv[1]}: client has no email address")
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id FROM outbox WHERE invoice_id = ? AND recipient = ? AND status IN ('pending', 'sending')
+    """, (invoice_id, recipient))
+    row = cur.fetchone()
+    if row:
+        return row[0]
+    now = _iso(_now())
+    cur.execute(
+        """INSERT INTO outbox (invoice_id, recipient, subject, body, next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+        (invoice_id, recipient, SUBJECT.format(number=inv[1]),
+         BODY.format(number=inv[1], date=inv[2], total=to_money(inv[7]), company=invoice_issuer(inv)[1]), now, now)
+    )
+    conn.commit()
+    return cur.lastrowid
+
+
+def enqueue_unsent(conn, since: Optional[str] = None) -> int:
+    """
+    Queue every invoice (dated on/after `since`) whose client has an email
+    and that was never queued before: one SELECT, one executemany, one commit.
+    """
+    now = _iso(_now())
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT i.id, i.number, i.date, i.total, trim(c.email), s.name
+        FROM invoices i JOIN clients c ON c.id = i.client_id
+        JOIN issuers s ON s.id = i.issuer_id
+        WHERE COALESCE(trim(c.email), '') <> '' AND i.date >= ?
+          AND NOT EXISTS (SELECT 1 FROM outbox o WHERE o.invoice_id = i.id)
+        ORDER BY i.id
+    """, (since or "",))
+    rows = [
+        (inv_id, email, SUBJECT.format(number=number),
+         BODY.format(number=number, date=date, total=to_money(total), company=issuer_name), now, now)
+        for inv_id, number, date, total, email, issuer_name in cur.fetchall()
+    ]
+    cur.executemany(
+        """INSERT INTO outbox (invoice_id, recipient, subject, body, next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)""", rows
+    )
+    conn.commit()
+    return len(rows)
+
+
+# --- Delivery ---
+def smtp_connect() -> smtplib.SMTP:
+    smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=60)
+    if SMTP_STARTTLS:
+        smtp.starttls()
+    if SMTP_USER:
+        smtp.login(SMTP_USER, SMTP_PASSWORD)
+    return smtp
+
+
+def _claim(conn, limit: int) -> List[tuple]:
+    """Atomically move due messages to 'sending' and return them."""
+    now = _now()
+    conn.commit()
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("""
+            UPDATE outbox SET status = 'pending'
+            WHERE status = 'sending' AND claimed_at < ?
+        """, (_iso(now - timedelta(seconds=STALE_CLAIM)),))
+        cur.execute("""
+            SELECT id, invoice_id, recipient, subject, body FROM outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY next_attempt_at, id LIMIT ?
+        """, (_iso(now), limit))
+        rows = cur.fetchall()
+        cur.executemany(
+            "UPDATE outbox SET status = 'sending', claimed_at = ? WHERE id = ?",
+            [(_iso(now), r[0]) for r in rows]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return rows
+
+
+def _build_message(conn, row) -> EmailMessage:
+    from .pdf import render_invoice_bytes  # reportlab only needed when sending
+    outbox_id, invoice_id, recipient, subject, body = row
+    inv, items, client = fetch_invoice_full(conn, invoice_id)
+    msg = EmailMessage()
+    msg["From"] = MAIL_FROM
+    msg["To"] = recipient
+    msg["Subject"] = subject
+    msg.set_content(body)
+    msg.add_attachment(render_invoice_bytes(inv, items, client), maintype="application",
+                       subtype="pdf", filename=f"invoice_{inv[1]}.pdf")
+    return msg
+
+
+def _sender(jobs: "queue.Queue", results: "queue.Queue", smtp_factory: Callable) -> None:
+    """One SMTP connection, reused for every message this thread sends."""
+    smtp = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        outbox_id, msg = job
+        try:
+            if smtp is None:
+                smtp = smtp_factory()
+            try:
+                smtp.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                smtp = smtp_factory()
+                smtp.send_message(msg)
+            results.put((outbox_id, None))
+        except Exception as e:
+            results.put((outbox_id, f"{type(e).__name__}: {e}"))
+            # SMTPException is an OSError too: a refused recipient or rejected
+            # message leaves the session usable, only a dropped link does not.
+            if isinstance(e, smtplib.SMTPServerDisconnected) or (
+                    isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)):
+                smtp = None
+    if smtp is not None:
+        try:
+            smtp.quit()
+        except Exception:
+            pass
+
+
+def _record(conn, outbox_id: int, error: Optional[str], max_attempts: int) -> bool:
+    cur = conn.cursor()
+    now = _now()
+    if error is None:
+        cur.execute("""
+            UPDATE outbox SET status = 'sent', sent_at = ?, attempts = attempts + 1, last_error = NULL
+            WHERE id = ?
+        """, (_iso(now), outbox_id))
+        return True
+    cur.execute("SELECT attempts FROM outbox WHERE id = ?", (outbox_id,))
+    attempts = cur.fetchone()[0] + 1
+    delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+    cur.execute("""
+        UPDATE outbox SET status = ?, attempts = ?, last_error = ?, next_attempt_at = ?
+        WHERE id = ?
+    """, ("failed" if attempts >= max_attempts else "pending", attempts, error,
+          _iso(now + timedelta(seconds=delay)), outbox_id))
+    return False
+
+
+def deliver_outbox(conn, smtp_factory: Callable = smtp_connect, concurrency: int = MAIL_CONCURRENCY,
+                   limit: int = 5000, max_attempts: int = MAIL_MAX_ATTEMPTS) -> dict:
+    """
+    Send up to `limit` due outbox messages with `concurrency` threads, each
+    holding one SMTP connection for all its messages. PDFs are rendered here
+    (the only thread that touches `conn`) and handed over through a bounded
+    queue. Messages are claimed a few per sender at a time, so no claim gets
+    older than STALE_CLAIM while it waits for its turn.
+    """
+    stats = {"sent": 0, "failed": 0}
+    concurrency = max(1, concurrency)
+    rows = _claim(conn, min(limit, CLAIM_PER_SENDER * concurrency))
+    if not rows:
+        return stats
+
+    jobs: "queue.Queue" = queue.Queue(maxsize=concurrency * 2)
+    results: "queue.Queue" = queue.Queue()
+    threads = [threading.Thread(target=_sender, args=(jobs, results, smtp_factory), daemon=True)
+               for _ in range(min(concurrency, len(rows)))]
+    for t in threads:
+        t.start()
+
+    def drain():
+        # record finished messages; committed right away so a crash cannot resend them
+        done = 0
+        while True:
+            try:
+                outbox_id, error = results.get_nowait()
+            except queue.Empty:
+                break
+            ok = _record(conn, outbox_id, error, max_attempts)
+            stats["sent" if ok else "failed"] += 1
+            done += 1
+        if done:
+            conn.commit()
+
+    remaining = limit
+    while rows:
+        remaining -= len(rows)
+        for row in rows:
+            try:
+                jobs.put((row[0], _build_message(conn, row)))
+            except Exception as e:
+                results.put((row[0], f"{type(e).__name__}: {e}"))
+            drain()
+        rows = _claim(conn, min(remaining, CLAIM_PER_SENDER * concurrency)) if remaining > 0 else []
+    for _ in threads:
+        jobs.put(None)
+    for t in threads:
+        t.join()
+    drain()
+    return stats
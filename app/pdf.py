@@ -1,8 +1,12 @@
+import io
 import os
-import re
+import tempfile
 from datetime import datetime, date
+from functools import lru_cache
 from typing import List, Tuple
 
+from reportlab.graphics.barcode.qr import QrCodeWidget
+from reportlab.graphics.shapes import Drawing
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm
@@ -11,8 +15,11 @@ from reportlab.platypus import (
     SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 )
 
-from .settings import COMPANY_NAME, COMPANY_NIF, COMPANY_ADDRESS, COMPANY_IBAN, OUTPUT_DIR
-from .utils import to_money
+from .db import invoice_issuer
+from .settings import OUTPUT_DIR, IRPF_RATE
+from .register import qr_url
+from .totals import to_cents
+from .utils import to_money, split_address_lines
 
 
 # ---------- layout constants (exact widths) ----------
@@ -63,80 +70,32 @@ def format_date_eu(d) -> str:
         return s
 
 
-def _insert_space_between_glued_caps(text: str) -> str:
-    """Turn 'Alella ParkBarcelona' -> 'Alella Park Barcelona' (accents too)."""
-    return re.sub(r'([a-záéíóúüïçñ])([A-ZÁÉÍÓÚÜÏÇÑ])', r'\1 \2', text)
-
+# ---------- layout blocks ----------
 
-def split_address_lines(address: str) -> Tuple[str, str, str]:
+@lru_cache(maxsize=64)
+def _issuer_html(issuer) -> str:
     """
-    Return up to THREE lines: (line1, line2, line3).
-    Heuristics:
-      1) Respect existing newlines.
-      2) Split AFTER 'street + number' (handles glued postal code like '2008328').
-      3) Line2 begins with postal code if present.
-      4) Try to split line2 again into locality vs province/country.
+    Static 'Emissor' block of an issuer row (id, name, nif, address, iban,
+    series), built once per issuer and process. Only the markup is cached:
+    platypus flowables keep layout state, so each render gets its own.
     """
-    if not address:
-        return "", "", ""
-
-    if "\n" in address:
-        parts = [p.strip() for p in address.split("\n")]
-        parts += ["", "", ""]
-        return parts[0], parts[1], parts[2]
-
-    s = _insert_space_between_glued_caps(re.sub(r"\s+", " ", address.strip()))
-
-    # number glued to postal code: "... 2008328 ..."
-    m = re.match(r"^(.*?\b)(\d{1,5})(\d{5})(\b.*)$", s)
-    if m:
-        left_prefix = m.group(1).strip().rstrip(",")
-        number = m.group(2)
-        postal = m.group(3)
-        rest = m.group(4).strip()
-        line1 = f"{left_prefix} {number}".strip()
-        line2_raw = f"{postal} {rest}".strip()
-    else:
-        # street+number + rest (allows 20B, 20-22, 20/2)
-        m = re.match(r"^(.*?\b\d+[A-Za-z\-\/]?)\b[ ,]*\s*(.+)$", s)
-        if m:
-            line1 = m.group(1).strip()
-            line2_raw = m.group(2).strip()
-        else:
-            # split before 5-digit postal code
-            m = re.match(r"^(.*?)(\b\d{5}\b.*)$", s)
-            if m:
-                line1 = m.group(1).strip().rstrip(",")
-                line2_raw = m.group(2).strip()
-            else:
-                # fallback
-                parts = s.split()
-                if len(parts) > 3:
-                    mid = max(2, min(len(parts) - 2, len(parts) // 2))
-                    return " ".join(parts[:mid]), " ".join(parts[mid:]), ""
-                return s, "", ""
-
-    # split line2_raw into line2 + line3
-    line2_raw = _insert_space_between_glued_caps(line2_raw)
-    if "," in line2_raw:
-        a, b = line2_raw.split(",", 1)
-        return line1, a.strip(), b.strip()
-
-    words = line2_raw.split()
-    if len(words) >= 4 and re.match(r"^\d{5}$", words[0]):
-        return line1, " ".join(words[:3]), " ".join(words[3:])
-    if len(words) >= 3:
-        return line1, " ".join(words[:2]), " ".join(words[2:])
-    return line1, line2_raw, ""
-
+    _, name, nif, address, iban, _ = issuer
+    comp_l1, comp_l2, comp_l3 = split_address_lines(address or "")
+    issuer_parts = [
+        "<b>Emissor</b>",
+        f"{name} — {nif}",
+        comp_l1
+    ]
+    if comp_l2: issuer_parts.append(comp_l2)
+    if comp_l3: issuer_parts.append(comp_l3)
+    if iban: issuer_parts.append(f"IBAN: {iban}")
+    return "<br/>".join(issuer_parts)
 
-# ---------- layout blocks ----------
 
 def _header(styles, inv, client) -> List:
     elems = []
 
-    # Title: only "Factura" (left-aligned and same padding as tables)
-    styles["Title"].alignment = 0  # LEFT
+    # Title: only "Factura" (left-aligned by _styles, same padding as tables)
     title = Paragraph("<b>Factura</b>", styles["Title"])
     title_row = Table([[title]], colWidths=[CONTENT_W], hAlign="LEFT")
     title_row.setStyle(TableStyle([
@@ -173,17 +132,7 @@ def _header(styles, inv, client) -> List:
     elems.append(Spacer(0, 6 * mm))
 
     # Emissor + Client (same formatter)
-    comp_l1, comp_l2, comp_l3 = split_address_lines(COMPANY_ADDRESS)
-    issuer_parts = [
-        "<b>Emissor</b>",
-        f"{COMPANY_NAME} — {COMPANY_NIF}",
-        comp_l1
-    ]
-    if comp_l2: issuer_parts.append(comp_l2)
-    if comp_l3: issuer_parts.append(comp_l3)
-    issuer_parts.append(f"IBAN: {COMPANY_IBAN}")
-    issuer_html = "<br/>".join(issuer_parts)
-    issuer = Paragraph(issuer_html, styles["Normal"])
+    issuer = Paragraph(_issuer_html(invoice_issuer(inv)), styles["Normal"])
 
     client_addr = client[3] or ""
     cli_l1, cli_l2, cli_l3 = split_address_lines(client_addr)
@@ -213,7 +162,19 @@ def _header(styles, inv, client) -> List:
     return elems
 
 
-def _items_and_totals_table(styles, items: List[Tuple[str, float, float, float]], inv) -> Table:
+def _pct(rate: float) -> str:
+    return f"{rate * 100:g}%"
+
+
+def _iva_label(items) -> str:
+    """'IVA (21%)' when every line has the same rate, 'IVA (21% / 10%)' otherwise."""
+    rates = sorted({round(it[4], 4) for it in items if len(it) > 4}, reverse=True)
+    if not rates:
+        return "IVA (21%)"
+    return "IVA (" + " / ".join(_pct(r) for r in rates) + ")"
+
+
+def _items_and_totals_table(styles, items: List[Tuple], inv) -> Table:
     """
     Build ONE table that contains:
       - Header row for items
@@ -236,7 +197,7 @@ def _items_and_totals_table(styles, items: List[Tuple[str, float, float, float]]
     ])
 
     # Item rows
-    for desc, qty, unit_price, line_total in items:
+    for desc, qty, unit_price, line_total, *_ in items:
         data.append([
             Paragraph(str(desc).replace("\n", "<br/>"), styles["Wrap"]),
             Paragraph(f"{qty:.2f}", styles["Right"]),
@@ -247,8 +208,8 @@ def _items_and_totals_table(styles, items: List[Tuple[str, float, float, float]]
     # Totals labels row
     data.append([
         Paragraph("Base imposable", styles["MutedCenter"]),
-        Paragraph("IVA (21%)", styles["MutedCenter"]),
-        Paragraph("IRPF (15%)", styles["MutedCenter"]),
+        Paragraph(_iva_label(items), styles["MutedCenter"]),
+        Paragraph(f"IRPF ({_pct(IRPF_RATE)})", styles["MutedCenter"]),
         Paragraph("<b>TOTAL</b>", styles["MutedCenter"]),
     ])
 
@@ -316,17 +277,30 @@ def _notes_block(styles, notes: str) -> List:
     return [Spacer(0, 6 * mm), box]
 
 
-# ---------- document build ----------
+QR_SIZE = 30 * mm
 
-def export_invoice(inv, items, client) -> str:
-    """
-    inv: (id, number, date, client_id, base, iva, irpf, total, notes)
-    items: list of (description, qty, unit_price, line_total)
-    client: (id, name, nif, address, email, phone)
-    """
-    number = inv[1]
-    out_path = _pdf_path(number)
 
+def _qr_block(styles, inv) -> List:
+    """VeriFactu tax QR: lets the client check the invoice with the AEAT."""
+    widget = QrCodeWidget(qr_url(inv[1], inv[2], to_cents(inv[4]) + to_cents(inv[5]), invoice_issuer(inv)[2]), barLevel="M")
+    x0, y0, x1, y1 = widget.getBounds()
+    drawing = Drawing(QR_SIZE, QR_SIZE, transform=[QR_SIZE / (x1 - x0), 0, 0, QR_SIZE / (y1 - y0), 0, 0])
+    drawing.add(widget)
+    label = Paragraph("<b>QR tributari</b><br/>Factura verificable a la seu electrònica de l’AEAT", styles["Wrap"])
+    box = Table([[drawing, label]], colWidths=[QR_SIZE + 4 * mm, CONTENT_W - QR_SIZE - 4 * mm], hAlign="LEFT")
+    box.setStyle(TableStyle([
+        ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+        ("LEFTPADDING", (0, 0), (-1, -1), 0),
+        ("RIGHTPADDING", (0, 0), (-1, -1), 0),
+    ]))
+    return [Spacer(0, 6 * mm), box]
+
+
+# ---------- document build ----------
+
+@lru_cache(maxsize=1)
+def _styles():
+    """Built once per process; treated as read-only by the layout code."""
     styles = getSampleStyleSheet()
     styles["Title"].fontSize = 18
     styles["Title"].spaceAfter = 0
@@ -336,18 +310,79 @@ def export_invoice(inv, items, client) -> str:
     styles.add(ParagraphStyle(name="Wrap", parent=styles["Normal"], wordWrap="CJK"))
     styles.add(ParagraphStyle(name="MutedCenter", parent=styles["Normal"], fontSize=9, textColor=colors.HexColor("#666666"), alignment=1))
     styles.add(ParagraphStyle(name="BigRight", parent=styles["Normal"], fontSize=12, alignment=2))
+    return styles
+
+
+def render_invoice_to(target, inv, items, client):
+    """
+    Render the invoice into `target`: a file path or any binary file-like
+    object with write() (open file, BytesIO, socket file, ...).
+    inv: (id, number, date, client_id, base, iva, irpf, total, notes[, issuer])
+    items: list of (description, qty, unit_price, line_total[, iva_rate])
+    client: (id, name, nif, address, email, phone)
+    """
+    styles = _styles()
 
     doc = SimpleDocTemplate(
-        out_path,
+        target,
         pagesize=PAGE_SIZE,
         leftMargin=LM, rightMargin=RM,
-        topMargin=TM, bottomMargin=BM
+        topMargin=TM, bottomMargin=BM,
+        invariant=1  # no timestamp / random ID: same invoice, same bytes
     )
 
     story = []
     story += _header(styles, inv, client)
     story.append(_items_and_totals_table(styles, items, inv))  # <— single table for both
     story += _notes_block(styles, inv[8])
+    story += _qr_block(styles, inv)
 
     doc.build(story)
+    return target
+
+
+def render_invoice_buffer(inv, items, client) -> memoryview:
+    """Render in memory; returns a zero-copy view over the PDF bytes."""
+    buf = io.BytesIO()
+    render_invoice_to(buf, inv, items, client)
+    return buf.getbuffer()
+
+
+def render_invoice_bytes(inv, items, client) -> bytes:
+    """Render in memory and return the PDF as bytes (HTTP responses, email, archives)."""
+    buf = io.BytesIO()
+    render_invoice_to(buf, inv, items, client)
+    return buf.getvalue()
+
+
+def write_invoice(stream, inv, items, client) -> int:
+    """Render in memory and write the PDF to a writable binary stream. Returns bytes written."""
+    view = render_invoice_buffer(inv, items, client)
+    stream.write(view)
+    return view.nbytes
+
+
+def export_invoice(inv, items, client) -> str:
+    """
+    Write out/invoice_<number>.pdf atomically: the PDF is built in a temp
+    file in the same directory and moved into place with os.replace, so a
+    crash never leaves a truncated invoice behind.
+    """
+    number = inv[1]
+    out_path = _pdf_path(number)
+
+    fd, tmp_path = tempfile.mkstemp(prefix=f".invoice_{number}.", suffix=".tmp", dir=os.path.dirname(out_path))
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            render_invoice_to(fh, inv, items, client)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.chmod(tmp_path, 0o644)  # mkstemp creates 0600
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
     return out_path
@@ -0,0 +1,198 @@
+import hashlib
+import os
+import re
+import sqlite3
+import zlib
+from datetime import datetime
+from typing import Iterable, Optional
+
+from .settings import OUTPUT_DIR, PDF_STORE_DB
+
+# Rendered PDFs, content-addressed by SHA-256 and zlib-compressed against a
+# shared preset dictionary (a previously stored invoice), so the static parts
+# every invoice repeats (fonts, issuer block, layout) cost almost nothing.
+STORE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS pdf_dicts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        data BLOB NOT NULL
+    );""",
+
+    """CREATE TABLE IF NOT EXISTS pdf_blobs (
+        hash TEXT PRIMARY KEY,
+        dict_id INTEGER,
+        size INTEGER NOT NULL,
+        stored_size INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        FOREIGN KEY(dict_id) REFERENCES pdf_dicts(id)
+    );""",
+
+    """CREATE TABLE IF NOT EXISTS pdf_index (
+        number TEXT PRIMARY KEY,
+        hash TEXT NOT NULL,
+        stored_at TEXT NOT NULL,
+        FOREIGN KEY(hash) REFERENCES pdf_blobs(hash)
+    );""",
+
+    "CREATE INDEX IF NOT EXISTS ix_pdf_index_hash ON pdf_index(hash);",
+]
+
+ZDICT_SIZE = 32 * 1024  # zlib only looks back 32 KiB
+_PDF_NAME_RE = re.compile(r"^invoice_(.+)\.pdf$")
+
+
+def open_store(path: Optional[str] = None, timeout: float = 5.0) -> sqlite3.Connection:
+    store = sqlite3.connect(path or PDF_STORE_DB, timeout=timeout)
+    cur = store.cursor()
+    for stmt in STORE_SCHEMA:
+        cur.execute(stmt)
+    store.commit()
+    return store
+
+
+def _zdict(store, dict_id: Optional[int]) -> Optional[bytes]:
+    if dict_id is None:
+        return None
+    row = store.execute("SELECT data FROM pdf_dicts WHERE id = ?", (dict_id,)).fetchone()
+    return row[0] if row else None
+
+
+def _current_dict(store, sample: bytes):
+    row = store.execute("SELECT id, data FROM pdf_dicts ORDER BY id DESC LIMIT 1").fetchone()
+    if row:
+        return row[0], row[1]
+    # The first PDF ever stored becomes the shared dictionary.
+    data = sample[-ZDICT_SIZE:]
+    cur = store.execute("INSERT INTO pdf_dicts (data) VALUES (?)", (data,))
+    return cur.lastrowid, data
+
+
+def _compress(data: bytes, zdict: bytes) -> bytes:
+    co = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY, zdict)
+    return co.compress(data) + co.flush()
+
+
+def _decompress(data: bytes, zdict: Optional[bytes]) -> bytes:
+    do = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+    return do.decompress(data) + do.flush()
+
+
+def _put(store, number: str, data: bytes) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    cur = store.cursor()
+    cur.execute("SELECT 1 FROM pdf_blobs WHERE hash = ?", (digest,))
+    if not cur.fetchone():
+        dict_id, zdict = _current_dict(store, data)
+        packed = _compress(data, zdict)
+        cur.execute(
+            """INSERT OR IGNORE INTO pdf_blobs (hash, dict_id, size, stored_size, data)
+                VALUES (?, ?, ?, ?, ?)""", (digest, dict_id, len(data), len(packed), packed)
+        )
+    cur.execute(
+        """INSERT INTO pdf_index (number, hash, stored_at) VALUES (?, ?, ?)
+            ON CONFLICT(number) DO UPDATE SET hash = excluded.hash, stored_at = excluded.stored_at""",
+        (number, digest, datetime.now().isoformat(timespec="seconds"))
+    )
+    return digest
+
+
+def put_pdf(store, number: str, data: bytes) -> str:
+    """Store (or replace) the PDF of invoice `number`; returns its SHA-256."""
+    digest = _put(store, number, bytes(data))
+    store.commit()
+    return digest
+
+
+def store_invoice_pdf(store, inv, items, client) -> str:
+    """Render an invoice in memory and put it in the store."""
+    from .pdf import render_invoice_bytes
+    return put_pdf(store, inv[1], render_invoice_bytes(inv, items, client))
+
+
+def get_pdf(store, number: str) -> Optional[bytes]:
+    row = store.execute("""
+        SELECT b.hash, b.dict_id, b.data FROM pdf_index i
+        JOIN pdf_blobs b ON b.hash = i.hash
+        WHERE i.number = ?
+    """, (number,)).fetchone()
+    if row is None:
+        return None
+    digest, dict_id, packed = row
+    data = _decompress(packed, _zdict(store, dict_id))
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise RuntimeError(f"Stored PDF for {number} is corrupt (hash mismatch)")
+    return data
+
+
+def export_to_folder(store, folder: str, numbers: Optional[Iterable[str]] = None) -> int:
+    """Write invoice_<number>.pdf files into `folder` (all invoices by default)."""
+    os.makedirs(folder, exist_ok=True)
+    if numbers is None:
+        numbers = [r[0] for r in store.execute("SELECT number FROM pdf_index ORDER BY number")]
+    count = 0
+    for number in numbers:
+        data = get_pdf(store, number)
+        if data is None:
+            print(f"Not in store: {number}")
+            continue
+        path = os.path.join(folder, f"invoice_{number}.pdf")
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+        count += 1
+    return count
+
+
+def migrate_output_dir(store, folder: str = OUTPUT_DIR, remove: bool = False, batch: int = 500) -> dict:
+    """
+    Import every invoice_<number>.pdf of `folder` into the store, committing
+    every `batch` files. With remove=True each committed batch is read back
+    from the store and compared with the files before they are deleted;
+    only the paths of the current batch are kept in memory.
+    """
+    stats = {"files": 0, "bytes": 0, "stored_bytes_before": stored_bytes(store), "removed": 0}
+    if not os.path.isdir(folder):
+        return stats
+    names = sorted(n for n in os.listdir(folder) if _PDF_NAME_RE.match(n))
+    pending = []
+    for i, name in enumerate(names, 1):
+        path = os.path.join(folder, name)
+        with open(path, "rb") as fh:
+            data = fh.read()
+        _put(store, _PDF_NAME_RE.match(name).group(1), data)
+        pending.append((path, name))
+        stats["files"] += 1
+        stats["bytes"] += len(data)
+        if i % batch == 0 or i == len(names):
+            store.commit()
+            if remove:
+                stats["removed"] += _remove_verified(store, pending)
+            pending = []
+    stats["stored_bytes"] = stored_bytes(store) - stats.pop("stored_bytes_before")
+    return stats
+
+
+def _remove_verified(store, files) -> int:
+    removed = 0
+    for path, name in files:
+        with open(path, "rb") as fh:
+            data = fh.read()
+        if get_pdf(store, _PDF_NAME_RE.match(name).group(1)) == data:
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def stored_bytes(store) -> int:
+    row = store.execute("""
+        SELECT COALESCE(SUM(stored_size), 0) FROM pdf_blobs
+    """).fetchone()
+    dicts = store.execute("SELECT COALESCE(SUM(length(data)), 0) FROM pdf_dicts").fetchone()
+    return row[0] + dicts[0]
+
+
+def prune_blobs(store) -> int:
+    """Delete blobs no invoice points to any more (after re-renders)."""
+    cur = store.execute("DELETE FROM pdf_blobs WHERE hash NOT IN (SELECT hash FROM pdf_index)")
+    store.commit()
+    return cur.rowcount
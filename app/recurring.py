@@ -0,0 +1,123 @@
+import calendar
+import json
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
+
+from .db import DEFAULT_ISSUER_ID, get_issuer
+from .repository import client_repo
+from .service import InvoiceDraft, InvoiceService
+from .settings import IVA_RATE
+from .totals import check_iva_rate
+
+# Invoices billed the same lines every period. A template's periods are
+# counted from its start date (runs = invoices generated so far), so a
+# monthly template started on the 31st bills on the last day of shorter
+# months and goes back to the 31st afterwards.
+
+CADENCES = {"weekly": None, "monthly": 1, "quarterly": 3, "yearly": 12}
+MAX_CATCH_UP = 120  # periods generated per template and run
+
+
+def _add_months(d: date, months: int) -> date:
+    y, m = divmod(d.month - 1 + months, 12)
+    year, month = d.year + y, m + 1
+    return date(year, month, min(d.day, calendar.monthrange(year, month)[1]))
+
+
+def period_date(start: str, cadence: str, n: int) -> str:
+    """Date of the n-th period (0 = start) as ISO 'YYYY-MM-DD'."""
+    d = date.fromisoformat(start)
+    if cadence == "weekly":
+        return (d + timedelta(weeks=n)).isoformat()
+    return _add_months(d, CADENCES[cadence] * n).isoformat()
+
+
+def _encode_items(items) -> str:
+    """items: (description, qty, unit_price[, line_total[, iva_rate]])"""
+    rows = []
+    for it in items:
+        rate = it[4] if len(it) > 4 else IVA_RATE
+        check_iva_rate(rate)
+        rows.append({"description": it[0], "qty": float(it[1]), "unit_price": float(it[2]), "iva_rate": rate})
+    return json.dumps(rows, ensure_ascii=False)
+
+
+def _decode_items(text: str) -> List[tuple]:
+    return [(r["description"], r["qty"], r["unit_price"], None, r.get("iva_rate", IVA_RATE)) for r in json.loads(text)]
+
+
+def add_template(conn, client_id: int, items, cadence: str, start: str, notes: str = "",
+                 issuer_id: int = DEFAULT_ISSUER_ID) -> int:
+    if cadence not in CADENCES:
+        raise ValueError(f"Unknown cadence {cadence!r} (use {', '.join(CADENCES)})")
+    if not items:
+        raise ValueError("A template needs at least one line.")
+    if not client_repo(conn).exists(client_id):
+        raise ValueError(f"Client id {client_id} not found.")
+    get_issuer(conn, issuer_id)  # LookupError if unknown
+    start = date.fromisoformat(start).isoformat()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO recurring_templates (client_id, issuer_id, items, cadence, start_date, next_run, notes, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (client_id, issuer_id, _encode_items(items), cadence, start, start, notes,
+          datetime.now().isoformat(timespec="seconds")))
+    conn.commit()
+    return cur.lastrowid
+
+
+def set_active(conn, template_id: int, active: bool) -> None:
+    conn.execute("UPDATE recurring_templates SET active = ? WHERE id = ?", (int(active), template_id))
+    conn.commit()
+
+
+def run_recurring(conn, today: Optional[str] = None) -> dict:
+    """
+    Generate every invoice due up to `today` (default: today), one per
+    missed period, dated on its period. The due templates are read, their
+    invoices saved (with render jobs) and next_run moved forward in a
+    single IMMEDIATE transaction, so a crash or a second run never bills a
+    period twice.
+    """
+    today = today or date.today().isoformat()
+    service = InvoiceService(conn)
+    repo = client_repo(conn)
+    with service.transaction() as cur:
+        cur.execute("""
+            SELECT id, client_id, issuer_id, items, cadence, start_date, runs, notes
+            FROM recurring_templates
+            WHERE active = 1 AND next_run <= ?
+            ORDER BY next_run, id
+        """, (today,))
+        due = cur.fetchall()
+
+        drafts: List[InvoiceDraft] = []
+        advanced: List[tuple] = []
+        skipped: List[Tuple[int, str]] = []
+        for template_id, client_id, issuer_id, items_json, cadence, start, runs, notes in due:
+            try:
+                items = _decode_items(items_json)
+                if not items:
+                    raise ValueError("no lines")
+                if not repo.exists(client_id):
+                    raise ValueError(f"client id {client_id} not found")
+                pending = []
+                n = runs
+                while period_date(start, cadence, n) <= today and n - runs < MAX_CATCH_UP:
+                    draft = InvoiceDraft(client_id, period_date(start, cadence, n), items, notes or "", issuer_id=issuer_id)
+                    service.check(draft)  # e.g. a period in an archived year
+                    pending.append(draft)
+                    n += 1
+            except (ValueError, LookupError, TypeError) as e:  # bad template: leave it due, bill the rest
+                skipped.append((template_id, f"{type(e).__name__}: {e}"))
+                continue
+            drafts += pending
+            advanced.append((template_id, n, period_date(start, cadence, n)))
+
+        saved = service.save_many(drafts, cur)
+        ran_at = datetime.now().isoformat(timespec="seconds")
+        cur.executemany("""
+            UPDATE recurring_templates SET runs = ?, next_run = ?, last_run_at = ? WHERE id = ?
+        """, [(n, next_run, ran_at, tid) for tid, n, next_run in advanced])
+
+    return {"templates": len(advanced), "invoices": saved, "skipped": skipped}
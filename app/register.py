@@ -0,0 +1,211 @@
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import List, Optional, Tuple
+from urllib.parse import urlencode
+from urllib.request import pathname2url
+
+from .archive import db_file
+from .settings import COMPANY_NIF, REGISTER_CHECKPOINT_EVERY, VERIFACTU_QR_URL
+from .utils import normalize_nif
+
+# VeriFactu-style register: every invoice gets an append-only record whose
+# SHA-256 covers its canonical fields and the previous record's hash, one
+# chain per issuer NIF. register_head caches the last hash of each chain so
+# an append is one lookup; register_checkpoints keeps the hash of every
+# REGISTER_CHECKPOINT_EVERY-th record so the chain can be re-checked in
+# independent segments.
+
+RECORD_TYPE = "F1"  # factura completa
+
+
+def _amount(cents: int) -> str:
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+
+def _date_es(date_iso: str) -> str:
+    """'2025-09-23' -> '23-09-2025' (the format the AEAT expects)."""
+    return f"{date_iso[8:10]}-{date_iso[5:7]}-{date_iso[0:4]}"
+
+
+def record_hash(nif: str, number: str, date_iso: str, record_type: str,
+                iva_cents: int, total_cents: int, prev_hash: str, generated_at: str) -> str:
+    """Huella of an alta record: SHA-256 of the AEAT field string, upper-case hex."""
+    text = (f"IDEmisorFactura={nif}&NumSerieFactura={number}&FechaExpedicionFactura={_date_es(date_iso)}"
+            f"&TipoFactura={record_type}&CuotaTotal={_amount(iva_cents)}&ImporteTotal={_amount(total_cents)}"
+            f"&Huella={prev_hash}&FechaHoraHusoGenRegistro={generated_at}")
+    return hashlib.sha256(text.encode("utf-8")).hexdigest().upper()
+
+
+def append_record(cur, invoice_id: int, number: str, date: str, iva_cents: int, total_cents: int,
+                  issuer_nif: str = COMPANY_NIF) -> str:
+    """
+    Chain a record for a just-written invoice. Does not commit: it belongs
+    to the caller's transaction, which must already hold the write lock.
+    total_cents is the ImporteTotal (base + IVA, before IRPF).
+    """
+    nif = normalize_nif(issuer_nif)
+    cur.execute("SELECT last_seq, hash FROM register_head WHERE issuer_nif = ?", (nif,))
+    last_seq, prev_hash = cur.fetchone() or (0, "")
+    seq = last_seq + 1
+    generated_at = datetime.now().astimezone().isoformat(timespec="seconds")
+    digest = record_hash(nif, number, date, RECORD_TYPE, iva_cents, total_cents, prev_hash, generated_at)
+    cur.execute("""
+        INSERT INTO invoice_register (issuer_nif, seq, invoice_id, number, date, record_type,
+                                      iva_cents, total_cents, generated_at, prev_hash, hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (nif, seq, invoice_id, number, date, RECORD_TYPE, iva_cents, total_cents, generated_at, prev_hash, digest))
+    cur.execute("""
+        INSERT INTO register_head (issuer_nif, last_seq, hash) VALUES (?, ?, ?)
+        ON CONFLICT(issuer_nif) DO UPDATE SET last_seq = excluded.last_seq, hash = excluded.hash
+    """, (nif, seq, digest))
+    if seq % REGISTER_CHECKPOINT_EVERY == 0:
+        cur.execute("INSERT INTO register_checkpoints (issuer_nif, seq, hash) VALUES (?, ?, ?)", (nif, seq, digest))
+    return digest
+
+
+def register_unregistered(conn) -> int:
+    """Chain every invoice of the main DB that has no record yet (invoices saved before the register existed)."""
+    conn.commit()
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("""
+            SELECT i.id, i.number, i.date, i.iva_cents, i.base_cents + i.iva_cents, s.nif
+            FROM invoices i JOIN issuers s ON s.id = i.issuer_id
+            WHERE NOT EXISTS (SELECT 1 FROM invoice_register r WHERE r.invoice_id = i.id)
+            ORDER BY i.id
+        """)
+        rows = cur.fetchall()
+        for invoice_id, number, date, iva_cents, total_cents, issuer_nif in rows:
+            append_record(cur, invoice_id, number, date, iva_cents, total_cents, issuer_nif)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(rows)
+
+
+def qr_url(number: str, date_iso: str, total_cents: int, issuer_nif: str = COMPANY_NIF) -> str:
+    """Payload of the tax QR printed on the invoice."""
+    return VERIFACTU_QR_URL + "?" + urlencode({
+        "nif": normalize_nif(issuer_nif),
+        "numserie": number,
+        "fecha": _date_es(date_iso),
+        "importe": _amount(total_cents),
+    })
+
+
+# --- Verification ---
+
+def _check_segment(conn, nif: str, start_seq: int, start_hash: str, end_seq: int, end_hash: str,
+                   max_problems: int = 20) -> List[Tuple[str, int, str]]:
+    """Re-hash records start_seq+1..end_seq; the last one must hash to end_hash."""
+    problems = []
+    expected_seq, prev = start_seq, start_hash
+    cur = conn.execute("""
+        SELECT seq, number, date, record_type, iva_cents, total_cents, generated_at, prev_hash, hash
+        FROM invoice_register WHERE issuer_nif = ? AND seq > ? AND seq <= ? ORDER BY seq
+    """, (nif, start_seq, end_seq))
+    for seq, number, date, rtype, iva_cents, total_cents, generated_at, prev_hash, digest in cur:
+        expected_seq += 1
+        if seq != expected_seq:
+            problems.append((nif, expected_seq, f"missing records {expected_seq}..{seq - 1}"))
+            expected_seq = seq
+        if prev_hash != prev:
+            problems.append((nif, seq, "previous hash does not match"))
+        if record_hash(nif, number, date, rtype, iva_cents, total_cents, prev_hash, generated_at) != digest:
+            problems.append((nif, seq, f"hash mismatch (invoice {number})"))
+        prev = digest
+        if len(problems) >= max_problems:
+            return problems
+    if expected_seq != end_seq:
+        problems.append((nif, expected_seq, f"chain ends at {expected_seq}, expected {end_seq}"))
+    elif prev != end_hash:
+        problems.append((nif, end_seq, "hash differs from the checkpoint / head"))
+    return problems
+
+
+_worker_conn = None
+
+
+def _worker_init(db_path: str) -> None:
+    global _worker_conn
+    _worker_conn = sqlite3.connect("file:" + pathname2url(os.path.abspath(db_path)) + "?mode=ro", uri=True)
+
+
+def _worker_check(segment) -> list:
+    return _check_segment(_worker_conn, *segment)
+
+
+def _segments(conn) -> List[tuple]:
+    """(nif, start_seq, start_hash, end_seq, end_hash) between consecutive checkpoints, per chain."""
+    segments = []
+    for nif, last_seq, head_hash in conn.execute("SELECT issuer_nif, last_seq, hash FROM register_head ORDER BY issuer_nif").fetchall():
+        start = (0, "")
+        for seq, digest in conn.execute("""
+            SELECT seq, hash FROM register_checkpoints WHERE issuer_nif = ? AND seq <= ? ORDER BY seq
+        """, (nif, last_seq)).fetchall():
+            segments.append((nif, *start, seq, digest))
+            start = (seq, digest)
+        if start[0] < last_seq:
+            segments.append((nif, *start, last_seq, head_hash))
+    return segments
+
+
+def verify_register(conn, workers: Optional[int] = None) -> dict:
+    """
+    Re-check every chain: segments between checkpoints are re-hashed in
+    parallel worker processes (inline for in-memory DBs or a single
+    segment). Also compares the records with the invoices still in the
+    main DB and the heads with the stored records.
+    """
+    segments = _segments(conn)
+    path = db_file(conn)
+    if len(segments) > 1 and path and workers != 1:
+        conn.commit()  # workers must see everything committed
+        with ProcessPoolExecutor(max_workers=workers, initializer=_worker_init, initargs=(path,)) as pool:
+            results = list(pool.map(_worker_check, segments))
+    else:
+        results = [_check_segment(conn, *s) for s in segments]
+    problems = [p for r in results for p in r]
+
+    # every stored record must be covered by a head
+    for nif, count, max_seq, last_seq in conn.execute("""
+        SELECT r.issuer_nif, COUNT(*), MAX(r.seq), h.last_seq
+        FROM invoice_register r LEFT JOIN register_head h ON h.issuer_nif = r.issuer_nif
+        GROUP BY r.issuer_nif
+    """).fetchall():
+        if last_seq is None or max_seq != last_seq or count != max_seq:
+            problems.append((nif, max_seq, f"{count} records up to seq {max_seq}, head at {last_seq}"))
+
+    altered = conn.execute("""
+        SELECT r.issuer_nif, r.seq, i.number
+        FROM invoice_register r JOIN invoices i ON i.id = r.invoice_id
+        WHERE r.number != i.number OR r.date != i.date
+           OR r.iva_cents != i.iva_cents OR r.total_cents != i.base_cents + i.iva_cents
+        ORDER BY r.issuer_nif, r.seq
+    """).fetchall()
+    problems += [(nif, seq, f"invoice {number} differs from its record") for nif, seq, number in altered]
+
+    unregistered = conn.execute("""
+        SELECT COUNT(*) FROM invoices i
+        WHERE NOT EXISTS (SELECT 1 FROM invoice_register r WHERE r.invoice_id = i.id)
+    """).fetchone()[0]
+    records = conn.execute("SELECT COUNT(*) FROM invoice_register").fetchone()[0]
+    return {"records": records, "segments": len(segments), "unregistered": unregistered, "problems": problems}
+
+
+def format_verify_report(report: dict, limit: int = 20) -> str:
+    lines = [f"{report['records']} records in {report['segments']} segments checked"]
+    if report["unregistered"]:
+        lines.append(f"{report['unregistered']} invoices without a record (run register-backfill)")
+    for nif, seq, msg in report["problems"][:limit]:
+        lines.append(f"  {nif} #{seq}: {msg}")
+    if len(report["problems"]) > limit:
+        lines.append(f"  ... and {len(report['problems']) - limit} more")
+    lines.append("OK" if not report["problems"] else f"{len(report['problems'])} problems")
+    return "\n".join(lines)
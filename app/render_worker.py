@@ -0,0 +1,201 @@
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Process
+from typing import Optional
+
+from .archive import db_file
+from .db import fetch_invoice_full, get_conn, _write_render_job
+from .settings import PDF_STORE_DB, PDF_TO_STORE
+
+BACKOFF_BASE = 30           # seconds; doubles with every failed attempt
+BACKOFF_MAX = 3600
+MAX_ATTEMPTS = 6            # then the job is marked 'failed'
+STALE_CLAIM = 5 * 60        # 'running' jobs older than this were lost in a crash
+POLL_INTERVAL = 1.0
+DEFAULT_STORE = PDF_STORE_DB if PDF_TO_STORE else None  # None: loose files in OUTPUT_DIR
+
+
+def _iso(dt: datetime) -> str:
+    return dt.isoformat(timespec="seconds")
+
+
+def enqueue_render(conn, invoice_id: int) -> int:
+    """Queue a (re-)render of an invoice PDF."""
+    job_id = _write_render_job(conn.cursor(), invoice_id)
+    conn.commit()
+    return job_id
+
+
+def claim_job(conn, worker: str) -> Optional[tuple]:
+    """
+    Atomically take the oldest due job (or one whose worker died): a single
+    UPDATE ... RETURNING, so two workers can never claim the same job.
+    Returns (job_id, invoice_id, attempts) or None.
+    """
+    now = datetime.now()
+    conn.commit()
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE render_jobs
+        SET status = 'running', claimed_by = ?, claimed_at = ?, attempts = attempts + 1
+        WHERE id = (
+            SELECT id FROM render_jobs
+            WHERE (status = 'pending' AND next_attempt_at <= ?)
+               OR (status = 'running' AND claimed_at < ?)
+            ORDER BY id LIMIT 1
+        )
+        RETURNING id, invoice_id, attempts
+    """, (worker, _iso(now), _iso(now), _iso(now - timedelta(seconds=STALE_CLAIM))))
+    row = cur.fetchone()
+    conn.commit()
+    return row
+
+
+def _finish(conn, job_id: int, attempts: int, started: float, output: Optional[str], error: Optional[str]) -> None:
+    now = datetime.now()
+    duration_ms = int((time.perf_counter() - started) * 1000)
+    if error is None:
+        conn.execute("""
+            UPDATE render_jobs SET status = 'done', duration_ms = ?, output = ?, last_error = NULL, finished_at = ?
+            WHERE id = ?
+        """, (duration_ms, output, _iso(now), job_id))
+    else:
+        delay = min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+        conn.execute("""
+            UPDATE render_jobs SET status = ?, duration_ms = ?, last_error = ?, next_attempt_at = ?, finished_at = ?
+            WHERE id = ?
+        """, ("failed" if attempts >= MAX_ATTEMPTS else "pending", duration_ms, error,
+              _iso(now + timedelta(seconds=delay)), _iso(now), job_id))
+    conn.commit()
+
+
+def run_one(conn, worker: str, store=None) -> Optional[bool]:
+    """
+    Claim and render one job. None if nothing was due, else whether it
+    succeeded. With a pdfstore connection the PDF goes into the store
+    (output 'store:<number>') instead of OUTPUT_DIR.
+    """
+    job = claim_job(conn, worker)
+    if job is None:
+        return None
+    job_id, invoice_id, attempts = job
+    started = time.perf_counter()
+    try:
+        from . import pdf, pdfstore  # reportlab is only needed by workers
+        inv, items, client = fetch_invoice_full(conn, invoice_id)
+        if store is not None:
+            pdfstore.store_invoice_pdf(store, inv, items, client)
+            output = f"store:{inv[1]}"
+        else:
+            output = pdf.export_invoice(inv, items, client)
+    except Exception as e:
+        _finish(conn, job_id, attempts, started, None, f"{type(e).__name__}: {e}")
+        return False
+    _finish(conn, job_id, attempts, started, output, None)
+    return True
+
+
+def _open_store(store_path: Optional[str]):
+    if store_path is None:
+        return None
+    from .pdfstore import open_store
+    return open_store(store_path, timeout=30)
+
+
+def worker_loop(db_path: str, once: bool = False, worker: Optional[str] = None,
+                store_path: Optional[str] = DEFAULT_STORE) -> dict:
+    """
+    Render jobs until the queue is empty (once=True) or forever, polling
+    every POLL_INTERVAL seconds when idle. PDFs go to the store at
+    `store_path`, or to OUTPUT_DIR when it is None.
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    conn = get_conn(db_path, timeout=30)
+    store = _open_store(store_path)
+    stats = {"done": 0, "failed": 0}
+    try:
+        while True:
+            ok = run_one(conn, worker, store)
+            if ok is None:
+                if once:
+                    return stats
+                time.sleep(POLL_INTERVAL)
+                continue
+            stats["done" if ok else "failed"] += 1
+    finally:
+        if store is not None:
+            store.close()
+        conn.close()
+
+
+def run_workers(db_path: str, processes: int = 2, once: bool = False,
+                store_path: Optional[str] = DEFAULT_STORE) -> None:
+    """A pool of worker processes, each with its own connections."""
+    procs = [Process(target=worker_loop, args=(db_path, once, None, store_path), daemon=False)
+             for _ in range(max(1, processes))]
+    for p in procs:
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            p.join()
+
+
+_background = []
+
+
+def drain_in_background(conn, store_path: Optional[str] = DEFAULT_STORE) -> threading.Thread:
+    """
+    Render what is queued on a daemon thread with its own connection, so
+    saves return immediately. Anything not finished is picked up later by a
+    worker (stale claims are retried).
+    """
+    path = db_file(conn)
+    if not path:  # in-memory DB: no second connection possible, render inline
+        store = _open_store(store_path)
+        try:
+            while run_one(conn, "inline", store) is not None:
+                pass
+        finally:
+            if store is not None:
+                store.close()
+        return threading.current_thread()
+    t = threading.Thread(target=worker_loop, args=(path, True, None, store_path), daemon=True)
+    t.start()
+    _background[:] = [b for b in _background if b.is_alive()] + [t]
+    return t
+
+
+def wait_background(timeout: float = 30.0) -> None:
+    """Give background renders a chance to finish (e.g. before the CLI exits)."""
+    deadline = time.monotonic() + timeout
+    for t in list(_background):
+        t.join(max(0.0, deadline - time.monotonic()))
+
+
+def job_status(conn, invoice_id: int) -> Optional[tuple]:
+    """(status, output, last_error) of the latest render job of an invoice."""
+    return conn.execute("""
+        SELECT status, output, last_error FROM render_jobs
+        WHERE invoice_id = ? ORDER BY id DESC LIMIT 1
+    """, (invoice_id,)).fetchone()
+
+
+def wait_for_job(conn, invoice_id: int, timeout: float = 30.0) -> Optional[tuple]:
+    """
+    Poll the invoice's latest render job until it is done or an attempt has
+    failed (or `timeout` passes) and return its job_status().
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        row = job_status(conn, invoice_id)
+        if row is None or row[0] in ("done", "failed") or row[2] or time.monotonic() >= deadline:
+            return row
+        time.sleep(0.1)
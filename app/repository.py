@@ -0,0 +1,88 @@
+import sqlite3
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+CLIENT_COLUMNS = "id, name, nif, address, email, phone"
+
+
+class ClientRepository:
+    """
+    Read cache for `clients` rows on one connection.
+
+    Entries are dropped whenever `PRAGMA data_version` changes (a commit from
+    another connection/process), so a lookup costs one PRAGMA instead of a
+    query. Writes to `clients` on this connection must call invalidate()
+    (db.new_client and get_or_create_clients_by_nif do); writes to other
+    tables keep the cache.
+    """
+
+    def __init__(self, conn, maxsize: int = 512):
+        self.conn = conn
+        self.maxsize = maxsize
+        self._rows: "OrderedDict[int, Optional[Tuple]]" = OrderedDict()
+        self._all: Optional[List[Tuple]] = None
+        self._token = None
+
+    def _check(self) -> None:
+        token = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if token != self._token:
+            self.invalidate()
+            self._token = token
+
+    def invalidate(self) -> None:
+        self._rows.clear()
+        self._all = None
+
+    def get(self, client_id: int) -> Optional[Tuple]:
+        """(id, name, nif, address, email, phone) or None."""
+        self._check()
+        if client_id in self._rows:
+            self._rows.move_to_end(client_id)
+            return self._rows[client_id]
+        cur = self.conn.cursor()
+        cur.execute(f"SELECT {CLIENT_COLUMNS} FROM clients WHERE id = ?", (client_id,))
+        row = cur.fetchone()
+        self._rows[client_id] = row
+        if len(self._rows) > self.maxsize:
+            self._rows.popitem(last=False)
+        return row
+
+    def exists(self, client_id: int) -> bool:
+        return self.get(client_id) is not None
+
+    def list_all(self) -> List[Tuple]:
+        """All clients, newest first (same order as db.list_clients)."""
+        self._check()
+        if self._all is None:
+            cur = self.conn.cursor()
+            cur.execute(f"SELECT {CLIENT_COLUMNS} FROM clients ORDER BY id DESC")
+            self._all = cur.fetchall()
+            for row in self._all[:self.maxsize]:
+                self._rows[row[0]] = row
+            while len(self._rows) > self.maxsize:
+                self._rows.popitem(last=False)
+        return list(self._all)
+
+
+class Connection(sqlite3.Connection):
+    """sqlite3.Connection that can be weakly referenced (db.get_conn opens these)."""
+
+
+# One repository per live connection; the entry goes away with the connection.
+_REPOS: "weakref.WeakKeyDictionary[Connection, ClientRepository]" = weakref.WeakKeyDictionary()
+
+
+def client_repo(conn) -> ClientRepository:
+    """
+    The shared ClientRepository of `conn`. A plain sqlite3.Connection cannot
+    be weakly referenced: it gets a fresh, unshared repository every call.
+    """
+    try:
+        repo = _REPOS.get(conn)
+    except TypeError:
+        return ClientRepository(conn)
+    if repo is None:
+        # the repository must not keep its own key alive: hold a proxy
+        repo = _REPOS[conn] = ClientRepository(weakref.proxy(conn))
+    return repo
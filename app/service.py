@@ -0,0 +1,129 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, NamedTuple, Optional
+
+from .db import (next_invoice_number, _write_invoice, _write_items, _write_seq_used, _write_render_job,
+                 _compose_number, _split_number, get_issuer, DEFAULT_ISSUER_ID, NUMBER_RE)
+from .archive import archived_years
+from .repository import client_repo
+from .totals import Totals, compute_totals
+
+
+@dataclass
+class InvoiceDraft:
+    """An invoice as entered, before it has a number or an id."""
+    client_id: int
+    date: str                                        # ISO 'YYYY-MM-DD'
+    items: List[tuple] = field(default_factory=list)  # (description, qty, unit_price[, line_total[, iva_rate]])
+    notes: str = ""
+    number: Optional[str] = None                     # override; default: next number for the date's year
+    issuer_id: int = DEFAULT_ISSUER_ID
+
+
+class SavedInvoice(NamedTuple):
+    id: int
+    number: str
+    totals: Totals
+
+
+class InvoiceService:
+    """
+    Unit of work for saving invoices: number allocation, header, lines, the
+    invoice_seq bump and the PDF render job happen in one IMMEDIATE
+    transaction with a single commit, so a crash leaves either the whole
+    invoice or nothing. Rendering is left to app/render_worker.py.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def check(self, draft: InvoiceDraft) -> None:
+        """ValueError / LookupError if the draft cannot be saved."""
+        if not draft.items:
+            raise ValueError("An invoice needs at least one line.")
+        if not client_repo(self.conn).exists(draft.client_id):
+            raise ValueError(f"Client id {draft.client_id} not found.")
+        if int(draft.date[:4]) in archived_years(self.conn):
+            raise ValueError(f"Year {draft.date[:4]} is archived; no new invoices can be dated in it.")
+        if draft.number and NUMBER_RE.match(draft.number):
+            series = get_issuer(self.conn, draft.issuer_id)[5]
+            if _split_number(draft.number)[0] != series:
+                raise ValueError(f"Invoice number {draft.number} is not in the issuer's series "
+                                 f"{repr(series) if series else '(none)'}.")
+
+    def _save_in_tx(self, cur, draft: InvoiceDraft, number: Optional[str] = None) -> SavedInvoice:
+        number = number or draft.number or next_invoice_number(self.conn, draft.date, draft.issuer_id)
+        totals = compute_totals(draft.items)
+        invoice_id = _write_invoice(cur, number, draft.date, draft.client_id,
+                                    (totals.base, totals.iva, totals.irpf, totals.total), draft.notes, draft.issuer_id)
+        _write_items(cur, invoice_id, draft.items)
+        _write_seq_used(cur, number, draft.issuer_id)
+        _write_render_job(cur, invoice_id)
+        return SavedInvoice(invoice_id, number, totals)
+
+    def _save_many_in_tx(self, cur, drafts: List[InvoiceDraft]) -> List[SavedInvoice]:
+        """
+        Drafts are numbered in date order; each issuer and year's next number
+        is read once and then counted up locally (the write lock is already
+        held). Override numbers of the batch are never handed out again, and
+        the count moves past each override as it is saved, as one-by-one
+        saves would.
+        """
+        overrides: Dict[tuple, set] = {}
+        for draft in drafts:
+            if draft.number and NUMBER_RE.match(draft.number):
+                _, year, seq = _split_number(draft.number)
+                overrides.setdefault((draft.issuer_id, f"{year:04d}"), set()).add(seq)
+
+        next_seq: Dict[tuple, list] = {}
+        saved = []
+        for draft in sorted(drafts, key=lambda d: d.date):
+            number = draft.number
+            if number is None:
+                key = (draft.issuer_id, draft.date[:4])
+                if key not in next_seq:
+                    next_seq[key] = list(_split_number(next_invoice_number(self.conn, draft.date, draft.issuer_id)))
+                series, year, seq = next_seq[key]
+                while seq in overrides.get(key, ()):
+                    seq += 1
+                number = _compose_number(year, seq, series)
+                next_seq[key][2] = seq + 1
+            elif NUMBER_RE.match(number):
+                _, year, seq = _split_number(number)
+                key = (draft.issuer_id, f"{year:04d}")
+                if key in next_seq:
+                    next_seq[key][2] = max(next_seq[key][2], seq + 1)
+            saved.append(self._save_in_tx(cur, draft, number))
+        return saved
+
+    @contextmanager
+    def transaction(self):
+        """One IMMEDIATE transaction: commit on success, rollback on error."""
+        self.conn.commit()  # BEGIN IMMEDIATE cannot nest in an open transaction
+        cur = self.conn.cursor()
+        # IMMEDIATE takes the write lock before the number is read, so two
+        # processes saving at once cannot get the same number.
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            yield cur
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+    def save(self, draft: InvoiceDraft) -> SavedInvoice:
+        self.check(draft)
+        with self.transaction() as cur:
+            return self._save_in_tx(cur, draft)
+
+    def save_many(self, drafts: List[InvoiceDraft], cur=None) -> List[SavedInvoice]:
+        """
+        All drafts or none, with consecutive numbers per year. With `cur`
+        the drafts join that open transaction (see transaction()) instead.
+        """
+        for draft in drafts:
+            self.check(draft)
+        if cur is not None:
+            return self._save_many_in_tx(cur, drafts)
+        with self.transaction() as cur:
+            return self._save_many_in_tx(cur, drafts)
@@ -1,5 +1,9 @@
+import os
 
 # --- Company / Issuer data ---
+# Seeds issuer 1 of a new database; further issuers live in the issuers
+# table (python main.py issuer-add ...). Later changes here are not copied
+# to the database: apply them with python main.py issuer-edit 1 ...
 COMPANY_NAME = "Xavier Anglada Gros"
 COMPANY_NIF = "43695894B"
 COMPANY_ADDRESS = ("Carrer Pau Picasso 20"
@@ -8,10 +12,35 @@ COMPANY_ADDRESS = ("Carrer Pau Picasso 20"
 COMPANY_IBAN = "ES47 1583 0001 1890 8909 7984"
 
 # --- Taxes (Spain) ---
-IVA_RATE = 0.21    # 21%
+IVA_RATE = 0.21    # 21% (default for new lines)
+IVA_RATES = (0.21, 0.10, 0.04, 0.0)  # general, reduced, super-reduced, exempt
 IRPF_RATE = 0.15   # 15%
 
 # --- Locale ---
 DATE_FMT = "%d/%m/%Y"
 CURRENCY = "EUR"
 OUTPUT_DIR = "out"
+PDF_STORE_DB = "invoice_pdfs.db"  # compressed, content-addressed PDF archive
+PDF_TO_STORE = False              # render jobs put PDFs in PDF_STORE_DB instead of OUTPUT_DIR
+
+# --- VeriFactu ---
+# AEAT invoice check service printed as a QR on every PDF
+# (test environment: https://prewww2.aeat.es/wlpl/TIKE-CONT/ValidarQR)
+VERIFACTU_QR_URL = "https://www2.agenciatributaria.gob.es/wlpl/TIKE-CONT/ValidarQR"
+REGISTER_CHECKPOINT_EVERY = 10000  # chain rows between checkpoint hashes
+
+# --- Backups ---
+BACKUP_DIR = "backups"
+BACKUP_KEEP = 14             # snapshots kept by rotation
+BACKUP_INTERVAL_MIN = 60     # GUI scheduled backup period
+
+# --- Email delivery (outbox) ---
+# Defaults point at a local test server: python -m aiosmtpd -n -l localhost:1025
+SMTP_HOST = os.environ.get("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", "1025"))
+SMTP_USER = os.environ.get("SMTP_USER", "")
+SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD", "")
+SMTP_STARTTLS = os.environ.get("SMTP_STARTTLS", "0") == "1"
+MAIL_FROM = os.environ.get("MAIL_FROM", "factures@localhost")
+MAIL_CONCURRENCY = 4      # SMTP connections used in parallel
+MAIL_MAX_ATTEMPTS = 6     # then the message is marked 'failed'
@@ -0,0 +1,127 @@
+from array import array
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .settings import IVA_RATE, IRPF_RATE, IVA_RATES
+
+# All money is integer cents, quantities are integer thousandths and rates
+# are integer basis points (21% -> 2100), so totals are exact and identical
+# in the CLI, the GUI and batch jobs.
+QTY_SCALE = 1000
+BP_SCALE = 10000
+
+
+def _div_half_up(n: int, d: int) -> int:
+    """n / d rounded half away from zero (the way invoices round), integers only."""
+    q = (abs(n) * 2 + d) // (2 * d)
+    return q if n >= 0 else -q
+
+
+def _scaled(x, scale: int) -> int:
+    return int((Decimal(str(x)) * scale).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def to_cents(x) -> int:
+    """12.345 -> 1235. Accepts float, int, str or Decimal."""
+    return _scaled(x, 100)
+
+
+def to_euros(cents: int) -> float:
+    return cents / 100
+
+
+def rate_bp(rate) -> int:
+    """0.21, 21 or '21' -> 2100 basis points."""
+    r = Decimal(str(rate))
+    if r > 1:
+        r = r / 100
+    return int((r * BP_SCALE).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def line_total_cents(qty, unit_price) -> int:
+    return _div_half_up(_scaled(qty, QTY_SCALE) * to_cents(unit_price), QTY_SCALE)
+
+
+def tax_cents(base_cents: int, bp: int) -> int:
+    return _div_half_up(base_cents * bp, BP_SCALE)
+
+
+def check_iva_rate(rate) -> float:
+    """Returns the rate as a fraction (0.21) or raises ValueError if it is not an IVA rate."""
+    bp = rate_bp(rate)
+    if bp not in {rate_bp(r) for r in IVA_RATES}:
+        allowed = "/".join(f"{r * 100:g}" for r in IVA_RATES)
+        raise ValueError(f"IVA rate must be one of {allowed} %")
+    return bp / BP_SCALE
+
+
+class Totals(NamedTuple):
+    base: int
+    iva: int
+    irpf: int
+    total: int
+    iva_by_rate: Tuple[Tuple[int, int, int], ...]  # (rate_bp, base, iva) per rate
+
+    def as_euros(self) -> Tuple[float, float, float, float]:
+        return to_euros(self.base), to_euros(self.iva), to_euros(self.irpf), to_euros(self.total)
+
+
+class LineBuffer:
+    """
+    Invoice lines of one or many invoices in parallel typed arrays, so a batch
+    of thousands of invoices is summed in one pass without per-line tuples.
+    """
+    __slots__ = ("invoice", "qty", "unit", "rate")
+
+    def __init__(self):
+        self.invoice = array("q")  # index of the invoice the line belongs to
+        self.qty = array("q")      # thousandths
+        self.unit = array("q")     # cents
+        self.rate = array("l")     # IVA basis points
+
+    def add(self, invoice: int, qty, unit_price, iva_rate=IVA_RATE) -> None:
+        self.invoice.append(invoice)
+        self.qty.append(_scaled(qty, QTY_SCALE))
+        self.unit.append(to_cents(unit_price))
+        self.rate.append(rate_bp(iva_rate))
+
+    def __len__(self) -> int:
+        return len(self.invoice)
+
+    def line_cents(self, i: int) -> int:
+        return _div_half_up(self.qty[i] * self.unit[i], QTY_SCALE)
+
+
+def compute_batch(lines: LineBuffer, n_invoices: Optional[int] = None, irpf_rate=IRPF_RATE) -> List[Totals]:
+    """
+    Totals of every invoice in `lines` (indexed 0..n_invoices-1) in one pass.
+    IVA is rounded once per rate and invoice, IRPF once on the whole base.
+    """
+    if n_invoices is None:
+        n_invoices = max(lines.invoice) + 1 if len(lines) else 0
+    bases: List[Dict[int, int]] = [{} for _ in range(n_invoices)]
+    inv, qty, unit, rate = lines.invoice, lines.qty, lines.unit, lines.rate
+    for i in range(len(inv)):
+        per_rate = bases[inv[i]]
+        per_rate[rate[i]] = per_rate.get(rate[i], 0) + _div_half_up(qty[i] * unit[i], QTY_SCALE)
+
+    irpf_bp = rate_bp(irpf_rate)
+    out = []
+    for per_rate in bases:
+        breakdown = tuple(sorted(((bp, b, tax_cents(b, bp)) for bp, b in per_rate.items()), reverse=True))
+        base = sum(b for _, b, _ in breakdown)
+        iva = sum(t for _, _, t in breakdown)
+        irpf = tax_cents(base, irpf_bp)
+        out.append(Totals(base, iva, irpf, base + iva - irpf, breakdown))
+    return out
+
+
+def compute_totals(items: Iterable, irpf_rate=IRPF_RATE) -> Totals:
+    """
+    Totals of one invoice. items: (description, qty, unit_price[, line_total[, iva_rate]]);
+    lines without a rate use IVA_RATE.
+    """
+    lines = LineBuffer()
+    for item in items:
+        lines.add(0, item[1], item[2], item[4] if len(item) > 4 else IVA_RATE)
+    return compute_batch(lines, 1, irpf_rate)[0]
@@ -1,17 +1,126 @@
 
 import re
 from datetime import datetime
+from functools import lru_cache
+from typing import Tuple
 from .settings import DATE_FMT
 
-NIF_RE = re.compile(r"^[A-Z0-9][A-Z0-9\d]{6,8}[A-Z0-9]$")
+DNI_RE = re.compile(r"^(\d{8})([A-Z])$")
+NIE_RE = re.compile(r"^([XYZKLM])(\d{7})([A-Z])$")
+CIF_RE = re.compile(r"^([ABCDEFGHJNPQRSUVW])(\d{7})([0-9A-J])$")
+DNI_LETTERS = "TRWAGMYFPDXBNJZSQVHLCKE"
+CIF_LETTERS = "JABCDEFGHI"
+
+def normalize_nif(nif: str | None) -> str:
+    """'43.695.894-b' -> '43695894B'. Drops an 'ES' VAT prefix."""
+    s = re.sub(r"[\s\-./]", "", (nif or "").upper())
+    if s.startswith("ES") and len(s) == 11:
+        s = s[2:]
+    return s
+
+def _cif_control(digits: str) -> int:
+    total = 0
+    for i, ch in enumerate(digits):
+        d = int(ch)
+        if i % 2 == 0:  # odd positions (1st, 3rd, ...) are doubled
+            d = sum(divmod(d * 2, 10))
+        total += d
+    return (10 - total % 10) % 10
 
 def validate_nif(nif: str) -> bool:
-    if not nif:
+    """Checks the control character of a DNI, NIE (X/Y/Z, K/L/M) or CIF."""
+    s = normalize_nif(nif)
+    if not s:
         return False
-    return bool(NIF_RE.match(nif.strip().upper()))
+    m = DNI_RE.match(s)
+    if m:
+        return DNI_LETTERS[int(m.group(1)) % 23] == m.group(2)
+    m = NIE_RE.match(s)
+    if m:
+        prefix, digits, letter = m.groups()
+        number = int("XYZ".index(prefix) if prefix in "XYZ" else 0) * 10**7 + int(digits)
+        return DNI_LETTERS[number % 23] == letter
+    m = CIF_RE.match(s)
+    if m:
+        kind, digits, control = m.groups()
+        digit = _cif_control(digits)
+        if kind in "PQRSNW":
+            return control == CIF_LETTERS[digit]
+        if kind in "ABEH":
+            return control == str(digit)
+        return control in (str(digit), CIF_LETTERS[digit])
+    return False
 
 def today_str() -> str:
     return datetime.today().strftime(DATE_FMT)
 
 def to_money(x: float) -> str:
     return f"{x:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def _insert_space_between_glued_caps(text: str) -> str:
+    """Turn 'Alella ParkBarcelona' -> 'Alella Park Barcelona' (accents too)."""
+    return re.sub(r'([a-záéíóúüïçñ])([A-ZÁÉÍÓÚÜÏÇÑ])', r'\1 \2', text)
+
+
+@lru_cache(maxsize=1024)
+def split_address_lines(address: str) -> Tuple[str, str, str]:
+    """
+    Return up to THREE lines: (line1, line2, line3).
+    Heuristics:
+      1) Respect existing newlines.
+      2) Split AFTER 'street + number' (handles glued postal code like '2008328').
+      3) Line2 begins with postal code if present.
+      4) Try to split line2 again into locality vs province/country.
+    """
+    if not address:
+        return "", "", ""
+
+    if "\n" in address:
+        parts = [p.strip() for p in address.split("\n")]
+        parts += ["", "", ""]
+        return parts[0], parts[1], parts[2]
+
+    s = _insert_space_between_glued_caps(re.sub(r"\s+", " ", address.strip()))
+
+    # number glued to postal code: "... 2008328 ..."
+    m = re.match(r"^(.*?\b)(\d{1,5})(\d{5})(\b.*)$", s)
+    if m:
+        left_prefix = m.group(1).strip().rstrip(",")
+        number = m.group(2)
+        postal = m.group(3)
+        rest = m.group(4).strip()
+        line1 = f"{left_prefix} {number}".strip()
+        line2_raw = f"{postal} {rest}".strip()
+    else:
+        # street+number + rest (allows 20B, 20-22, 20/2)
+        m = re.match(r"^(.*?\b\d+[A-Za-z\-\/]?)\b[ ,]*\s*(.+)$", s)
+        if m:
+            line1 = m.group(1).strip()
+            line2_raw = m.group(2).strip()
+        else:
+            # split before 5-digit postal code
+            m = re.match(r"^(.*?)(\b\d{5}\b.*)$", s)
+            if m:
+                line1 = m.group(1).strip().rstrip(",")
+                line2_raw = m.group(2).strip()
+            else:
+                # fallback
+                parts = s.split()
+                if len(parts) > 3:
+                    mid = max(2, min(len(parts) - 2, len(parts) // 2))
+                    return " ".join(parts[:mid]), " ".join(parts[mid:]), ""
+                return s, "", ""
+
+    # split line2_raw into line2 + line3
+    line2_raw = _insert_space_between_glued_caps(line2_raw)
+    if "," in line2_raw:
+        a, b = line2_raw.split(",", 1)
+        return line1, a.strip(), b.strip()
+
+    words = line2_raw.split()
+    if len(words) >= 4 and re.match(r"^\d{5}$", words[0]):
+        return line1, " ".join(words[:3]), " ".join(words[3:])
+    if len(words) >= 3:
+        return line1, " ".join(words[:2]), " ".join(words[2:])
+    return line1, line2_raw, ""
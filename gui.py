@@ -1,17 +1,19 @@
+import queue
 import sqlite3
+import threading
 from datetime import datetime
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 
-from app.db import (
-    init_db, list_clients, new_client,
-    next_invoice_number, insert_invoice, insert_item, fetch_invoice_full,
-    mark_invoice_used,
-)
+from app.db import get_conn, init_db, list_clients, list_issuers, new_client, fetch_invoice_full, iter_invoices_page
+from app.service import InvoiceDraft, InvoiceService
 from app.utils import to_money
-from app.settings import IVA_RATE, IRPF_RATE
+from app.settings import IVA_RATE, IVA_RATES, BACKUP_INTERVAL_MIN
+from app.backup import backup_db
+from app.totals import compute_totals, line_total_cents, to_euros
 from app.invoices import _parse_invoice_date_str   # reuse the same parser
 from app import pdf
+from app.render_worker import drain_in_background, job_status
 
 DB_PATH = "invoice_app.db"
 
@@ -20,9 +22,12 @@ class InvoiceGUI(tk.Tk):
         super().__init__()
         self.title("Invoice App — GUI (simple)")
         self.geometry("800x600")
-        self.conn = sqlite3.connect(DB_PATH)
+        self.conn = get_conn(DB_PATH)
         init_db(self.conn)
         self._build_ui()
+        self._backup_thread = None
+        self._backup_results = queue.Queue()  # filled by the backup thread, read on the Tk thread
+        self.after(BACKUP_INTERVAL_MIN * 60 * 1000, self._scheduled_backup)
 
     def _build_ui(self):
         nb = ttk.Notebook(self)
@@ -30,12 +35,15 @@ class InvoiceGUI(tk.Tk):
 
         self.clients_frame = ttk.Frame(nb)
         self.invoice_frame = ttk.Frame(nb)
+        self.history_frame = ttk.Frame(nb)
 
         nb.add(self.clients_frame, text="Clients")
         nb.add(self.invoice_frame, text="New Invoice")
+        nb.add(self.history_frame, text="History")
 
         self._build_clients_tab()
         self._build_invoice_tab()
+        self._build_history_tab()
 
     # -------- Clients Tab --------
     def _build_clients_tab(self):
@@ -73,8 +81,8 @@ class InvoiceGUI(tk.Tk):
 
     def _refresh_clients_list(self):
         self.clients_list.delete(0, tk.END)
-        self._clients_cache = list_clients(self.conn)
-        for cid, name, nif, addr, email, phone in self._clients_cache:
+        # list_clients is served by the shared ClientRepository cache
+        for cid, name, nif, addr, email, phone in list_clients(self.conn):
             self.clients_list.insert(tk.END, f"[{cid}] {name} — {nif}")
 
     def _add_client(self):
@@ -96,6 +104,8 @@ class InvoiceGUI(tk.Tk):
                 e.delete(0, tk.END)
             # Also update invoice tab dropdown
             self._refresh_invoice_clients()
+        except sqlite3.IntegrityError:
+            messagebox.showerror("Error", "A client with this NIF already exists")
         except Exception as e:
             messagebox.showerror("Error", str(e))
 
@@ -110,12 +120,17 @@ class InvoiceGUI(tk.Tk):
         self.client_dropdown.pack(side=tk.LEFT, padx=10)
         self._refresh_invoice_clients()
 
+        ttk.Label(top, text="Issuer:").pack(side=tk.LEFT)
+        issuers = [f"{iid} | {name}" for iid, name, *_ in list_issuers(self.conn)]
+        self.issuer_var = tk.StringVar(value=issuers[0])
+        ttk.Combobox(top, textvariable=self.issuer_var, values=issuers, state="readonly", width=30).pack(side=tk.LEFT, padx=10)
+
         self.items_frame = ttk.Frame(self.invoice_frame)
         self.items_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
         header = ttk.Frame(self.items_frame)
         header.pack(fill=tk.X)
-        for i, txt in enumerate(["Description", "Qty", "Unit Price", "Line Total"]):
+        for i, txt in enumerate(["Description", "Qty", "Unit Price", "IVA %", "Line Total"]):
             ttk.Label(header, text=txt, font=("Arial", 10, "bold")).grid(row=0, column=i, padx=5, pady=5, sticky="w")
 
         self.item_rows = []
@@ -148,19 +163,22 @@ class InvoiceGUI(tk.Tk):
         ent_desc = ttk.Entry(row, width=50)
         ent_qty = ttk.Entry(row, width=8)
         ent_price = ttk.Entry(row, width=12)
+        cmb_iva = ttk.Combobox(row, width=4, state="readonly", values=[f"{r * 100:g}" for r in IVA_RATES])
+        cmb_iva.set(f"{IVA_RATE * 100:g}")
         ent_total = ttk.Entry(row, width=14, state="readonly")
 
         ent_desc.grid(row=r_index, column=0, padx=5)
         ent_qty.grid(row=r_index, column=1, padx=5)
         ent_price.grid(row=r_index, column=2, padx=5)
-        ent_total.grid(row=r_index, column=3, padx=5)
+        cmb_iva.grid(row=r_index, column=3, padx=5)
+        ent_total.grid(row=r_index, column=4, padx=5)
 
         # update line total when qty/price change (on focus out)
         def update_line_total(*_):
             try:
                 q = float(ent_qty.get().strip().replace(",", "."))
                 p = float(ent_price.get().strip().replace(",", "."))
-                lt = q * p
+                lt = to_euros(line_total_cents(q, p))
                 ent_total.config(state="normal")
                 ent_total.delete(0, tk.END)
                 ent_total.insert(0, to_money(lt))
@@ -173,11 +191,12 @@ class InvoiceGUI(tk.Tk):
         ent_qty.bind("<FocusOut>", update_line_total)
         ent_price.bind("<FocusOut>", update_line_total)
 
-        self.item_rows.append((ent_desc, ent_qty, ent_price, ent_total))
+        self.item_rows.append((ent_desc, ent_qty, ent_price, cmb_iva, ent_total))
 
     def _collect_items(self):
+        """[(description, qty, unit_price, line_total, iva_rate)]"""
         items = []
-        for ent_desc, ent_qty, ent_price, _ in self.item_rows:
+        for ent_desc, ent_qty, ent_price, cmb_iva, _ in self.item_rows:
             desc = ent_desc.get().strip()
             if not desc:
                 continue
@@ -186,7 +205,8 @@ class InvoiceGUI(tk.Tk):
                 price = float(ent_price.get().strip().replace(",", "."))
             except ValueError:
                 raise ValueError("Invalid number in items (qty/price).")
-            items.append((desc, qty, price, qty * price))
+            iva_rate = float(cmb_iva.get()) / 100
+            items.append((desc, qty, price, to_euros(line_total_cents(qty, price)), iva_rate))
         if not items:
             raise ValueError("No valid items entered.")
         return items
@@ -196,10 +216,7 @@ class InvoiceGUI(tk.Tk):
             items = self._collect_items()
         except Exception as e:
             messagebox.showerror("Error", str(e)); return
-        base = round(sum(l[3] for l in items), 2)
-        iva = round(base * IVA_RATE, 2)
-        irpf = round(base * IRPF_RATE, 2)
-        total = round(base + iva - irpf, 2)
+        base, iva, irpf, total = compute_totals(items).as_euros()
         self.totals_var.set(f"Base: {to_money(base)}  IVA: {to_money(iva)}  IRPF: {to_money(irpf)}  TOTAL: {to_money(total)}")
 
     def _save_invoice(self):
@@ -214,6 +231,7 @@ class InvoiceGUI(tk.Tk):
             messagebox.showerror("Error", "Select a client.")
             return
         client_id = int(sel.split("|",1)[0].strip())
+        issuer_id = int(self.issuer_var.get().split("|", 1)[0])
 
         # --- Ask for invoice date (default = today) ---
         default_hint = datetime.now().strftime("%Y-%m-%d")
@@ -224,32 +242,162 @@ class InvoiceGUI(tk.Tk):
         )
         date_iso = _parse_invoice_date_str(date_input)
 
-        # --- Compute number for that year ---
-        number = next_invoice_number(self.conn, date_iso)
-
-        base = round(sum(l[3] for l in items), 2)
-        iva = round(base * IVA_RATE, 2)
-        irpf = round(base * IRPF_RATE, 2)
-        total = round(base + iva - irpf, 2)
-
-        # insert invoice + items
+        # number + invoice + items + invoice_seq in one transaction
         try:
-            inv_id = insert_invoice(self.conn, number, date_iso, client_id, base, iva, irpf, total, notes="")
-            # keep invoice_seq in sync (optional but recommended)
-            try:
-                mark_invoice_used(self.conn, number)
-            except Exception:
-                pass
+            saved = InvoiceService(self.conn).save(InvoiceDraft(client_id, date_iso, items, issuer_id=issuer_id))
+        except Exception as e:
+            messagebox.showerror("Error", f"Invoice not saved: {e}")
+            return
+        number, inv_id = saved.number, saved.id
+
+        # the render job was queued with the invoice
+        drain_in_background(self.conn)
+        self.status_var.set(f"Saved invoice {number}. PDF queued.")
+        messagebox.showinfo("OK", f"Invoice {number} saved. The PDF is being rendered.")
+        self.after(500, self._watch_render, inv_id, number, 60)
+
+    def _watch_render(self, inv_id, number, tries):
+        row = job_status(self.conn, inv_id)
+        if row and row[0] == "done":
+            self.status_var.set(f"Saved invoice {number}. Exported: {row[1]}")
+        elif row and row[2]:
+            self.status_var.set(f"Invoice {number} saved, but PDF export failed: {row[2]} "
+                                "(run 'python main.py render-worker' to retry)")
+        elif tries > 0:
+            self.after(500, self._watch_render, inv_id, number, tries - 1)
+        else:
+            self.status_var.set(f"Saved invoice {number}. PDF not rendered yet "
+                                "(run 'python main.py render-worker')")
+
+    # -------- History Tab --------
+    HISTORY_PAGE = 100
+
+    def _build_history_tab(self):
+        filters = ttk.Frame(self.history_frame)
+        filters.pack(fill=tk.X, padx=10, pady=10)
+
+        ttk.Label(filters, text="Client:").pack(side=tk.LEFT)
+        self.hist_client_var = tk.StringVar(value="All")
+        self.hist_client = ttk.Combobox(filters, textvariable=self.hist_client_var, state="readonly", width=30)
+        self.hist_client.pack(side=tk.LEFT, padx=(5, 10))
+        self.hist_client.bind("<Button-1>", lambda _e: self._refresh_history_clients())
+        self._refresh_history_clients()
+
+        ttk.Label(filters, text="Issuer:").pack(side=tk.LEFT)
+        self.hist_issuer_var = tk.StringVar(value="All")
+        ttk.Combobox(filters, textvariable=self.hist_issuer_var, state="readonly", width=20,
+                     values=["All"] + [f"{iid} | {name}" for iid, name, *_ in list_issuers(self.conn)]
+                     ).pack(side=tk.LEFT, padx=(5, 10))
+
+        ttk.Label(filters, text="From:").pack(side=tk.LEFT)
+        self.hist_from = ttk.Entry(filters, width=12)
+        self.hist_from.pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Label(filters, text="To:").pack(side=tk.LEFT)
+        self.hist_to = ttk.Entry(filters, width=12)
+        self.hist_to.pack(side=tk.LEFT, padx=(5, 10))
+        ttk.Button(filters, text="Search", command=self._reload_history).pack(side=tk.LEFT)
+
+        body = ttk.Frame(self.history_frame)
+        body.pack(fill=tk.BOTH, expand=True, padx=10)
+        cols = ("number", "date", "client", "total")
+        self.history = ttk.Treeview(body, columns=cols, show="headings", selectmode="browse")
+        for col, title, width, anchor in [
+            ("number", "Number", 110, "w"), ("date", "Date", 100, "w"),
+            ("client", "Client", 320, "w"), ("total", "Total", 110, "e"),
+        ]:
+            self.history.heading(col, text=title)
+            self.history.column(col, width=width, anchor=anchor)
+        scroll = ttk.Scrollbar(body, orient=tk.VERTICAL, command=self.history.yview)
+        self._hist_next_key, self._hist_done, self._hist_loading = None, True, False
+        self.history.configure(yscrollcommand=lambda first, last: self._on_history_scroll(scroll, first, last))
+        self.history.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scroll.pack(side=tk.LEFT, fill=tk.Y)
+        self.history.bind("<Double-1>", lambda _e: self._reexport_selected())
+
+        btn_row = ttk.Frame(self.history_frame)
+        btn_row.pack(fill=tk.X, padx=10, pady=10)
+        ttk.Button(btn_row, text="Re-export PDF", command=self._reexport_selected).pack(side=tk.LEFT)
+        self.hist_status_var = tk.StringVar(value="")
+        ttk.Label(btn_row, textvariable=self.hist_status_var, foreground="gray").pack(side=tk.LEFT, padx=10)
+
+        self._reload_history()
+
+    def _refresh_history_clients(self):
+        self.hist_client["values"] = ["All"] + [f"{cid} | {name}" for cid, name, *_ in list_clients(self.conn)]
+
+    def _reload_history(self):
+        sel = self.hist_client_var.get()
+        issuer = self.hist_issuer_var.get()
+        self._hist_filters = {
+            "client_id": int(sel.split("|", 1)[0]) if "|" in sel else None,
+            "issuer_id": int(issuer.split("|", 1)[0]) if "|" in issuer else None,
+            "date_from": _parse_invoice_date_str(self.hist_from.get()) if self.hist_from.get().strip() else None,
+            "date_to": _parse_invoice_date_str(self.hist_to.get()) if self.hist_to.get().strip() else None,
+        }
+        self.history.delete(*self.history.get_children())
+        self._hist_next_key = None
+        self._hist_done = False
+        self._load_history_page()
 
-            for desc, qty, price, line_total in items:
-                insert_item(self.conn, inv_id, desc, qty, price)
-            inv, it, cli = fetch_invoice_full(self.conn, inv_id)
+    def _load_history_page(self):
+        if self._hist_done:
+            return
+        rows, self._hist_next_key = iter_invoices_page(
+            self.conn, self._hist_next_key, self.HISTORY_PAGE, **self._hist_filters
+        )
+        self._hist_done = self._hist_next_key is None
+        self._hist_loading = False
+        for inv_id, number, date, client_id, client_name, total in rows:
+            self.history.insert("", tk.END, iid=str(inv_id),
+                                values=(number, date, client_name or f"#{client_id}", to_money(total)))
+        self.hist_status_var.set(f"{len(self.history.get_children())} invoices" + ("" if self._hist_done else " (scroll for more)"))
+
+    def _on_history_scroll(self, scroll, first, last):
+        scroll.set(first, last)
+        # lazy loading: fetch the next page when the end of the list comes into view
+        if float(last) >= 0.98 and not self._hist_done and not self._hist_loading:
+            self._hist_loading = True
+            self.after_idle(self._load_history_page)
+
+    def _reexport_selected(self):
+        sel = self.history.selection()
+        if not sel:
+            messagebox.showerror("Error", "Select an invoice.")
+            return
+        try:
+            inv, it, cli = fetch_invoice_full(self.conn, int(sel[0]))
             out_path = pdf.export_invoice(inv, it, cli)
-            self.status_var.set(f"Saved invoice {number}. Exported: {out_path}")
-            messagebox.showinfo("OK", f"Invoice {number} saved. Exported to: {out_path}")
+            self.hist_status_var.set(f"Exported: {out_path}")
         except Exception as e:
             messagebox.showerror("Error", str(e))
 
+    # -------- Scheduled backup --------
+    def _scheduled_backup(self):
+        # Runs off the Tk thread with its own connection; the backup API copies
+        # in small steps so saving invoices meanwhile is not blocked.
+        if self._backup_thread is None or not self._backup_thread.is_alive():
+            self._backup_thread = threading.Thread(target=self._run_backup, daemon=True)
+            self._backup_thread.start()
+            self.after(500, self._poll_backup)
+        self.after(BACKUP_INTERVAL_MIN * 60 * 1000, self._scheduled_backup)
+
+    def _run_backup(self):
+        # Tk is not thread-safe: only hand the result over, never touch widgets here.
+        try:
+            path = backup_db(DB_PATH)
+            msg = f"Backup: {path}"
+        except Exception as e:
+            msg = f"Backup failed: {e}"
+        self._backup_results.put(msg)
+
+    def _poll_backup(self):
+        running = self._backup_thread is not None and self._backup_thread.is_alive()  # before get: no lost result
+        try:
+            self.status_var.set(self._backup_results.get_nowait())
+        except queue.Empty:
+            if running:
+                self.after(500, self._poll_backup)
+
 def main():
     app = InvoiceGUI()
     app.mainloop()
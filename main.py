@@ -1,14 +1,24 @@
+import argparse
 import sqlite3
+import sys
+from datetime import date
 from app import add_client, new_client, init_db, choose_client_id, create_invoice_interactive
+from app.archive import archive_year
+from app.db import (DEFAULT_ISSUER_ID, fetch_invoice_by_number, get_conn, iter_invoices_page, list_issuers,
+                    new_issuer, update_issuer)
+from app.utils import to_money
+from app import audit, backup, einvoice, mailer, pdf, pdfstore, recurring, register, render_worker
+from app.settings import BACKUP_DIR, BACKUP_KEEP, IVA_RATE, MAIL_CONCURRENCY, OUTPUT_DIR, PDF_STORE_DB, PDF_TO_STORE
 
-def main():
-    conn = sqlite3.connect("invoice_app.db")
-    init_db(conn)
+DB_PATH = "invoice_app.db"
+
+def menu(conn):
     while True:
         print("Select option")
         print("1 - New Invoice")
         print("2 - New Client")
         print("3 - Exit")
+        print("4 - Invoice history")
         option = input().strip()
         if option == "1":
             cid = choose_client_id(conn)
@@ -19,12 +29,357 @@ def main():
             try:
                 new_client(conn, client)
                 print("Client added.")
+            except sqlite3.IntegrityError:
+                print("Could not add client: a client with this NIF already exists.")
             except Exception as e:
                 print("Could not add client:", e)
         elif option == "3":
+            render_worker.wait_background()
             break
+        elif option == "4":
+            history(conn)
         else:
             print("Unknown option. Try again.")
 
+def history(conn, page_size: int = 20):
+    raw = input("Client id (blank = all): ").strip()
+    client_id = int(raw) if raw.isdigit() else None
+    issuer_id = None
+    if len(list_issuers(conn)) > 1:
+        raw = input("Issuer id (blank = all): ").strip()
+        issuer_id = int(raw) if raw.isdigit() else None
+    key = None
+    while True:
+        rows, key = iter_invoices_page(conn, key, page_size, client_id=client_id, issuer_id=issuer_id)
+        for inv_id, number, date, cid, name, total in rows:
+            print(f"{number:>12}  {date}  {to_money(total):>12}  [{cid}] {name or ''}")
+        prompt = "Enter = more, invoice number = re-export PDF, q = back: " if key else "Invoice number = re-export PDF, Enter = back: "
+        answer = input(prompt).strip()
+        if answer and answer.lower() != "q":
+            try:
+                print("Exported:", pdf.export_invoice(*fetch_invoice_by_number(conn, answer)))
+            except Exception as e:
+                print("PDF export failed:", e)
+            return
+        if answer.lower() == "q" or not key:
+            return
+
+# --- Commands (python main.py <command> ...) ---
+def cmd_archive_year(conn, args) -> int:
+    try:
+        res = archive_year(conn, args.year)
+    except (ValueError, RuntimeError) as e:
+        print("Archive failed:", e)
+        return 1
+    print(f"Archived {res['invoices']} invoices ({res['items']} lines) of {res['year']} into {res['path']}")
+    return 0
+
+def cmd_pdf_store_put(conn, args) -> int:
+    store = pdfstore.open_store(args.store)
+    for number in args.numbers:
+        try:
+            digest = pdfstore.store_invoice_pdf(store, *fetch_invoice_by_number(conn, number))
+        except LookupError as e:
+            print(e)
+            return 1
+        print(f"{number} -> {digest[:12]}")
+    return 0
+
+def cmd_pdf_store_export(conn, args) -> int:
+    store = pdfstore.open_store(args.store)
+    count = pdfstore.export_to_folder(store, args.folder, args.numbers or None)
+    print(f"Exported {count} PDFs to {args.folder}")
+    return 0
+
+def cmd_pdf_store_migrate(conn, args) -> int:
+    store = pdfstore.open_store(args.store)
+    res = pdfstore.migrate_output_dir(store, args.folder, remove=args.remove)
+    print(f"Imported {res['files']} PDFs ({res['bytes']} bytes -> {res['stored_bytes']} bytes stored), removed {res['removed']}")
+    return 0
+
+def cmd_backup(conn, args) -> int:
+    path = backup.backup_db(args.db, args.dir, keep=args.keep, pages=args.pages)
+    print(f"Backup written: {path}")
+    return 0
+
+def cmd_backup_verify(conn, args) -> int:
+    snapshots = args.snapshots or backup.list_snapshots(args.db, args.dir)
+    bad = 0
+    for path in snapshots:
+        check = backup.verify_snapshot(path)
+        print(f"{path}: {check}")
+        bad += check != "ok"
+    return 1 if bad else 0
+
+def cmd_restore(conn, args) -> int:
+    conn.close()  # restore writes through its own connection
+    safety = backup.restore_snapshot(args.snapshot, args.db, args.dir)
+    print(f"Restored {args.snapshot} into {args.db}" + (f" (previous state saved as {safety})" if safety else ""))
+    return 0
+
+def cmd_audit(conn, args) -> int:
+    report = audit.run_audit(conn, args.since, args.issuer)
+    print(audit.format_report(report, args.limit))
+    return 1 if audit.has_problems(report) else 0
+
+def cmd_email_queue(conn, args) -> int:
+    if args.all_unsent:
+        print(f"Queued {mailer.enqueue_unsent(conn, args.since)} emails")
+        return 0
+    for number in args.numbers:
+        try:
+            inv = fetch_invoice_by_number(conn, number)[0]
+            mailer.enqueue_invoice_email(conn, inv[0], args.to)
+            print(f"Queued {number}")
+        except (LookupError, ValueError) as e:
+            print(e)
+            return 1
+    return 0
+
+def cmd_email_send(conn, args) -> int:
+    stats = mailer.deliver_outbox(conn, concurrency=args.concurrency, limit=args.limit)
+    print(f"Sent {stats['sent']}, failed {stats['failed']}")
+    return 1 if stats["failed"] else 0
+
+def cmd_einvoice(conn, args) -> int:
+    if args.since:
+        ids = [r[0] for r in conn.execute("SELECT id FROM invoices WHERE date >= ? ORDER BY date, id", (args.since,))]
+    else:
+        ids = []
+        for number in args.numbers:
+            try:
+                ids.append(fetch_invoice_by_number(conn, number)[0][0])
+            except LookupError as e:
+                print(e)
+                return 1
+    if len(ids) == 1:
+        print(einvoice.export_einvoice(conn, ids[0], args.out, args.format))
+        return 0
+    failed = 0
+    for invoice_id, path, error in einvoice.export_batch(args.db, ids, args.out, args.format, args.workers):
+        if error:
+            failed += 1
+            print(f"Invoice id {invoice_id}: {error}")
+    print(f"Exported {len(ids) - failed} {args.format} files to {args.out}, {failed} failed")
+    return 1 if failed else 0
+
+def cmd_render_queue(conn, args) -> int:
+    for number in args.numbers:
+        try:
+            inv = fetch_invoice_by_number(conn, number)[0]
+        except LookupError as e:
+            print(e)
+            return 1
+        render_worker.enqueue_render(conn, inv[0])
+        print(f"Queued {number}")
+    return 0
+
+def cmd_render_worker(conn, args) -> int:
+    conn.close()  # each worker process opens its own connection
+    store_path = args.store if args.to_store else None
+    render_worker.run_workers(args.db, processes=args.processes, once=args.once, store_path=store_path)
+    return 0
+
+def cmd_verify_register(conn, args) -> int:
+    report = register.verify_register(conn, workers=args.workers)
+    print(register.format_verify_report(report, args.limit))
+    return 1 if report["problems"] else 0
+
+def cmd_register_backfill(conn, args) -> int:
+    print(f"Registered {register.register_unregistered(conn)} invoices")
+    return 0
+
+def _parse_item(text: str) -> tuple:
+    """'description|qty|price[|iva%]' -> (description, qty, price, None, iva_rate)"""
+    parts = text.split("|")
+    if len(parts) not in (3, 4):
+        raise argparse.ArgumentTypeError(f"expected 'description|qty|price[|iva%]', got {text!r}")
+    try:
+        rate = float(parts[3].replace(",", ".")) / 100 if len(parts) == 4 else IVA_RATE
+        return parts[0].strip(), float(parts[1].replace(",", ".")), float(parts[2].replace(",", ".")), None, rate
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"bad number in {text!r}")
+
+def cmd_recurring_add(conn, args) -> int:
+    try:
+        tid = recurring.add_template(conn, args.client_id, args.item, args.cadence, args.start, args.notes, args.issuer)
+    except (ValueError, LookupError) as e:
+        print("Could not add template:", e)
+        return 1
+    print(f"Template {tid}: {args.cadence} from {args.start}")
+    return 0
+
+def cmd_run_recurring(conn, args) -> int:
+    res = recurring.run_recurring(conn, args.today)
+    for tid, error in res["skipped"]:
+        print(f"Template {tid} skipped: {error}")
+    numbers = [s.number for s in res["invoices"]]
+    print(f"Generated {len(numbers)} invoices from {res['templates']} templates" +
+          (f" ({numbers[0]} .. {numbers[-1]}); PDFs queued for render-worker" if numbers else ""))
+    return 1 if res["skipped"] else 0
+
+def cmd_issuer_add(conn, args) -> int:
+    issuer = {"name": args.name, "nif": args.nif, "address": args.address, "iban": args.iban, "series": args.series}
+    try:
+        iid = new_issuer(conn, issuer)
+    except ValueError as e:
+        print("Could not add issuer:", e)
+        return 1
+    except sqlite3.IntegrityError:
+        print(f"Could not add issuer: series {args.series!r} is already used.")
+        return 1
+    print(f"Issuer {iid}: {args.name}, numbers {args.series.upper()}YYYY-NNNN")
+    return 0
+
+def cmd_issuer_edit(conn, args) -> int:
+    changes = {"name": args.name, "nif": args.nif, "address": args.address, "iban": args.iban, "series": args.series}
+    try:
+        iid, name, nif, address, iban, series = update_issuer(conn, args.issuer_id, changes)
+    except (ValueError, LookupError) as e:
+        print("Could not edit issuer:", e)
+        return 1
+    except sqlite3.IntegrityError:
+        print(f"Could not edit issuer: series {args.series!r} is already used.")
+        return 1
+    print(f"Issuer {iid}: {name} ({nif}), numbers {series}YYYY-NNNN")
+    return 0
+
+def cmd_issuer_list(conn, args) -> int:
+    for iid, name, nif, address, iban, series in list_issuers(conn):
+        print(f"{iid:>3}  {series or '-':<5}  {nif:<10}  {name}")
+    return 0
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Invoice app. Without a command, opens the interactive menu.")
+    parser.add_argument("--db", default=DB_PATH, help="SQLite database file")
+    sub = parser.add_subparsers(dest="command")
+
+    p = sub.add_parser("archive-year", help="move a closed year into invoice_archive_<year>.db")
+    p.add_argument("year", type=int)
+    p.set_defaults(func=cmd_archive_year)
+
+    p = sub.add_parser("pdf-store-put", help="render invoices into the compressed PDF store")
+    p.add_argument("numbers", nargs="+")
+    p.add_argument("--store", default=PDF_STORE_DB)
+    p.set_defaults(func=cmd_pdf_store_put)
+
+    p = sub.add_parser("pdf-store-export", help="write stored PDFs to a folder")
+    p.add_argument("folder")
+    p.add_argument("numbers", nargs="*", help="invoice numbers (default: all)")
+    p.add_argument("--store", default=PDF_STORE_DB)
+    p.set_defaults(func=cmd_pdf_store_export)
+
+    p = sub.add_parser("pdf-store-migrate", help="import the loose PDFs of out/ into the store")
+    p.add_argument("--folder", default=OUTPUT_DIR)
+    p.add_argument("--remove", action="store_true", help="delete each file once it is verified in the store")
+    p.add_argument("--store", default=PDF_STORE_DB)
+    p.set_defaults(func=cmd_pdf_store_migrate)
+
+    p = sub.add_parser("backup", help="online, compressed, integrity-checked snapshot of the DB")
+    p.add_argument("--dir", default=BACKUP_DIR)
+    p.add_argument("--keep", type=int, default=BACKUP_KEEP)
+    p.add_argument("--pages", type=int, default=backup.BACKUP_PAGES, help="pages copied per step")
+    p.set_defaults(func=cmd_backup)
+
+    p = sub.add_parser("backup-verify", help="integrity_check snapshots (default: all)")
+    p.add_argument("snapshots", nargs="*")
+    p.add_argument("--dir", default=BACKUP_DIR)
+    p.set_defaults(func=cmd_backup_verify)
+
+    p = sub.add_parser("restore", help="restore the DB from a snapshot")
+    p.add_argument("snapshot")
+    p.add_argument("--dir", default=BACKUP_DIR)
+    p.set_defaults(func=cmd_restore)
+
+    p = sub.add_parser("audit", help="check totals, orphans, clients and numbering")
+    p.add_argument("--since", help="only invoices dated on/after YYYY-MM-DD")
+    p.add_argument("--limit", type=int, default=20, help="rows shown per check")
+    p.add_argument("--issuer", type=int, help="only this issuer id")
+    p.set_defaults(func=cmd_audit)
+
+    p = sub.add_parser("email-queue", help="queue invoice PDFs for email delivery")
+    p.add_argument("numbers", nargs="*")
+    p.add_argument("--to", help="recipient (default: the client's email)")
+    p.add_argument("--all-unsent", action="store_true", help="every invoice never queued whose client has an email")
+    p.add_argument("--since", help="with --all-unsent: only invoices dated on/after YYYY-MM-DD")
+    p.set_defaults(func=cmd_email_queue)
+
+    p = sub.add_parser("email-send", help="deliver due outbox messages")
+    p.add_argument("--concurrency", type=int, default=MAIL_CONCURRENCY)
+    p.add_argument("--limit", type=int, default=5000)
+    p.set_defaults(func=cmd_email_send)
+
+    p = sub.add_parser("einvoice", help="export Facturae 3.2.2 / UBL 2.1 XML")
+    p.add_argument("numbers", nargs="*")
+    p.add_argument("--since", help="every invoice dated on/after YYYY-MM-DD")
+    p.add_argument("--format", choices=einvoice.FORMATS, default="facturae")
+    p.add_argument("--out", default=OUTPUT_DIR)
+    p.add_argument("--workers", type=int, help="worker processes for batches (default: CPU count)")
+    p.set_defaults(func=cmd_einvoice)
+
+    p = sub.add_parser("render-queue", help="queue invoices for PDF (re-)rendering")
+    p.add_argument("numbers", nargs="+")
+    p.set_defaults(func=cmd_render_queue)
+
+    p = sub.add_parser("render-worker", help="render queued PDFs with a pool of processes")
+    p.add_argument("--processes", type=int, default=2)
+    p.add_argument("--once", action="store_true", help="exit when the queue is empty")
+    p.add_argument("--to-store", action=argparse.BooleanOptionalAction, default=PDF_TO_STORE,
+                   help=f"put PDFs in the PDF store instead of '{OUTPUT_DIR}/'")
+    p.add_argument("--store", default=PDF_STORE_DB)
+    p.set_defaults(func=cmd_render_worker)
+
+    p = sub.add_parser("recurring-add", help="bill the same lines to a client every period")
+    p.add_argument("client_id", type=int)
+    p.add_argument("--item", type=_parse_item, action="append", required=True, help="'description|qty|price[|iva%%]', repeatable")
+    p.add_argument("--cadence", choices=tuple(recurring.CADENCES), default="monthly")
+    p.add_argument("--start", default=date.today().isoformat(), help="first invoice date YYYY-MM-DD (default: today)")
+    p.add_argument("--notes", default="")
+    p.add_argument("--issuer", type=int, default=DEFAULT_ISSUER_ID, help="issuer id (default: %(default)s)")
+    p.set_defaults(func=cmd_recurring_add)
+
+    p = sub.add_parser("run-recurring", help="generate every due recurring invoice, catching up missed periods")
+    p.add_argument("--today", help="run as of YYYY-MM-DD (default: today)")
+    p.set_defaults(func=cmd_run_recurring)
+
+    p = sub.add_parser("issuer-add", help="add a legal entity to bill for, with its own number series")
+    p.add_argument("name")
+    p.add_argument("nif")
+    p.add_argument("--address", default="")
+    p.add_argument("--iban", default="")
+    p.add_argument("--series", required=True, help="number prefix, up to 5 letters (e.g. B -> B2025-0001)")
+    p.set_defaults(func=cmd_issuer_add)
+
+    p = sub.add_parser("issuer-edit", help="change an issuer's details (e.g. issuer 1 after editing settings.py)")
+    p.add_argument("issuer_id", type=int)
+    p.add_argument("--name")
+    p.add_argument("--nif")
+    p.add_argument("--address")
+    p.add_argument("--iban")
+    p.add_argument("--series", help="only while the issuer has no invoices")
+    p.set_defaults(func=cmd_issuer_edit)
+
+    p = sub.add_parser("issuer-list", help="list issuers")
+    p.set_defaults(func=cmd_issuer_list)
+
+    p = sub.add_parser("verify-register", help="re-check the invoice hash chain")
+    p.add_argument("--workers", type=int, help="worker processes (default: CPU count)")
+    p.add_argument("--limit", type=int, default=20, help="problems shown")
+    p.set_defaults(func=cmd_verify_register)
+
+    p = sub.add_parser("register-backfill", help="chain invoices saved before the register existed")
+    p.set_defaults(func=cmd_register_backfill)
+
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    conn = get_conn(args.db)
+    init_db(conn)
+    if args.command is None:
+        menu(conn)
+        return 0
+    return args.func(conn, args)
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
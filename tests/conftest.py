@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import db  # noqa: E402
+
+
+@pytest.fixture
+def conn():
+    conn = db.get_conn(":memory:")
+    db.init_db(conn)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def client_id(conn):
+    return db.new_client(conn, {"name": "Client SL", "nif": "B12345674", "address": "Carrer Major 1"})
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from app import archive, db
+from app.service import InvoiceDraft, InvoiceService
+
+
+@pytest.fixture
+def file_conn(tmp_path):
+    conn = db.get_conn(str(tmp_path / "invoices.db"))
+    db.init_db(conn)
+    yield conn
+    conn.close()
+
+
+def _archives(conn):
+    return [name for name in archive._attached(conn) if name.startswith("archive_")]
+
+
+def _fill(conn, years):
+    client_id = db.new_client(conn, {"name": "Client SL", "nif": "B12345674", "address": "Carrer Major 1"})
+    service = InvoiceService(conn)
+    for year in years:
+        for day in ("01-10", "06-15"):
+            service.save(InvoiceDraft(client_id, f"{year}-{day}", [("a", 1, year)]))
+
+
+def test_archive_moves_year_out_of_main(file_conn):
+    _fill(file_conn, [2020, 2021])
+    res = archive.archive_year(file_conn, 2020)
+    assert (res["invoices"], res["items"]) == (2, 2)
+    assert os.path.exists(res["path"])
+    assert file_conn.execute("SELECT COUNT(*) FROM invoices").fetchone()[0] == 2
+    assert archive.archived_years(file_conn) == [2020]
+    # still readable, and the sequence of the year is kept
+    inv, items, client = db.fetch_invoice_by_number(file_conn, "2020-0002")
+    assert inv[2] == "2020-06-15" and items[0][2] == 2020
+    assert db.next_invoice_number(file_conn, "2020-12-31") == "2020-0003"
+    with pytest.raises(ValueError):
+        archive.archive_year(file_conn, 2020)
+
+
+def test_many_archives_on_one_connection(file_conn):
+    years = list(range(2010, 2024))
+    _fill(file_conn, years)
+    for year in years:
+        archive.archive_year(file_conn, year)
+    assert _archives(file_conn) == []
+    assert db.fetch_invoice_full(file_conn, 1)[0][1] == "2010-0001"
+    assert db.fetch_invoice_by_number(file_conn, "2012-0001")[0][2] == "2012-01-10"
+    for invoice_id in range(1, 2 * len(years) + 1, 3):
+        assert db.fetch_invoice_full(file_conn, invoice_id)[0][0] == invoice_id
+    assert len(_archives(file_conn)) <= archive.MAX_ATTACHED
+
+
+def test_lookup_by_id_goes_to_one_archive(file_conn):
+    _fill(file_conn, [2018, 2019, 2020])
+    for year in (2018, 2019, 2020):
+        archive.archive_year(file_conn, year)
+    assert archive.find_archived_invoice(file_conn, invoice_id=3) == "archive_2019"
+    assert _archives(file_conn) == ["archive_2019"]
+
+
+def test_failed_archive_leaves_no_file(file_conn, monkeypatch):
+    _fill(file_conn, [2020])
+    real = archive._year_stats
+    monkeypatch.setattr(archive, "_year_stats",
+                        lambda conn, schema, year: (0, 0, 0, 0) if schema == "archive_new" else real(conn, schema, year))
+    with pytest.raises(RuntimeError):
+        archive.archive_year(file_conn, 2020)
+    assert not os.path.exists(archive.archive_path(file_conn, 2020))
+    assert file_conn.execute("SELECT COUNT(*) FROM invoices").fetchone()[0] == 2
+    monkeypatch.setattr(archive, "_year_stats", real)
+    assert archive.archive_year(file_conn, 2020)["invoices"] == 2
+
+
+def test_no_new_invoices_in_archived_year(file_conn):
+    _fill(file_conn, [2020])
+    archive.archive_year(file_conn, 2020)
+    with pytest.raises(ValueError, match="archived"):
+        InvoiceService(file_conn).save(InvoiceDraft(1, "2020-12-01", [("late", 1, 5)]))
@@ -0,0 +1,51 @@
+from app import audit
+from app.db import forward_invoice_number, insert_invoice, insert_item, mark_invoice_used, next_invoice_number
+from app.totals import compute_totals
+
+
+def _save(conn, client_id, number=None, date="2025-03-01"):
+    number = number or next_invoice_number(conn, date)
+    items = [("a", 1, 10)]
+    base, iva, irpf, total = compute_totals(items).as_euros()
+    invoice_id = insert_invoice(conn, number, date, client_id, base, iva, irpf, total, "")
+    for desc, qty, price in items:
+        insert_item(conn, invoice_id, desc, qty, price)
+    mark_invoice_used(conn, number)
+    return number
+
+
+def test_consecutive_numbers_have_no_gaps(conn, client_id):
+    assert [_save(conn, client_id) for _ in range(3)] == ["2025-0001", "2025-0002", "2025-0003"]
+    report = audit.run_audit(conn)
+    assert not audit.has_problems(report)
+
+
+def test_gap_is_reported(conn, client_id):
+    _save(conn, client_id)
+    _save(conn, client_id, number="2025-0005")
+    assert audit.numbering_gaps(conn) == [(1, 2025, 2, 4)]
+    assert audit.has_problems(audit.run_audit(conn))
+
+
+def test_forwarded_range_is_not_a_gap(conn, client_id):
+    _save(conn, client_id)
+    _save(conn, client_id)
+    forward_invoice_number(conn, "2025-0010")
+    assert _save(conn, client_id) == "2025-0010"
+    assert audit.numbering_gaps(conn) == []
+    # a hole outside the skipped range is still reported
+    _save(conn, client_id, number="2025-0013")
+    assert audit.numbering_gaps(conn) == [(1, 2025, 11, 12)]
+
+
+def test_gaps_are_per_year_and_respect_since(conn, client_id):
+    _save(conn, client_id, number="2024-0003", date="2024-12-30")
+    _save(conn, client_id, date="2025-01-02")
+    assert audit.numbering_gaps(conn) == [(1, 2024, 1, 2)]
+    assert audit.numbering_gaps(conn, since="2025-01-01") == []
+
+
+def test_duplicate_sequence_is_reported(conn, client_id):
+    _save(conn, client_id, number="2025-0007")
+    _save(conn, client_id, number="2025-007")
+    assert audit.numbering_duplicates(conn) == [(1, 2025, 7, "2025-0007, 2025-007")]
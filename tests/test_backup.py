@@ -0,0 +1,34 @@
+import sqlite3
+import time
+
+from app import backup
+
+
+def _make_db(path, rows=400):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, data TEXT)")
+    conn.executemany("INSERT INTO t (data) VALUES (?)", [("x" * 500,) for _ in range(rows)])
+    conn.commit()
+    conn.close()
+
+
+def test_backup_pauses_between_steps(tmp_path):
+    src = str(tmp_path / "src.db")
+    _make_db(src)
+    steps = []
+    started = time.monotonic()
+    path = backup.backup_db(src, str(tmp_path / "backups"), pages=8, sleep=0.01,
+                            progress=lambda status, remaining, total: steps.append(remaining))
+    elapsed = time.monotonic() - started
+    assert len(steps) > 5 and steps[-1] == 0
+    # one pause after every step but the last
+    assert elapsed >= 0.01 * (len(steps) - 1)
+    assert backup.verify_snapshot(path) == "ok"
+
+
+def test_rotation_keeps_newest(tmp_path):
+    src = str(tmp_path / "src.db")
+    _make_db(src, rows=10)
+    dest = str(tmp_path / "backups")
+    made = [backup.backup_db(src, dest, keep=2, sleep=0) for _ in range(4)]
+    assert backup.list_snapshots(src, dest) == made[-2:]
@@ -0,0 +1,107 @@
+import smtplib
+import socketserver
+import threading
+from email import message_from_bytes, policy
+
+import pytest
+
+from app import db, mailer
+from app.service import InvoiceDraft, InvoiceService
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib; recipients containing 'refuse' get a 550."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 stand-in")
+        rcpts = []
+        while True:
+            line = self.rfile.readline().decode().strip()
+            verb = line[:4].upper()
+            if not line or verb == "QUIT":
+                self.reply("221 bye")
+                return
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 stand-in")
+            elif verb == "MAIL":
+                rcpts = []
+                self.reply("250 ok")
+            elif verb == "RCPT":
+                if "refuse" in line:
+                    self.reply("550 no such user")
+                else:
+                    rcpts.append(line)
+                    self.reply("250 ok")
+            elif verb == "DATA":
+                self.reply("354 go on")
+                data = b""
+                while True:
+                    chunk = self.rfile.readline()
+                    if chunk in (b".\r\n", b""):
+                        break
+                    data += chunk
+                self.server.messages.append(message_from_bytes(data, policy=policy.default))
+                self.reply("250 queued")
+            else:  # RSET, NOOP
+                self.reply("250 ok")
+
+
+@pytest.fixture
+def smtp_server():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _SMTPHandler)
+    server.daemon_threads = True
+    server.messages, server.connections = [], 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _queue(conn, emails):
+    service = InvoiceService(conn)
+    for n, email in enumerate(emails):
+        cid = db.new_client(conn, {"name": f"C{n}", "nif": f"{n:08d}{'TRWAGMYFPDXBNJZSQVHLCKE'[n % 23]}",
+                                   "address": "", "email": email})
+        service.save(InvoiceDraft(cid, "2025-01-01", [("a", 1, 10)]))
+    return mailer.enqueue_unsent(conn)
+
+
+def test_delivery_through_local_smtp(conn, smtp_server):
+    assert _queue(conn, [f"c{n}@example.com" for n in range(6)] + ["refuse@example.com"]) == 7
+    port = smtp_server.server_address[1]
+    stats = mailer.deliver_outbox(conn, lambda: smtplib.SMTP("127.0.0.1", port, timeout=10), concurrency=2)
+    assert stats == {"sent": 6, "failed": 1}
+    assert smtp_server.connections == 2  # the refused recipient did not drop a connection
+
+    msg = min(smtp_server.messages, key=lambda m: m["Subject"])
+    assert msg["Subject"] == "Factura 2025-0001" and msg["To"] == "c0@example.com"
+    assert [p.get_filename() for p in msg.iter_attachments()] == ["invoice_2025-0001.pdf"]
+
+    rows = conn.execute("SELECT recipient, status, attempts FROM outbox ORDER BY id").fetchall()
+    assert rows[-1][:2] == ("refuse@example.com", "pending") and rows[-1][2] == 1
+    assert {r[1] for r in rows[:-1]} == {"sent"}
+    # nothing is due again until the backoff has passed
+    assert mailer.deliver_outbox(conn, lambda: smtplib.SMTP("127.0.0.1", port, timeout=10)) == {"sent": 0, "failed": 0}
+
+
+def test_claims_in_small_batches(conn, monkeypatch):
+    _queue(conn, [f"c{n}@example.com" for n in range(5)])
+    monkeypatch.setattr(mailer, "CLAIM_PER_SENDER", 2)
+    claimed = []
+    real_claim = mailer._claim
+    monkeypatch.setattr(mailer, "_claim", lambda conn, limit: claimed.append(limit) or real_claim(conn, limit))
+
+    class Fake:
+        def send_message(self, msg):
+            pass
+
+        def quit(self):
+            pass
+
+    assert mailer.deliver_outbox(conn, Fake, concurrency=1) == {"sent": 5, "failed": 0}
+    assert claimed == [2, 2, 2, 2]
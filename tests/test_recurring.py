@@ -0,0 +1,40 @@
+from app import recurring
+from app.service import InvoiceDraft, InvoiceService
+
+
+def _numbers(conn):
+    return [r[0] for r in conn.execute("SELECT number FROM invoices ORDER BY number")]
+
+
+def test_period_date_clamps_to_month_end():
+    assert recurring.period_date("2025-01-31", "monthly", 1) == "2025-02-28"
+    assert recurring.period_date("2025-01-31", "monthly", 2) == "2025-03-31"
+    assert recurring.period_date("2025-01-06", "weekly", 2) == "2025-01-20"
+
+
+def test_catch_up_bills_each_period_once(conn, client_id):
+    tid = recurring.add_template(conn, client_id, [("Quota", 1, 50)], "monthly", "2025-01-15")
+    res = recurring.run_recurring(conn, today="2025-04-20")
+    assert [s.number for s in res["invoices"]] == ["2025-0001", "2025-0002", "2025-0003", "2025-0004"]
+    assert [r[0] for r in conn.execute("SELECT date FROM invoices ORDER BY id")] == [
+        "2025-01-15", "2025-02-15", "2025-03-15", "2025-04-15"]
+
+    # same day again, and a later day within the same period: nothing new
+    assert recurring.run_recurring(conn, today="2025-04-20")["invoices"] == []
+    assert recurring.run_recurring(conn, today="2025-05-14")["invoices"] == []
+    assert len(_numbers(conn)) == 4
+    assert conn.execute("SELECT runs, next_run FROM recurring_templates WHERE id = ?",
+                        (tid,)).fetchone() == (4, "2025-05-15")
+
+    assert [s.number for s in recurring.run_recurring(conn, today="2025-05-15")["invoices"]] == ["2025-0005"]
+
+
+def test_batch_numbering_skips_override_numbers(conn, client_id):
+    drafts = [
+        InvoiceDraft(client_id, "2025-02-01", [("a", 1, 1)]),
+        InvoiceDraft(client_id, "2025-02-03", [("b", 1, 1)], number="2025-0002"),
+        InvoiceDraft(client_id, "2025-02-02", [("c", 1, 1)]),
+        InvoiceDraft(client_id, "2025-02-04", [("d", 1, 1)]),
+    ]
+    saved = InvoiceService(conn).save_many(drafts)
+    assert [s.number for s in saved] == ["2025-0001", "2025-0003", "2025-0002", "2025-0004"]
@@ -0,0 +1,44 @@
+import sqlite3
+
+import pytest
+
+from app.register import verify_register
+from app.service import InvoiceDraft, InvoiceService
+
+
+def _save(conn, client_id, n):
+    service = InvoiceService(conn)
+    for i in range(n):
+        service.save(InvoiceDraft(client_id, "2025-02-01", [("a", 1, 100 + i)]))
+
+
+def test_intact_register_verifies(conn, client_id):
+    _save(conn, client_id, 3)
+    report = verify_register(conn)
+    assert report["records"] == 3 and report["unregistered"] == 0
+    assert report["problems"] == []
+
+
+def test_register_is_append_only(conn, client_id):
+    _save(conn, client_id, 1)
+    with pytest.raises(sqlite3.DatabaseError):
+        conn.execute("UPDATE invoice_register SET total_cents = 1")
+
+
+def test_modified_record_is_detected(conn, client_id):
+    _save(conn, client_id, 3)
+    conn.execute("DROP TRIGGER invoice_register_no_update")
+    conn.execute("UPDATE invoice_register SET total_cents = total_cents + 1 WHERE seq = 2")
+    conn.commit()
+    problems = verify_register(conn)["problems"]
+    messages = [msg for _, seq, msg in problems if seq == 2]
+    assert any(m.startswith("hash mismatch") for m in messages)
+    assert any("differs from its record" in m for m in messages)
+
+
+def test_modified_invoice_is_detected(conn, client_id):
+    _save(conn, client_id, 2)
+    conn.execute("UPDATE invoices SET iva_cents = iva_cents - 1 WHERE number = '2025-0001'")
+    conn.commit()
+    problems = verify_register(conn)["problems"]
+    assert problems == [(problems[0][0], 1, "invoice 2025-0001 differs from its record")]
@@ -0,0 +1,85 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import pdf, render_worker
+from app.service import InvoiceDraft, InvoiceService
+
+
+@pytest.fixture
+def invoice_ids(conn, client_id):
+    saved = InvoiceService(conn).save_many([InvoiceDraft(client_id, "2025-01-01", [("a", 1, 1)]) for _ in range(2)])
+    return [s.id for s in saved]
+
+
+def _job(conn, invoice_id):
+    return conn.execute("""
+        SELECT status, attempts, next_attempt_at, last_error FROM render_jobs WHERE invoice_id = ?
+    """, (invoice_id,)).fetchone()
+
+
+def _make_due(conn):
+    conn.execute("UPDATE render_jobs SET next_attempt_at = ?", ((datetime.now() - timedelta(seconds=1)).isoformat(),))
+    conn.commit()
+
+
+def test_each_job_is_claimed_once(conn, invoice_ids):
+    first = render_worker.claim_job(conn, "w1")
+    second = render_worker.claim_job(conn, "w2")
+    assert {first[1], second[1]} == set(invoice_ids)
+    assert render_worker.claim_job(conn, "w3") is None
+
+
+def test_stale_claim_is_taken_over(conn, invoice_ids):
+    render_worker.claim_job(conn, "dead")
+    render_worker.claim_job(conn, "dead")
+    old = (datetime.now() - timedelta(seconds=render_worker.STALE_CLAIM + 5)).isoformat(timespec="seconds")
+    conn.execute("UPDATE render_jobs SET claimed_at = ? WHERE invoice_id = ?", (old, invoice_ids[0]))
+    conn.commit()
+    job = render_worker.claim_job(conn, "alive")
+    assert job[1] == invoice_ids[0] and job[2] == 2
+    assert render_worker.claim_job(conn, "alive") is None
+
+
+def test_failures_back_off_then_fail(conn, invoice_ids, monkeypatch):
+    def boom(*args):
+        raise OSError("disk full")
+    monkeypatch.setattr(pdf, "export_invoice", boom)
+    conn.execute("DELETE FROM render_jobs WHERE invoice_id != ?", (invoice_ids[0],))
+    conn.commit()
+
+    assert render_worker.run_one(conn, "w") is False
+    status, attempts, next_at, error = _job(conn, invoice_ids[0])
+    assert (status, attempts, error) == ("pending", 1, "OSError: disk full")
+    delay = (datetime.fromisoformat(next_at) - datetime.now()).total_seconds()
+    assert render_worker.BACKOFF_BASE - 5 < delay <= render_worker.BACKOFF_BASE
+    assert render_worker.run_one(conn, "w") is None  # not due yet
+
+    _make_due(conn)
+    assert render_worker.run_one(conn, "w") is False
+    delay = (datetime.fromisoformat(_job(conn, invoice_ids[0])[2]) - datetime.now()).total_seconds()
+    assert delay > render_worker.BACKOFF_BASE  # doubled
+
+    for _ in range(render_worker.MAX_ATTEMPTS - 2):
+        _make_due(conn)
+        render_worker.run_one(conn, "w")
+    assert _job(conn, invoice_ids[0])[:2] == ("failed", render_worker.MAX_ATTEMPTS)
+    _make_due(conn)
+    assert render_worker.run_one(conn, "w") is None
+
+
+def test_success_records_output(conn, invoice_ids, monkeypatch):
+    monkeypatch.setattr(pdf, "export_invoice", lambda inv, items, client: f"out/invoice_{inv[1]}.pdf")
+    assert render_worker.run_one(conn, "w") is True
+    assert render_worker.job_status(conn, invoice_ids[0]) == ("done", "out/invoice_2025-0001.pdf", None)
+
+
+def test_store_target_skips_output_dir(conn, invoice_ids, monkeypatch, tmp_path):
+    from app import pdfstore
+    monkeypatch.setattr(pdf, "export_invoice", lambda *args: pytest.fail("wrote to the output folder"))
+    store = pdfstore.open_store(str(tmp_path / "pdfs.db"))
+    while render_worker.run_one(conn, "w", store) is not None:
+        pass
+    assert render_worker.job_status(conn, invoice_ids[0]) == ("done", "store:2025-0001", None)
+    assert pdfstore.get_pdf(store, "2025-0002").startswith(b"%PDF")
+    store.close()
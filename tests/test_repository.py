@@ -0,0 +1,31 @@
+import gc
+import sqlite3
+
+from app import db, repository
+
+
+def test_repository_is_dropped_with_its_connection():
+    before = len(repository._REPOS)
+    conn = db.get_conn(":memory:")
+    db.init_db(conn)
+    assert db.get_client(conn, 1) is None
+    assert len(repository._REPOS) == before + 1
+    conn.close()
+    del conn
+    gc.collect()
+    assert len(repository._REPOS) == before
+
+
+def test_plain_connections_are_not_registered():
+    conn = sqlite3.connect(":memory:")
+    db.init_db(conn)
+    before = len(repository._REPOS)
+    cid = db.new_client(conn, {"name": "A", "nif": "12345678Z", "address": ""})
+    assert db.get_client(conn, cid)[1] == "A"
+    assert len(repository._REPOS) == before
+
+
+def test_new_client_is_visible_immediately(conn):
+    assert db.list_clients(conn) == []
+    cid = db.new_client(conn, {"name": "A", "nif": "12345678Z", "address": ""})
+    assert [c[0] for c in db.list_clients(conn)] == [cid]
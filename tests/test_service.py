@@ -0,0 +1,46 @@
+import sqlite3
+
+import pytest
+
+from app.db import new_issuer
+from app.service import InvoiceDraft, InvoiceService
+
+
+def test_override_outside_default_series_message(conn, client_id):
+    new_issuer(conn, {"name": "B Co", "nif": "A58818501", "series": "B"})
+    with pytest.raises(ValueError) as exc:
+        InvoiceService(conn).save(InvoiceDraft(client_id, "2025-01-01", [("a", 1, 1)], number="B2025-0001"))
+    assert str(exc.value) == "Invoice number B2025-0001 is not in the issuer's series (none)."
+
+
+def test_override_outside_named_series_message(conn, client_id):
+    iid = new_issuer(conn, {"name": "B Co", "nif": "A58818501", "series": "B"})
+    with pytest.raises(ValueError, match=r"series 'B'\.$"):
+        InvoiceService(conn).save(InvoiceDraft(client_id, "2025-01-01", [("a", 1, 1)], number="2025-0001", issuer_id=iid))
+
+
+def _counts(conn):
+    return [conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+            for t in ("invoices", "invoice_items", "invoice_seq", "render_jobs", "invoice_register")]
+
+
+def test_failing_line_rolls_back_the_whole_invoice(conn, client_id):
+    service = InvoiceService(conn)
+    service.save(InvoiceDraft(client_id, "2025-01-01", [("ok", 1, 1)]))
+    before = _counts(conn)
+    # the header is written before the lines; a NULL description fails on the second line
+    with pytest.raises(sqlite3.IntegrityError):
+        service.save(InvoiceDraft(client_id, "2025-01-02", [("ok", 1, 1), (None, 1, 1)]))
+    assert _counts(conn) == before
+    assert not conn.in_transaction
+    assert service.save(InvoiceDraft(client_id, "2025-01-03", [("ok", 1, 1)])).number == "2025-0002"
+
+
+def test_save_many_is_all_or_nothing(conn, client_id):
+    service = InvoiceService(conn)
+    drafts = [InvoiceDraft(client_id, "2025-01-01", [("ok", 1, 1)]),
+              InvoiceDraft(client_id, "2025-01-02", [(None, 1, 1)])]
+    with pytest.raises(sqlite3.IntegrityError):
+        service.save_many(drafts)
+    assert _counts(conn)[0] == 0
+    assert service.save(drafts[0]).number == "2025-0001"
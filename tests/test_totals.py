@@ -0,0 +1,42 @@
+from app.totals import LineBuffer, compute_batch, compute_totals, _div_half_up
+
+
+def test_div_half_up_rounds_away_from_zero():
+    assert _div_half_up(5, 10) == 1
+    assert _div_half_up(15, 10) == 2
+    assert _div_half_up(25, 10) == 3   # not banker's rounding
+    assert _div_half_up(-5, 10) == -1
+    assert _div_half_up(4, 10) == 0
+
+
+def test_line_total_rounds_half_up():
+    t = compute_totals([("half a cent", 0.5, 0.01, None, 0.0)], irpf_rate=0)
+    assert t.base == 1
+
+
+def test_taxes_round_half_up():
+    # 0.50 * 21% = 10.5 cents, 0.50 * 15% = 7.5 cents
+    t = compute_totals([("a", 1, 0.50)])
+    assert (t.base, t.iva, t.irpf, t.total) == (50, 11, 8, 53)
+
+
+def test_iva_is_rounded_once_per_rate():
+    # per line 0.05 * 10% = 0.5 cent -> 1 + 1; per rate 0.10 * 10% = 1 cent
+    t = compute_totals([("x", 1, 10, None, 0.21), ("y", 1, 0.05, None, 0.10), ("z", 1, 0.05, None, 0.10)])
+    assert t.iva_by_rate == ((2100, 1000, 210), (1000, 10, 1))
+    assert (t.base, t.iva, t.irpf, t.total) == (1010, 211, 152, 1069)
+
+
+def test_compute_batch_matches_compute_totals():
+    invoices = [
+        [("a", 3, 19.99, None, 0.21), ("b", 0.25, 7.33, None, 0.04)],
+        [],
+        [("c", 1.5, 0.35, None, 0.10), ("d", 2, 120, None, 0.0), ("e", 1, 0.07, None, 0.10)],
+    ]
+    lines = LineBuffer()
+    for n, items in enumerate(invoices):
+        for _, qty, price, _, rate in items:
+            lines.add(n, qty, price, rate)
+    batch = compute_batch(lines, len(invoices))
+    assert batch == [compute_totals(items) for items in invoices]
+    assert batch[1] == (0, 0, 0, 0, ())
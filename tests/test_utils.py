@@ -0,0 +1,36 @@
+import pytest
+
+from app.utils import normalize_nif, validate_nif
+
+
+@pytest.mark.parametrize("nif", [
+    "12345678Z",        # DNI
+    "12.345.678-z",     # DNI, formatted
+    "X1234567L",        # NIE
+    "Y1234567X",
+    "Z1234567R",
+    "B12345674",        # CIF, digit control
+    "A58818501",
+    "Q2826000H",        # CIF, letter control
+    "ES B12345674",     # with VAT prefix
+])
+def test_valid_nifs(nif):
+    assert validate_nif(nif)
+
+
+@pytest.mark.parametrize("nif", [
+    "12345678A",        # wrong DNI letter
+    "X1234567A",        # wrong NIE letter
+    "B12345675",        # wrong CIF digit
+    "Q28260008",        # P/Q/R/S/N/W need a letter
+    "1234567Z",         # too short
+    "",
+    None,
+])
+def test_invalid_nifs(nif):
+    assert not validate_nif(nif)
+
+
+def test_normalize_nif():
+    assert normalize_nif("43.695.894-b") == "43695894B"
+    assert normalize_nif("ES43695894B") == "43695894B"